@@ -0,0 +1,204 @@
+import logging
+import threading
+import zlib
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Optional, Tuple
+from sqlalchemy import distinct, func, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from . import models
+from .hyperloglog import HyperLogLog, merge_registers
+from .rollups import bucket_start
+import sys
+sys.path.append('/app')
+from .shared.config import config
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SketchKey = Tuple[datetime, int]  # (day, shard)
+
+
+class ActiveUsers:
+    """
+    Distinct active users per day, counted over any range of days
+
+    In "hll" mode every day has HyperLogLog sketches of the users with
+    events that day, split into SYSTEM_COUNTER_SHARDS rows by user ID like
+    the system counters. A range is answered by merging its sketches, so
+    the cost depends on the number of days, not of users; the estimate has
+    a relative standard error of 1.04 / sqrt(2**HLL_PRECISION).
+
+    In "exact" mode nothing extra is stored: distinct users are counted
+    from the daily rollups, which is exact but grows with the number of
+    active users. Meant for small deployments.
+    """
+
+    def __init__(self, mode: Optional[str] = None, precision: Optional[int] = None):
+        self.mode = mode or config.ACTIVE_USERS_MODE
+        self.precision = precision or config.HLL_PRECISION
+        # Committed sketches seen by this process; a batch whose users are all
+        # already in them cannot change the stored sketch and skips the database
+        self._known: Dict[SketchKey, HyperLogLog] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def relative_error(self) -> float:
+        return 0.0 if self.mode == "exact" else 1.04 / (1 << self.precision) ** 0.5
+
+    def record(self, db: Session, rows: Iterable[dict]) -> Dict[SketchKey, HyperLogLog]:
+        """
+        Add the users of stored events to their days' sketches
+
+        Args:
+            db: Database session (committed by the caller, with the events)
+            rows: Stored event rows with user_id and timestamp
+
+        Returns:
+            Updated sketches; pass them to remember() once the transaction commits
+        """
+        if self.mode == "exact":
+            return {}
+
+        users: Dict[SketchKey, set] = defaultdict(set)
+        for row in rows:
+            users[(bucket_start(row["timestamp"], "day"), row["user_id"] % config.SYSTEM_COUNTER_SHARDS)].add(
+                row["user_id"]
+            )
+
+        updated = {}
+        # Fixed order, so concurrent writers lock sketch rows in the same order
+        for key in sorted(users):
+            with self._lock:
+                known = self._known.get(key)
+            if known is not None and not known.would_change(users[key]):
+                continue
+
+            row = self._lock_sketch(db, *key)
+            sketch = HyperLogLog.from_bytes(row.registers)
+            if sketch.update(users[key]):
+                row.registers = sketch.to_bytes()
+                row.updated_at = datetime.utcnow()
+            updated[key] = sketch
+        return updated
+
+    def remember(self, sketches: Dict[SketchKey, HyperLogLog]):
+        """Cache committed sketches, keeping only the most recent days"""
+        if not sketches:
+            return
+        with self._lock:
+            self._known.update(sketches)
+            days = sorted({day for day, _ in self._known})
+            for day, shard in [key for key in self._known if key[0] < days[-1] - timedelta(days=2)]:
+                del self._known[(day, shard)]
+
+    def forget(self):
+        """Drop cached sketches (after the stored ones were deleted)"""
+        with self._lock:
+            self._known.clear()
+
+    def _lock_sketch(self, db: Session, day: datetime, shard: int) -> models.ActiveUserSketch:
+        query = db.query(models.ActiveUserSketch).filter(
+            models.ActiveUserSketch.day == day,
+            models.ActiveUserSketch.shard == shard
+        ).with_for_update()
+        row = query.first()
+        if row is not None:
+            return row
+        try:
+            with db.begin_nested():
+                row = models.ActiveUserSketch(day=day, shard=shard, registers=HyperLogLog(self.precision).to_bytes())
+                db.add(row)
+            return row
+        except IntegrityError:
+            # Created by a concurrent writer in the meantime
+            return query.one()
+
+    def count(self, db: Session, start: datetime, end: datetime) -> int:
+        """
+        Distinct users active on any day from start to end (inclusive)
+
+        Args:
+            db: Database session
+            start: First day
+            end: Last day
+
+        Returns:
+            Number of distinct active users (estimated in "hll" mode)
+        """
+        start, end = bucket_start(start, "day"), bucket_start(end, "day")
+        if self.mode == "exact":
+            return db.scalar(
+                select(func.count(distinct(models.UserEventRollup.user_id))).where(
+                    models.UserEventRollup.granularity == "day",
+                    models.UserEventRollup.bucket_start >= start,
+                    models.UserEventRollup.bucket_start <= end
+                )
+            ) or 0
+
+        stored = db.scalars(
+            select(models.ActiveUserSketch.registers).where(
+                models.ActiveUserSketch.day >= start,
+                models.ActiveUserSketch.day <= end
+            )
+        ).all()
+        if not stored:
+            return 0
+        return HyperLogLog(self.precision, merge_registers(zlib.decompress(data) for data in stored)).count()
+
+    def counts(self, db: Session, day: Optional[datetime] = None) -> Dict[str, int]:
+        """Daily, weekly (7 days) and monthly (30 days) active users up to a day (default today)"""
+        day = bucket_start(day or datetime.utcnow(), "day")
+        return {
+            "daily": self.count(db, day, day),
+            "weekly": self.count(db, day - timedelta(days=6), day),
+            "monthly": self.count(db, day - timedelta(days=29), day),
+        }
+
+
+active_users = ActiveUsers()
+
+
+def record_from_rollups(db: Session, batch_size: int = 10000) -> int:
+    """
+    Add every user-day of the daily rollups to the sketches
+
+    Args:
+        db: Database session (committed by the caller)
+        batch_size: Rollup rows read per round trip
+
+    Returns:
+        Number of user-days recorded
+    """
+    query = select(
+        models.UserEventRollup.user_id,
+        models.UserEventRollup.bucket_start.label("timestamp")
+    ).where(models.UserEventRollup.granularity == "day").distinct().execution_options(yield_per=batch_size)
+
+    user_days = 0
+    for partition in db.execute(query).partitions():
+        active_users.record(db, [row._mapping for row in partition])
+        user_days += len(partition)
+    return user_days
+
+
+def backfill_active_users(engine: Engine):
+    """
+    Build the daily sketches from the daily rollups when there are none yet
+
+    Args:
+        engine: Analytics database engine
+    """
+    if active_users.mode == "exact":
+        return
+
+    with Session(engine) as db:
+        if db.scalar(select(func.count()).select_from(models.ActiveUserSketch)):
+            return
+        user_days = record_from_rollups(db)
+        db.commit()
+
+    if user_days:
+        logger.info(f"Backfilled active user sketches from {user_days} user-days")
@@ -0,0 +1,233 @@
+"""
+Vectorized analytics queries over columnar snapshots of the projections
+
+Cohort, distribution and hour-of-day questions scan every user, which
+row by row over ORM objects costs seconds per request. Instead the
+relevant columns are read once, in chunks, into NumPy arrays, and each
+query is a handful of array operations over them. The arrays are cached
+in an AnalyticsSnapshot and reloaded at most every
+ANALYTICS_SNAPSHOT_REFRESH_SECONDS.
+
+User activity comes from the daily and hourly rollups rather than the
+raw event tables: they hold the same events folded per user-day and per
+hour, are much smaller, and outlive the event retention window.
+"""
+import logging
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Sequence
+import numpy as np
+from sqlalchemy import Select, select
+from sqlalchemy.orm import Session
+from . import models
+import sys
+sys.path.append('/app')
+from .shared.config import config
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Numeric user_statistics columns a distribution can be computed for
+METRICS = ("total_notes", "total_notes_created", "total_notes_updated", "total_notes_deleted", "total_logins")
+
+PERCENTILES = (50, 75, 90, 95, 99)
+
+# Rows fetched per round trip while loading a snapshot
+LOAD_BATCH_SIZE = 50000
+
+# 1970-01-01 was a Thursday; shifting days by 3 makes weeks start on Monday
+_WEEK_SHIFT_DAYS = 3
+
+
+def load_columns(db: Session, query: Select, dtypes: Dict[str, str]) -> Dict[str, np.ndarray]:
+    """
+    Run a query and return its columns as arrays, converting one chunk of rows at a time
+
+    Args:
+        db: Database session
+        query: Select whose columns match dtypes, in order
+        dtypes: Array name -> NumPy dtype (None values of datetime columns become NaT)
+
+    Returns:
+        Array name -> array, all of the same length
+    """
+    chunks: Dict[str, List[np.ndarray]] = {name: [] for name in dtypes}
+    for partition in db.execute(query.execution_options(yield_per=LOAD_BATCH_SIZE)).partitions():
+        for (name, dtype), values in zip(dtypes.items(), zip(*partition)):
+            chunks[name].append(np.array(values, dtype=dtype))
+    return {
+        name: np.concatenate(chunks[name]) if chunks[name] else np.empty(0, dtype=dtype)
+        for name, dtype in dtypes.items()
+    }
+
+
+def week_index(days: np.ndarray) -> np.ndarray:
+    """Monday-based week number of datetime64 values"""
+    return (days.astype("datetime64[D]").astype(np.int64) + _WEEK_SHIFT_DAYS) // 7
+
+
+def week_start(index: int) -> datetime:
+    return np.datetime64(int(index) * 7 - _WEEK_SHIFT_DAYS, "D").astype("datetime64[s]").item()
+
+
+def retention_cohorts(
+    user_ids: np.ndarray,
+    registered_at: np.ndarray,
+    active_user_ids: np.ndarray,
+    active_days: np.ndarray,
+    cohorts: int,
+    weeks: int,
+    now: Optional[datetime] = None
+) -> List[dict]:
+    """
+    Weekly retention of users grouped by the week they registered
+
+    Args:
+        user_ids: User IDs of user_statistics
+        registered_at: Their registration times (NaT if unknown; such users are skipped)
+        active_user_ids: User of every active user-day
+        active_days: Day of every active user-day
+        cohorts: Number of most recent registration weeks returned
+        weeks: Weeks after registration tracked per cohort (week 0 is the registration week)
+        now: End of the observed period (default now); later weeks are left out
+
+    Returns:
+        One dict per cohort, oldest first: week_start, users, and per week since
+        registration the number (active) and share (retention) of its users active
+    """
+    known = ~np.isnat(registered_at)
+    order = np.argsort(user_ids[known], kind="stable")
+    users = user_ids[known][order]
+    user_weeks = week_index(registered_at[known][order])
+    if not len(users):
+        return []
+
+    current_week = int(week_index(np.array([now or datetime.utcnow()], dtype="datetime64[s]"))[0])
+    cohort_weeks = np.arange(current_week - cohorts + 1, current_week + 1)
+    in_range = (user_weeks >= cohort_weeks[0]) & (user_weeks <= current_week)
+    sizes = np.bincount(user_weeks[in_range] - cohort_weeks[0], minlength=cohorts)
+
+    # Position of each active user-day's user in `users` (or no match)
+    positions = np.searchsorted(users, active_user_ids)
+    positions[positions == len(users)] = 0
+    matched = users[positions] == active_user_ids
+    positions = positions[matched]
+    offsets = week_index(active_days[matched]) - user_weeks[positions]
+    tracked = (offsets >= 0) & (offsets < weeks) & in_range[positions]
+
+    # A user counts once per week however many days they were active in it
+    user_offsets = np.unique(positions[tracked].astype(np.int64) * weeks + offsets[tracked])
+    cells = (user_weeks[user_offsets // weeks] - cohort_weeks[0]) * weeks + user_offsets % weeks
+    active = np.bincount(cells, minlength=cohorts * weeks).reshape(cohorts, weeks)
+
+    result = []
+    for index, cohort_week in enumerate(cohort_weeks):
+        observed = min(weeks, current_week - int(cohort_week) + 1)
+        size = int(sizes[index])
+        result.append({
+            "week_start": week_start(cohort_week),
+            "users": size,
+            "active": active[index, :observed].tolist(),
+            "retention": (active[index, :observed] / size if size else np.zeros(observed)).round(4).tolist(),
+        })
+    return result
+
+
+def histogram(values: np.ndarray, bins: int) -> List[dict]:
+    """
+    Counts of integer values in up to `bins` equally wide integer ranges
+
+    Returns:
+        One dict per range: start and end (both inclusive) and count
+    """
+    if not len(values):
+        return []
+    low, high = int(values.min()), int(values.max())
+    width = max(1, -(-(high - low + 1) // bins))
+    counts = np.bincount((values - low) // width, minlength=-(-(high - low + 1) // width))
+    return [
+        {"start": low + index * width, "end": low + (index + 1) * width - 1, "count": int(count)}
+        for index, count in enumerate(counts)
+    ]
+
+
+def percentiles(values: np.ndarray, points: Sequence[float] = PERCENTILES) -> Dict[str, float]:
+    if not len(values):
+        return {f"p{point}": 0.0 for point in points}
+    return {f"p{point}": float(value) for point, value in zip(points, np.percentile(values, points))}
+
+
+def activity_by_hour(hours: np.ndarray, counts: np.ndarray) -> List[int]:
+    """Events per hour of day (UTC) from hourly bucket starts and their event counts"""
+    hour_of_day = hours.astype("datetime64[h]").astype(np.int64) % 24
+    return np.bincount(hour_of_day, weights=counts, minlength=24).astype(np.int64).tolist()
+
+
+class AnalyticsSnapshot:
+    """
+    Columns of the projections held in memory and reloaded at most every few minutes
+
+    Like the system statistics snapshot, at most one reload runs at a time
+    per process and other requests keep using the previous arrays
+    meanwhile. Results are as fresh as `loaded_at`.
+    """
+
+    def __init__(self, refresh_seconds: Optional[float] = None):
+        self.refresh_seconds = (
+            config.ANALYTICS_SNAPSHOT_REFRESH_SECONDS if refresh_seconds is None else refresh_seconds
+        )
+        self._lock = threading.Lock()
+        self._arrays: Optional[Dict[str, Dict[str, np.ndarray]]] = None
+        self._loaded_at = 0.0
+        self.loaded_at: Optional[datetime] = None
+
+    def load(self, db: Session) -> Dict[str, Dict[str, np.ndarray]]:
+        started = time.perf_counter()
+        statistics = models.UserStatistics
+        user_rollups = models.UserEventRollup
+        system_rollups = models.SystemEventRollup
+        arrays = {
+            "statistics": load_columns(
+                db,
+                select(statistics.user_id, statistics.registered_at, *(getattr(statistics, metric) for metric in METRICS)),
+                {"user_id": "int64", "registered_at": "datetime64[s]", **{metric: "int64" for metric in METRICS}}
+            ),
+            "active_days": load_columns(
+                db,
+                select(user_rollups.user_id, user_rollups.bucket_start).where(
+                    user_rollups.granularity == "day"
+                ).distinct(),
+                {"user_id": "int64", "day": "datetime64[D]"}
+            ),
+            "hourly": load_columns(
+                db,
+                select(system_rollups.bucket_start, system_rollups.event_type, system_rollups.event_count).where(
+                    system_rollups.granularity == "hour"
+                ),
+                {"hour": "datetime64[h]", "event_type": "object", "event_count": "int64"}
+            ),
+        }
+        logger.info(
+            f"Loaded analytics snapshot: {len(arrays['statistics']['user_id'])} users, "
+            f"{len(arrays['active_days']['user_id'])} user-days in {time.perf_counter() - started:.2f}s"
+        )
+        return arrays
+
+    def get(self, db: Session) -> Dict[str, Dict[str, np.ndarray]]:
+        if self._arrays is not None and time.monotonic() - self._loaded_at < self.refresh_seconds:
+            return self._arrays
+
+        if not self._lock.acquire(blocking=self._arrays is None):
+            return self._arrays
+        try:
+            if self._arrays is None or time.monotonic() - self._loaded_at >= self.refresh_seconds:
+                self._arrays = self.load(db)
+                self._loaded_at = time.monotonic()
+                self.loaded_at = datetime.utcnow()
+            return self._arrays
+        finally:
+            self._lock.release()
+
+
+analytics_snapshot = AnalyticsSnapshot()
@@ -0,0 +1,295 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Callable, List, Optional
+import aio_pika
+import sys
+sys.path.append('/app')
+from .shared.config import config
+from .shared.codec import BATCH_MESSAGE_TYPE, EncodedMessage, decode_body, encode_payload, unpack_envelope
+from .shared.rabbitmq_client import backoff_delay, failure_destination
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class AsyncEventConsumer:
+    """
+    asyncio consumer of one queue, run as a task on the application's event loop
+
+    Deliveries are buffered and processed in micro-batches like
+    RabbitMQClient.consume_batches. The database work is synchronous
+    SQLAlchemy, so batches run in a worker thread while the loop keeps
+    receiving. On stop the consumer is cancelled first, so nothing new
+    arrives, then everything already delivered is processed and acked
+    before the connection is closed.
+    """
+
+    def __init__(
+        self,
+        queue_name: str,
+        batch_callback: Callable[[List[dict]], None],
+        event_callback: Callable[[dict], None],
+        rabbitmq_url: Optional[str] = None,
+        batch_size: Optional[int] = None,
+        batch_interval_ms: Optional[int] = None,
+        prefetch_count: Optional[int] = None
+    ):
+        """
+        Initialize async consumer
+
+        Args:
+            queue_name: Name of the queue to consume from
+            batch_callback: Callback processing a list of events at once
+            event_callback: Callback processing a single event (fallback path)
+            rabbitmq_url: RabbitMQ connection URL (defaults to config value)
+            batch_size: Maximum number of events per batch
+            batch_interval_ms: Maximum time an event waits for its batch to fill
+            prefetch_count: Maximum number of unacknowledged messages delivered to this consumer
+        """
+        self.queue_name = queue_name
+        self.batch_callback = batch_callback
+        self.event_callback = event_callback
+        self.rabbitmq_url = rabbitmq_url or config.RABBITMQ_URL
+        self.batch_size = batch_size or config.CONSUMER_BATCH_SIZE
+        self.batch_interval = (batch_interval_ms or config.CONSUMER_BATCH_INTERVAL_MS) / 1000
+        self.prefetch_count = max(prefetch_count or config.CONSUMER_PREFETCH_COUNT, self.batch_size)
+
+        self.state = "created"
+        self.processed = 0
+        self.failed = 0
+        self.batches = 0
+        self.last_batch_at: Optional[datetime] = None
+        self.last_error: Optional[str] = None
+
+        self._task: Optional[asyncio.Task] = None
+        self._stopping: Optional[asyncio.Event] = None
+        self._buffer: Optional[asyncio.Queue] = None
+        self._pending = []  # (message, original encoded message, events) per delivery
+        self._pending_events = 0
+        self._opened_at = 0.0
+
+    def start(self) -> asyncio.Task:
+        """Schedule the consumer on the running event loop"""
+        self._stopping = asyncio.Event()
+        self._task = asyncio.create_task(self.run(), name=f"consumer-{self.queue_name}")
+        return self._task
+
+    async def stop(self, timeout: Optional[float] = None):
+        """
+        Stop fetching, finish and ack what was delivered, and close the connection
+
+        Args:
+            timeout: Seconds to wait for the drain before the task is cancelled
+        """
+        if self._task is None:
+            return
+        timeout = config.CONSUMER_SHUTDOWN_TIMEOUT_SECONDS if timeout is None else timeout
+        self._stopping.set()
+        try:
+            await asyncio.wait_for(asyncio.shield(self._task), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Consumer of {self.queue_name} did not drain within {timeout}s, cancelling it")
+            self._task.cancel()
+        self.state = "stopped"
+
+    def status(self) -> dict:
+        return {
+            "queue": self.queue_name,
+            "state": self.state,
+            "processed": self.processed,
+            "failed": self.failed,
+            "batches": self.batches,
+            "buffered": self._pending_events + (self._buffer.qsize() if self._buffer is not None else 0),
+            "last_batch_at": self.last_batch_at.isoformat() if self.last_batch_at else None,
+            "last_error": self.last_error,
+        }
+
+    async def run(self):
+        attempt = 0
+        while not self._stopping.is_set():
+            self.state = "connecting"
+            try:
+                connection = await aio_pika.connect(self.rabbitmq_url)
+                async with connection:
+                    channel = await connection.channel(publisher_confirms=True)
+                    await channel.set_qos(prefetch_count=self.prefetch_count)
+                    queue = await channel.declare_queue(self.queue_name, passive=True)
+
+                    self._buffer = asyncio.Queue()
+                    consumer_tag = await queue.consume(self._on_message)
+                    self.state = "consuming"
+                    attempt = 0
+                    logger.info(
+                        f"Consuming {self.queue_name} (prefetch={self.prefetch_count}, batch={self.batch_size})"
+                    )
+
+                    await self._process(channel)
+
+                    self.state = "draining"
+                    await queue.cancel(consumer_tag)
+                    await self._drain(channel)
+                self.state = "stopped"
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Unacked deliveries are redelivered after a reconnect; event IDs make that harmless
+                self._pending.clear()
+                self._pending_events = 0
+                self.last_error = f"{type(e).__name__}: {e}"
+                self.state = "reconnecting"
+                delay = backoff_delay(attempt)
+                attempt += 1
+                logger.error(f"Consumer of {self.queue_name} failed ({e}), reconnecting in {delay:.2f}s")
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+        self.state = "stopped"
+
+    async def _on_message(self, message: aio_pika.abc.AbstractIncomingMessage):
+        self._buffer.put_nowait(message)
+
+    async def _process(self, channel):
+        """Collect deliveries into batches until stop is requested"""
+        stop_wait = asyncio.ensure_future(self._stopping.wait())
+        try:
+            while not self._stopping.is_set():
+                timeout = self.batch_interval
+                if self._pending:
+                    timeout = max(0.0, self._opened_at + self.batch_interval - time.monotonic())
+                get = asyncio.ensure_future(self._buffer.get())
+                done, _ = await asyncio.wait({get, stop_wait}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if get in done:
+                    await self._add(channel, get.result())
+                else:
+                    get.cancel()
+                    if self._pending and time.monotonic() - self._opened_at >= self.batch_interval:
+                        await self._flush(channel)
+        finally:
+            stop_wait.cancel()
+
+    async def _drain(self, channel):
+        """Process and ack everything delivered before the consumer was cancelled"""
+        while not self._buffer.empty():
+            await self._add(channel, self._buffer.get_nowait())
+        await self._flush(channel)
+        logger.info(f"Drained consumer of {self.queue_name}")
+
+    async def _add(self, channel, message):
+        original = EncodedMessage(message.body, message.content_type, message.content_encoding, message.type)
+        try:
+            payload = decode_body(message.body, message.content_type, message.content_encoding)
+            events = unpack_envelope(payload, message.type)
+        except Exception as e:
+            logger.error(f"Undecodable message from {self.queue_name}: {e}")
+            # Settle the batch first: a multiple ack must not cover unprocessed messages
+            await self._flush(channel)
+            if await self._route_failure(channel, message, original, e, retryable=False):
+                await message.ack()
+            return
+
+        if not self._pending:
+            self._opened_at = time.monotonic()
+        self._pending.append((message, original, events))
+        self._pending_events += len(events)
+        if self._pending_events >= self.batch_size:
+            await self._flush(channel)
+
+    async def _flush(self, channel):
+        if not self._pending:
+            return
+        deliveries = self._pending
+        self._pending = []
+        self._pending_events = 0
+        events = [event for _, _, delivery_events in deliveries for event in delivery_events]
+
+        rejected = set()  # Delivery tags settled by a nack
+        try:
+            await asyncio.to_thread(self.batch_callback, events)
+            self.processed += len(events)
+        except Exception as e:
+            logger.warning(
+                f"Batch of {len(events)} events from {self.queue_name} failed, processing them one by one: {e}"
+            )
+            rejected = await self._process_one_by_one(channel, deliveries)
+
+        # Acking a nacked delivery raises, so the ack names the last delivery still outstanding;
+        # with multiple=True it settles every outstanding one before it as well
+        outstanding = [message for message, _, _ in deliveries if message.delivery_tag not in rejected]
+        if outstanding:
+            await outstanding[-1].ack(multiple=True)
+        self.batches += 1
+        self.last_batch_at = datetime.utcnow()
+
+    async def _process_one_by_one(self, channel, deliveries) -> set:
+        """Process a failed batch event by event; returns the delivery tags that had to be rejected"""
+        rejected = set()
+        for message, original, events in deliveries:
+            for event in events:
+                try:
+                    await asyncio.to_thread(self.event_callback, event)
+                    self.processed += 1
+                except Exception as e:
+                    self.failed += 1
+                    logger.error(f"Error processing message: {e}")
+                    # Events of an envelope are retried one by one, as plain messages
+                    failed = original if len(events) == 1 and message.type != BATCH_MESSAGE_TYPE else (
+                        encode_payload(event, message.content_type)
+                    )
+                    if not await self._route_failure(channel, message, failed, e, retryable=True):
+                        rejected.add(message.delivery_tag)
+                        break
+        return rejected
+
+    async def _route_failure(
+        self,
+        channel,
+        message,
+        encoded: EncodedMessage,
+        error: Exception,
+        retryable: bool
+    ) -> bool:
+        """Move a failed event to its retry tier or the DLQ; returns False if the delivery had to be rejected"""
+        target, headers = failure_destination(
+            self.queue_name, message.exchange, message.routing_key, message.headers, error, retryable
+        )
+        try:
+            # Confirmed publish: the original is only acked once its copy is safe
+            await channel.default_exchange.publish(
+                aio_pika.Message(
+                    body=encoded.body,
+                    headers=headers,
+                    content_type=encoded.content_type,
+                    content_encoding=encoded.content_encoding,
+                    type=encoded.message_type,
+                    delivery_mode=aio_pika.DeliveryMode.PERSISTENT
+                ),
+                routing_key=target
+            )
+            logger.warning(f"Moved failed message from {self.queue_name} to {target}")
+            return True
+        except Exception as e:
+            logger.error(f"Failed to route failed message, requeueing it: {e}")
+            await message.nack(requeue=True)
+            return False
+
+
+def create_async_consumers(processor, queue_names: List[str]) -> List[AsyncEventConsumer]:
+    """
+    Async consumers for the given queues, using an EventProcessor's callbacks
+
+    Args:
+        processor: EventProcessor whose callbacks store the events
+        queue_names: Queues to consume (users/notes queues or their partitions)
+
+    Returns:
+        Consumers, not yet started
+    """
+    consumers = []
+    for queue_name in queue_names:
+        event_callback, batch_callback = processor.callbacks_for(queue_name)
+        consumers.append(AsyncEventConsumer(queue_name, batch_callback, event_callback))
+    return consumers
@@ -0,0 +1,56 @@
+import threading
+from collections import OrderedDict
+from typing import Iterable, Optional
+import sys
+sys.path.append('/app')
+from .shared.config import config
+
+
+class DedupeCache:
+    """
+    Bounded LRU set of recently processed event IDs
+
+    It only short-circuits the common case (a redelivery shortly after the
+    original); the unique event_id constraint remains the source of truth
+    for events that have fallen out of the window.
+    """
+
+    def __init__(self, capacity: Optional[int] = None):
+        """
+        Initialize dedupe cache
+
+        Args:
+            capacity: Maximum number of remembered event IDs
+        """
+        self.capacity = capacity or config.CONSUMER_DEDUPE_CACHE_SIZE
+        self._ids: "OrderedDict[str, None]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+
+    def __contains__(self, event_id: Optional[str]) -> bool:
+        if event_id is None:
+            return False
+        with self._lock:
+            if event_id in self._ids:
+                self._ids.move_to_end(event_id)
+                self.hits += 1
+                return True
+            return False
+
+    def add(self, event_ids: Iterable[Optional[str]]):
+        """Remember event IDs once their transaction has committed"""
+        with self._lock:
+            for event_id in event_ids:
+                if event_id is None:
+                    continue
+                self._ids[event_id] = None
+                self._ids.move_to_end(event_id)
+            while len(self._ids) > self.capacity:
+                self._ids.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+
+# Shared by the consumer threads of this process
+processed_events = DedupeCache()
@@ -0,0 +1,178 @@
+"""
+Inspect and replay dead-lettered analytics events
+
+Usage:
+    python -m app.dlq stats
+    python -m app.dlq list [--queue notes] [--limit 20]
+    python -m app.dlq replay [--queue notes] [--limit 100] [--event-type note.created]
+    python -m app.dlq purge --queue notes --yes
+"""
+import argparse
+import sys
+from datetime import datetime
+import pika
+sys.path.append('/app')
+from .shared.config import config
+from .shared.codec import decode_body, unpack_envelope
+from .shared.rabbitmq_client import (
+    RabbitMQClient,
+    ANALYTICS_USERS_QUEUE,
+    ANALYTICS_NOTES_QUEUE,
+    consumer_queue_names,
+    dead_letter_queue_name,
+    retry_queue_name,
+)
+
+QUEUES = {
+    "users": ANALYTICS_USERS_QUEUE,
+    "notes": ANALYTICS_NOTES_QUEUE,
+}
+
+
+def _selected_queues(name: str):
+    # Each partition queue has its own retry tiers and dead-letter queue
+    bases = list(QUEUES.values()) if name == "all" else [QUEUES[name]]
+    return [queue_name for base in bases for queue_name in consumer_queue_names(base)]
+
+
+def _message_count(client: RabbitMQClient, queue_name: str) -> int:
+    result = client.channel.queue_declare(queue=queue_name, passive=True)
+    return result.method.message_count
+
+
+def _describe(body, properties) -> str:
+    headers = properties.headers or {}
+    try:
+        events = unpack_envelope(decode_body(body, properties.content_type, properties.content_encoding), properties.type)
+        summary = "\n    ".join(
+            ", ".join(f"{key}={value}" for key, value in event.items() if key != "timestamp") for event in events
+        )
+    except Exception as e:
+        summary = f"<undecodable: {e}>"
+    return (
+        f"[retries={headers.get('x-retry-count', 0)} failed_at={headers.get('x-failed-at')} "
+        f"routing_key={headers.get('x-original-routing-key')}]\n"
+        f"    {summary}\n"
+        f"    error: {headers.get('x-last-error')}"
+    )
+
+
+def stats(client: RabbitMQClient, args):
+    for queue_name in _selected_queues(args.queue):
+        print(f"{queue_name}: {_message_count(client, queue_name)} ready")
+        for delay_ms in config.CONSUMER_RETRY_TIERS_MS:
+            retry_queue = retry_queue_name(queue_name, delay_ms)
+            print(f"  {retry_queue}: {_message_count(client, retry_queue)} waiting")
+        dlq = dead_letter_queue_name(queue_name)
+        print(f"  {dlq}: {_message_count(client, dlq)} dead-lettered")
+
+
+def list_messages(client: RabbitMQClient, args):
+    for queue_name in _selected_queues(args.queue):
+        dlq = dead_letter_queue_name(queue_name)
+        print(f"== {dlq}")
+        # Messages are fetched without acking; closing the connection returns them to the queue
+        for _ in range(args.limit):
+            method, properties, body = client.channel.basic_get(queue=dlq, auto_ack=False)
+            if method is None:
+                break
+            print(f"  #{method.delivery_tag} {_describe(body, properties)}")
+
+
+def replay(client: RabbitMQClient, args):
+    client.channel.confirm_delivery()
+    for queue_name in _selected_queues(args.queue):
+        dlq = dead_letter_queue_name(queue_name)
+        replayed = 0
+        skipped = []
+
+        while args.limit is None or replayed < args.limit:
+            method, properties, body = client.channel.basic_get(queue=dlq, auto_ack=False)
+            if method is None:
+                break
+
+            if args.event_type:
+                try:
+                    events = unpack_envelope(
+                        decode_body(body, properties.content_type, properties.content_encoding), properties.type
+                    )
+                    event_types = {event.get("event_type") for event in events}
+                except Exception:
+                    event_types = set()
+                if args.event_type not in event_types:
+                    skipped.append(method.delivery_tag)
+                    continue
+
+            headers = {
+                key: value for key, value in (properties.headers or {}).items()
+                if key not in ("x-retry-count", "x-last-error", "x-failed-at")
+            }
+            headers["x-replayed-at"] = datetime.utcnow().isoformat()
+
+            client.channel.basic_publish(
+                exchange="",
+                routing_key=queue_name,
+                body=body,
+                properties=pika.BasicProperties(
+                    delivery_mode=2,
+                    content_type=properties.content_type,
+                    content_encoding=properties.content_encoding,
+                    type=properties.type,  # Batch envelopes must stay envelopes
+                    headers=headers
+                )
+            )
+            client.channel.basic_ack(delivery_tag=method.delivery_tag)
+            replayed += 1
+
+        for delivery_tag in skipped:
+            client.channel.basic_nack(delivery_tag=delivery_tag, requeue=True)
+
+        print(f"{dlq}: replayed {replayed} events to {queue_name}, left {len(skipped)} in place")
+
+
+def purge(client: RabbitMQClient, args):
+    if not args.yes:
+        print("Refusing to purge without --yes")
+        sys.exit(1)
+    for queue_name in _selected_queues(args.queue):
+        dlq = dead_letter_queue_name(queue_name)
+        result = client.channel.queue_purge(queue=dlq)
+        print(f"{dlq}: purged {result.method.message_count} events")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect and replay dead-lettered analytics events")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    stats_parser = subparsers.add_parser("stats", help="Show message counts of retry and dead-letter queues")
+    stats_parser.add_argument("--queue", choices=["all", *QUEUES], default="all")
+    stats_parser.set_defaults(handler=stats)
+
+    list_parser = subparsers.add_parser("list", help="Show dead-lettered events without removing them")
+    list_parser.add_argument("--queue", choices=["all", *QUEUES], default="all")
+    list_parser.add_argument("--limit", type=int, default=20)
+    list_parser.set_defaults(handler=list_messages)
+
+    replay_parser = subparsers.add_parser("replay", help="Move dead-lettered events back to their queue")
+    replay_parser.add_argument("--queue", choices=["all", *QUEUES], default="all")
+    replay_parser.add_argument("--limit", type=int, default=None)
+    replay_parser.add_argument("--event-type", default=None)
+    replay_parser.set_defaults(handler=replay)
+
+    purge_parser = subparsers.add_parser("purge", help="Delete all dead-lettered events")
+    purge_parser.add_argument("--queue", choices=["all", *QUEUES], default="all")
+    purge_parser.add_argument("--yes", action="store_true")
+    purge_parser.set_defaults(handler=purge)
+
+    args = parser.parse_args()
+
+    client = RabbitMQClient()
+    try:
+        client.connect()
+        args.handler(client, args)
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
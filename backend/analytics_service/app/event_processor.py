@@ -1,8 +1,18 @@
 from datetime import datetime
+from typing import Dict, List
 from sqlalchemy.orm import Session
 from . import models, database
+from .active_users import active_users
+from .dedupe import processed_events
+from .leaderboard import leaderboards
+from .live_statistics import statistics_hub
+from .note_statistics import upsert_note_statistics
+from .rollups import upsert_rollups
+from .system_stats import upsert_system_counters
+from .upsert import insert_new_rows, upsert_counters
 import sys
 sys.path.append('/app')
+from .shared.config import config
 from .shared.rabbitmq_client import RabbitMQClient, USERS_EXCHANGE, NOTES_EXCHANGE, ANALYTICS_USERS_QUEUE, ANALYTICS_NOTES_QUEUE
 import threading
 import logging
@@ -10,124 +20,223 @@ import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-class EventProcessor:
-    """Processes events from RabbitMQ and updates analytics database"""
+# Statistics counters changed by each note event type: (column, delta)
+NOTE_EVENT_DELTAS = {
+    "note.created": (("total_notes", 1), ("total_notes_created", 1)),
+    "note.updated": (("total_notes_updated", 1),),
+    "note.deleted": (("total_notes", -1), ("total_notes_deleted", 1)),
+}
 
-    def __init__(self):
-        self.rabbitmq_client = RabbitMQClient()
+STATISTICS_COUNTERS = (
+    "total_notes", "total_notes_created", "total_notes_updated", "total_notes_deleted", "total_logins"
+)
 
-    def process_user_event(self, event_data: dict):
-        """Process user-related events"""
-        db = database.SessionLocal()
-        try:
-            event_type = event_data.get("event_type")
-            user_id = event_data.get("user_id")
-            username = event_data.get("username")
-            email = event_data.get("email")
-            timestamp = datetime.fromisoformat(event_data.get("timestamp").replace("Z", "+00:00"))
-
-            # Store event
-            user_event = models.UserEvent(
-                event_type=event_type,
-                user_id=user_id,
-                username=username,
-                email=email,
-                timestamp=timestamp
-            )
-            db.add(user_event)
 
-            # Update user statistics
-            user_stats = db.query(models.UserStatistics).filter(
-                models.UserStatistics.user_id == user_id
-            ).first()
+def parse_timestamp(value: str) -> datetime:
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
 
-            if not user_stats:
-                user_stats = models.UserStatistics(
-                    user_id=user_id,
-                    registered_at=timestamp if event_type == "user.registered" else None
-                )
-                db.add(user_stats)
 
-            # Update statistics based on event type
-            if event_type == "user.registered":
-                user_stats.registered_at = timestamp
+def new_delta() -> dict:
+    delta = {column: 0 for column in STATISTICS_COUNTERS}
+    delta.update(last_activity=None, last_login=None, registered_at=None)
+    return delta
 
-            elif event_type == "user.logged_in":
-                user_stats.total_logins += 1
-                user_stats.last_login = timestamp
 
-            user_stats.last_activity = timestamp
+def _latest(current: datetime, timestamp: datetime) -> datetime:
+    return timestamp if current is None or timestamp > current else current
+
+
+def fold_event(delta: dict, row: dict):
+    """
+    Add one stored event's effect to its user's statistics delta
+
+    Timestamps keep the latest value, so events can be folded in any order.
+
+    Args:
+        delta: Delta from new_delta, updated in place
+        row: Event row with event_type and timestamp
+    """
+    event_type, timestamp = row["event_type"], row["timestamp"]
+    for column, change in NOTE_EVENT_DELTAS.get(event_type, ()):
+        delta[column] += change
+    if event_type == "user.registered":
+        delta["registered_at"] = _latest(delta["registered_at"], timestamp)
+    elif event_type == "user.logged_in":
+        delta["total_logins"] += 1
+        delta["last_login"] = _latest(delta["last_login"], timestamp)
+    delta["last_activity"] = _latest(delta["last_activity"], timestamp)
 
-            db.commit()
-            logger.info(f"Processed user event: {event_type} for user {user_id}")
 
+def upsert_statistics(db: Session, deltas: Dict[int, dict]):
+    """
+    Apply per-user statistic deltas atomically (see upsert_counters)
+
+    Args:
+        db: Database session (committed by the caller)
+        deltas: Counter deltas and latest timestamps by user ID
+    """
+    upsert_counters(
+        db,
+        models.UserStatistics.__table__,
+        [{"user_id": user_id, **delta} for user_id, delta in deltas.items()],
+        key_columns=("user_id",),
+        counters=STATISTICS_COUNTERS,
+        keep_latest=("last_activity", "last_login", "registered_at")
+    )
+
+
+class EventProcessor:
+    """Processes events from RabbitMQ and updates analytics database"""
+
+    def __init__(self):
+        self.rabbitmq_client = RabbitMQClient()
+
+    def process_user_event(self, event_data: dict):
+        """Process user-related events"""
+        try:
+            self.process_user_events([event_data])
         except Exception as e:
             logger.error(f"Error processing user event: {e}")
-            db.rollback()
-        finally:
-            db.close()
+            # Let the consumer route the event to a retry tier instead of dropping it
+            raise
 
     def process_note_event(self, event_data: dict):
         """Process note-related events"""
-        db = database.SessionLocal()
         try:
-            event_type = event_data.get("event_type")
-            note_id = event_data.get("note_id")
-            user_id = event_data.get("user_id")
-            title = event_data.get("title")
-            timestamp = datetime.fromisoformat(event_data.get("timestamp").replace("Z", "+00:00"))
-
-            # Store event
-            note_event = models.NoteEvent(
-                event_type=event_type,
-                note_id=note_id,
-                user_id=user_id,
-                title=title,
-                timestamp=timestamp
-            )
-            db.add(note_event)
+            self.process_note_events([event_data])
+        except Exception as e:
+            logger.error(f"Error processing note event: {e}")
+            # Let the consumer route the event to a retry tier instead of dropping it
+            raise
 
-            # Update user statistics
-            user_stats = db.query(models.UserStatistics).filter(
-                models.UserStatistics.user_id == user_id
-            ).first()
+    def process_user_events(self, events: List[dict]):
+        """Process a batch of user events in one transaction"""
+        rows = [
+            {
+                "event_id": event_data.get("event_id"),
+                "event_type": event_data.get("event_type"),
+                "user_id": event_data.get("user_id"),
+                "username": event_data.get("username"),
+                "email": event_data.get("email"),
+                "timestamp": parse_timestamp(event_data.get("timestamp")),
+            }
+            for event_data in events
+        ]
 
-            if not user_stats:
-                user_stats = models.UserStatistics(user_id=user_id)
-                db.add(user_stats)
+        stored = self._store_events(models.UserEvent.__table__, rows)
+        logger.info(f"Processed {stored} of {len(events)} user events")
 
-            # Update statistics based on event type
-            if event_type == "note.created":
-                user_stats.total_notes += 1
-                user_stats.total_notes_created += 1
+    def process_note_events(self, events: List[dict]):
+        """Process a batch of note events in one transaction"""
+        rows = [
+            {
+                "event_id": event_data.get("event_id"),
+                "event_type": event_data.get("event_type"),
+                "note_id": event_data.get("note_id"),
+                "user_id": event_data.get("user_id"),
+                "title": event_data.get("title"),
+                "timestamp": parse_timestamp(event_data.get("timestamp")),
+            }
+            for event_data in events
+        ]
 
-            elif event_type == "note.updated":
-                user_stats.total_notes_updated += 1
+        stored = self._store_events(models.NoteEvent.__table__, rows)
+        logger.info(f"Processed {stored} of {len(events)} note events")
 
-            elif event_type == "note.deleted":
-                user_stats.total_notes -= 1
-                user_stats.total_notes_deleted += 1
+    def _store_events(self, table, rows: List[dict]) -> int:
+        """
+        Store new events and update statistics, system totals, rollups,
+        per-note statistics and active user sketches in one transaction
 
-            user_stats.last_activity = timestamp
+        Events already processed are skipped: recently seen IDs are dropped
+        by the dedupe cache without a query, older ones by the unique
+        event_id constraint (ON CONFLICT DO NOTHING), so redeliveries and
+        replays never count twice.
 
-            db.commit()
-            logger.info(f"Processed note event: {event_type} for note {note_id}")
+        Args:
+            table: Event table
+            rows: Event rows in delivery order
 
-        except Exception as e:
-            logger.error(f"Error processing note event: {e}")
+        Returns:
+            Number of events stored
+        """
+        fresh, batch_ids = [], set()
+        for row in rows:
+            event_id = row["event_id"]
+            if event_id in processed_events or (event_id is not None and event_id in batch_ids):
+                continue
+            batch_ids.add(event_id)
+            fresh.append(row)
+        if not fresh:
+            return 0
+
+        db = database.SessionLocal()
+        try:
+            inserted = insert_new_rows(db, table, fresh)
+            deltas: Dict[int, dict] = {}
+            stored = []
+            for row in fresh:
+                if row["event_id"] is not None and row["event_id"] not in inserted:
+                    continue
+                fold_event(deltas.setdefault(row["user_id"], new_delta()), row)
+                stored.append(row)
+
+            upsert_system_counters(db, deltas)
+            upsert_statistics(db, deltas)
+            upsert_rollups(db, stored)
+            if table.name == models.NoteEvent.__tablename__:
+                upsert_note_statistics(db, stored)
+            sketches = active_users.record(db, stored)
+            db.commit()
+        except Exception:
             db.rollback()
+            raise
         finally:
             db.close()
 
+        processed_events.add(batch_ids)
+        active_users.remember(sketches)
+        statistics_hub.notify(deltas)
+        leaderboards.record(stored)
+        return len(stored)
+
+    def _consume(self, queue_name: str, event_callback, batch_callback):
+        if config.CONSUMER_BATCH_SIZE > 1:
+            self.rabbitmq_client.consume_batches(
+                queue_name=queue_name,
+                batch_callback=batch_callback,
+                event_callback=event_callback,
+                retry=True
+            )
+        else:
+            self.rabbitmq_client.consume(queue_name=queue_name, callback=event_callback, retry=True)
+
+    def callbacks_for(self, queue_name: str):
+        """Single-event and batch callbacks for a users or notes queue, or one of its partitions"""
+        if queue_name.startswith(ANALYTICS_USERS_QUEUE):
+            return self.process_user_event, self.process_user_events
+        return self.process_note_event, self.process_note_events
+
+    def start_consuming_queue(self, queue_name: str):
+        """Start consuming a users or notes queue, or one of its partitions"""
+        event_callback, batch_callback = self.callbacks_for(queue_name)
+        logger.info(f"Starting to consume {queue_name}...")
+        try:
+            self.rabbitmq_client.connect()
+            self._consume(queue_name, event_callback, batch_callback)
+        except KeyboardInterrupt:
+            logger.info(f"Stopped consuming {queue_name}")
+        except Exception as e:
+            logger.error(f"Error consuming {queue_name}: {e}")
+        finally:
+            self.rabbitmq_client.close()
+
     def start_consuming_users(self):
         """Start consuming user events"""
         logger.info("Starting to consume user events...")
         try:
             self.rabbitmq_client.connect()
-            self.rabbitmq_client.consume(
-                queue_name=ANALYTICS_USERS_QUEUE,
-                callback=self.process_user_event
-            )
+            self._consume(ANALYTICS_USERS_QUEUE, self.process_user_event, self.process_user_events)
         except KeyboardInterrupt:
             logger.info("Stopped consuming user events")
         except Exception as e:
@@ -140,10 +249,7 @@ class EventProcessor:
         logger.info("Starting to consume note events...")
         try:
             self.rabbitmq_client.connect()
-            self.rabbitmq_client.consume(
-                queue_name=ANALYTICS_NOTES_QUEUE,
-                callback=self.process_note_event
-            )
+            self._consume(ANALYTICS_NOTES_QUEUE, self.process_note_event, self.process_note_events)
         except KeyboardInterrupt:
             logger.info("Stopped consuming note events")
         except Exception as e:
@@ -0,0 +1,433 @@
+"""
+Top-K leaderboards maintained during event ingestion
+
+Each leaderboard (most active users, most edited notes, ...) counts
+events per key in a count-min sketch and keeps the CANDIDATES keys with
+the largest estimates next to it, so answering never sorts all users or
+events. Time windows (last 24 hours, last 7 days) are made of slices that
+expire as a whole: a window is the sum of its live slices, kept as a
+running total, and may include up to one slice more than its length.
+
+Sketches of the same shape add up, which is what makes the leaderboards
+work across processes: every ingesting process checkpoints its own
+counts to leaderboard_checkpoints, and the API merges all checkpoints
+(plus its own live counts) into the served top lists, refreshed at most
+every VIEW_REFRESH_SECONDS.
+
+Counts are estimates: never below the true count, and above it by at
+most e / SKETCH_WIDTH of the window's events with probability
+1 - e**-SKETCH_DEPTH (98%).
+"""
+import io
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+import numpy as np
+from sqlalchemy import case, func, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from . import models, database
+from .rollups import to_utc_naive
+import sys
+sys.path.append('/app')
+from .shared.config import config
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SKETCH_WIDTH_BITS = 10
+SKETCH_WIDTH = 1 << SKETCH_WIDTH_BITS
+SKETCH_DEPTH = 4
+
+# Largest k served, and keys tracked per leaderboard to answer it
+K_MAX = 100
+CANDIDATES = 2 * K_MAX
+
+# Leaderboards: (counted key, event types counted; None counts every event)
+LEADERBOARDS = {
+    "events": ("user_id", None),
+    "notes_created": ("user_id", ("note.created",)),
+    "notes_updated": ("user_id", ("note.updated",)),
+    "logins": ("user_id", ("user.logged_in",)),
+    "note_edits": ("note_id", ("note.updated",)),
+}
+
+# Windows: (length, slice length); "all" counts every event ever recorded
+WINDOWS = {
+    "all": None,
+    "24h": (timedelta(hours=24), timedelta(hours=1)),
+    "7d": (timedelta(days=7), timedelta(hours=12)),
+}
+
+# How stale the served top lists may be
+VIEW_REFRESH_SECONDS = 1.0
+
+# Odd multipliers of the multiply-shift hash of each sketch row; fixed, so sketches of all processes add up
+_MULTIPLIERS = np.random.default_rng(4049).integers(1, 2 ** 63, SKETCH_DEPTH, dtype=np.uint64) | np.uint64(1)
+_ROWS = np.arange(SKETCH_DEPTH)[:, None]
+
+
+def epoch_seconds(timestamps: Iterable[datetime]) -> np.ndarray:
+    return np.array([to_utc_naive(timestamp) for timestamp in timestamps], dtype="datetime64[s]").astype(np.int64)
+
+
+class CountMinSketch:
+    """SKETCH_DEPTH rows of SKETCH_WIDTH counters; a key's estimate is its smallest counter"""
+
+    def __init__(self, table: Optional[np.ndarray] = None):
+        self.table = np.zeros((SKETCH_DEPTH, SKETCH_WIDTH), dtype=np.int64) if table is None else table
+
+    @staticmethod
+    def columns(keys: np.ndarray) -> np.ndarray:
+        # Multiplication wraps modulo 2**64; the top bits are the column
+        hashed = keys.astype(np.uint64)[None, :] * _MULTIPLIERS[:, None]
+        return (hashed >> np.uint64(64 - SKETCH_WIDTH_BITS)).astype(np.intp)
+
+    def add(self, keys: np.ndarray, counts: np.ndarray):
+        columns = self.columns(keys)
+        for row in range(SKETCH_DEPTH):
+            np.add.at(self.table[row], columns[row], counts)
+
+    def estimate(self, keys: np.ndarray) -> np.ndarray:
+        return self.table[_ROWS, self.columns(keys)].min(axis=0)
+
+
+class TopK:
+    """Counts per key over one window, and the keys with the largest counts"""
+
+    def __init__(self, window: Optional[Tuple[timedelta, timedelta]] = None):
+        self.length, self.step = (
+            (int(window[0].total_seconds()), int(window[1].total_seconds())) if window else (None, None)
+        )
+        self.slices: Dict[int, CountMinSketch] = {}  # slice start (epoch seconds) -> counts
+        self.total = CountMinSketch()
+        self.candidates: Dict[int, int] = {}
+
+    def add(self, keys: np.ndarray, counts: np.ndarray, times: np.ndarray, now: int):
+        """Add counts of keys at times (epoch seconds); counts outside the window are ignored"""
+        if self.length is not None:
+            self.expire(now)
+            starts = times - times % self.step
+            live = starts + self.step > now - self.length
+            keys, counts, starts = keys[live], counts[live], starts[live]
+            for start in np.unique(starts):
+                in_slice = starts == start
+                self.slices.setdefault(int(start), CountMinSketch()).add(keys[in_slice], counts[in_slice])
+        if not len(keys):
+            return
+        self.total.add(keys, counts)
+        self._select(np.unique(keys))
+
+    def _select(self, keys: np.ndarray):
+        """Re-estimate the candidates and keys, keeping the CANDIDATES largest"""
+        keys = np.union1d(keys, np.fromiter(self.candidates, dtype=np.int64, count=len(self.candidates)))
+        estimates = self.total.estimate(keys)
+        if len(keys) > CANDIDATES:
+            largest = np.argpartition(-estimates, CANDIDATES)[:CANDIDATES]
+            keys, estimates = keys[largest], estimates[largest]
+        self.candidates = {key: count for key, count in zip(keys.tolist(), estimates.tolist()) if count > 0}
+
+    def expire(self, now: int):
+        """Drop slices that ended before the window start"""
+        if self.length is None:
+            return
+        expired = [start for start in self.slices if start + self.step <= now - self.length]
+        for start in expired:
+            self.total.table -= self.slices.pop(start).table
+        if expired:
+            self._select(np.empty(0, dtype=np.int64))
+
+
+class Leaderboards:
+    """All leaderboards of one process, fed with the events it stores"""
+
+    def __init__(self, owner: str = "main"):
+        self.owner = owner
+        self.active = False  # recording events and checkpointing them
+        self.boards: Dict[Tuple[str, str], TopK] = {
+            (name, window): TopK(WINDOWS[window]) for name in LEADERBOARDS for window in WINDOWS
+        }
+        self.changed = False
+        self._lock = threading.Lock()
+
+    def add(self, name: str, keys: np.ndarray, counts: np.ndarray, times: np.ndarray, windows: Iterable[str] = WINDOWS):
+        now = int(time.time())
+        with self._lock:
+            for window in windows:
+                self.boards[(name, window)].add(keys, counts, times, now)
+            self.changed = True
+
+    def record(self, rows: List[dict]):
+        """Count stored event rows (after they were committed)"""
+        if not self.active or not rows:
+            return
+        event_types = np.array([row["event_type"] for row in rows])
+        times = epoch_seconds(row["timestamp"] for row in rows)
+        for name, (key, counted_types) in LEADERBOARDS.items():
+            if key not in rows[0]:
+                continue
+            selected = np.ones(len(rows), dtype=bool) if counted_types is None else np.isin(event_types, counted_types)
+            if not selected.any():
+                continue
+            keys = np.array([row[key] for row in rows], dtype=np.int64)[selected]
+            self.add(name, keys, np.ones(len(keys), dtype=np.int64), times[selected])
+
+    def to_bytes(self) -> bytes:
+        with self._lock:
+            arrays = {}
+            for (name, window), board in self.boards.items():
+                prefix = f"{name}.{window}"
+                starts = sorted(board.slices)
+                arrays[f"{prefix}.starts"] = np.array(starts, dtype=np.int64)
+                arrays[f"{prefix}.slices"] = np.array(
+                    [board.slices[start].table for start in starts], dtype=np.int64
+                ).reshape(len(starts), SKETCH_DEPTH, SKETCH_WIDTH)
+                arrays[f"{prefix}.total"] = board.total.table.copy()
+                arrays[f"{prefix}.candidates"] = np.fromiter(board.candidates, dtype=np.int64, count=len(board.candidates))
+            self.changed = False
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **arrays)
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data: bytes, owner: str) -> "Leaderboards":
+        leaderboards = cls(owner)
+        arrays = np.load(io.BytesIO(data), allow_pickle=False)
+        now = int(time.time())
+        for (name, window), board in leaderboards.boards.items():
+            prefix = f"{name}.{window}"
+            if f"{prefix}.total" not in arrays:
+                continue  # Leaderboard added after the checkpoint was written
+            board.total = CountMinSketch(arrays[f"{prefix}.total"])
+            board.slices = {
+                int(start): CountMinSketch(table)
+                for start, table in zip(arrays[f"{prefix}.starts"], arrays[f"{prefix}.slices"])
+            }
+            board.candidates = dict.fromkeys(arrays[f"{prefix}.candidates"].tolist(), 0)
+            board.expire(now)
+            board._select(np.empty(0, dtype=np.int64))
+        return leaderboards
+
+    def restore(self, db: Session):
+        """Continue from this owner's last checkpoint"""
+        row = db.get(models.LeaderboardCheckpoint, self.owner)
+        if row is None:
+            return
+        restored = Leaderboards.from_bytes(row.data, self.owner)
+        with self._lock:
+            self.boards = restored.boards
+
+    def checkpoint(self, db: Session):
+        if not self.changed:
+            return
+        db.merge(models.LeaderboardCheckpoint(owner=self.owner, data=self.to_bytes(), updated_at=datetime.utcnow()))
+        db.commit()
+
+
+leaderboards = Leaderboards()
+
+
+def merge_top(boards: List[TopK], k: int = K_MAX) -> Tuple[List[Tuple[int, int]], int]:
+    """
+    Top keys of the sum of several boards of one leaderboard and window
+
+    Returns:
+        ([(key, count)] largest first, number of events counted)
+    """
+    total = CountMinSketch(sum(board.total.table for board in boards))
+    keys = np.array(sorted({key for board in boards for key in board.candidates}), dtype=np.int64)
+    if not len(keys):
+        return [], int(total.table[0].sum())
+    estimates = total.estimate(keys)
+    order = np.lexsort((keys, -estimates))[:k]
+    return list(zip(keys[order].tolist(), estimates[order].tolist())), int(total.table[0].sum())
+
+
+class LeaderboardView:
+    """
+    Served top lists: this process's live counts merged with the other processes' checkpoints
+
+    Like the system statistics snapshot, at most one refresh runs at a time
+    and other requests keep the previous lists meanwhile, so a request is a
+    dictionary lookup and a slice.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._others: List[Leaderboards] = []
+        self._others_loaded_at = 0.0
+        self._top: Optional[Dict[Tuple[str, str], Tuple[List[Tuple[int, int]], int]]] = None
+        self._refreshed_at = 0.0
+        self.as_of: Optional[datetime] = None
+
+    def _load_others(self, db: Session):
+        query = select(models.LeaderboardCheckpoint)
+        if leaderboards.active:
+            query = query.where(models.LeaderboardCheckpoint.owner != leaderboards.owner)
+        self._others = [Leaderboards.from_bytes(row.data, row.owner) for row in db.scalars(query)]
+        self._others_loaded_at = time.monotonic()
+
+    def _refresh(self, db: Session):
+        if time.monotonic() - self._others_loaded_at >= config.LEADERBOARD_CHECKPOINT_SECONDS:
+            self._load_others(db)
+        now = int(time.time())
+        top = {}
+        with leaderboards._lock:
+            for key, board in leaderboards.boards.items():
+                board.expire(now)
+                sources = [board] + [other.boards[key] for other in self._others]
+                for source in sources[1:]:
+                    source.expire(now)
+                top[key] = merge_top(sources)
+        self._top = top
+        self._refreshed_at = time.monotonic()
+        self.as_of = datetime.utcnow()
+
+    def top(self, db: Session, name: str, window: str, k: int) -> Tuple[List[Tuple[int, int]], int]:
+        """
+        The k keys with the most events of a leaderboard in a window
+
+        Returns:
+            ([(key, count)] largest first, number of events counted in the window)
+        """
+        if self._top is None or time.monotonic() - self._refreshed_at >= VIEW_REFRESH_SECONDS:
+            if self._lock.acquire(blocking=self._top is None):
+                try:
+                    if self._top is None or time.monotonic() - self._refreshed_at >= VIEW_REFRESH_SECONDS:
+                        self._refresh(db)
+                finally:
+                    self._lock.release()
+        entries, events = self._top[(name, window)]
+        return entries[:k], events
+
+
+leaderboard_view = LeaderboardView()
+
+
+# ============================================
+# CHECKPOINTS
+# ============================================
+
+_checkpoint_stop = threading.Event()
+
+
+def _run_checkpoints(interval_seconds: float):
+    while not _checkpoint_stop.wait(interval_seconds):
+        try:
+            with Session(database.engine) as db:
+                leaderboards.checkpoint(db)
+        except Exception as e:
+            logger.error(f"Leaderboard checkpoint failed: {e}")
+
+
+def checkpoint_owner(process: str) -> str:
+    """Checkpoint row of a process of this replica: unique across replicas, stable across restarts"""
+    return f"{config.REPLICA_ID}/{process}"
+
+
+def start_leaderboard_checkpoints(process: str = "main", interval_seconds: Optional[float] = None) -> threading.Thread:
+    """
+    Record stored events in this process's leaderboards and checkpoint them periodically
+
+    Starts from the owner's previous checkpoint, so counts survive restarts.
+
+    Args:
+        process: Name of this process within the replica ("main" or "worker-<index>")
+        interval_seconds: Time between checkpoints (defaults to LEADERBOARD_CHECKPOINT_SECONDS)
+
+    Returns:
+        The checkpoint thread
+    """
+    owner = leaderboards.owner = checkpoint_owner(process)
+    try:
+        with Session(database.engine) as db:
+            leaderboards.restore(db)
+    except Exception as e:
+        logger.error(f"Failed to restore leaderboards of {owner}: {e}")
+    leaderboards.active = True
+
+    _checkpoint_stop.clear()
+    thread = threading.Thread(
+        target=_run_checkpoints,
+        args=(interval_seconds or config.LEADERBOARD_CHECKPOINT_SECONDS,),
+        daemon=True,
+        name="leaderboard-checkpoints"
+    )
+    thread.start()
+    return thread
+
+
+def stop_leaderboard_checkpoints():
+    """Stop the checkpoint thread and write a last checkpoint"""
+    _checkpoint_stop.set()
+    if leaderboards.active:
+        with Session(database.engine) as db:
+            leaderboards.checkpoint(db)
+
+
+def backfill_leaderboards(engine: Engine, batch_size: int = 10000):
+    """
+    Seed the leaderboards from existing data when there are no checkpoints yet
+
+    All-time counts come from user_statistics, windowed ones from the
+    hourly rollups, note edits from note_events. The result is stored as
+    the "backfill" checkpoint, which is merged like any other and whose
+    windows expire as time passes.
+
+    Args:
+        engine: Analytics database engine
+        batch_size: Rows read per round trip
+    """
+    with Session(engine) as db:
+        if db.scalar(select(func.count()).select_from(models.LeaderboardCheckpoint)):
+            return
+
+        seeded = Leaderboards("backfill")
+        statistics = models.UserStatistics
+        totals = {
+            "notes_created": statistics.total_notes_created,
+            "notes_updated": statistics.total_notes_updated,
+            "logins": statistics.total_logins,
+            "events": (
+                statistics.total_notes_created + statistics.total_notes_updated + statistics.total_notes_deleted
+                + statistics.total_logins + case((statistics.registered_at.is_not(None), 1), else_=0)
+            ),
+        }
+        query = select(statistics.user_id, *totals.values()).execution_options(yield_per=batch_size)
+        for partition in db.execute(query).partitions():
+            columns = np.array(partition, dtype=np.int64).reshape(len(partition), len(totals) + 1)
+            for index, name in enumerate(totals, start=1):
+                seeded.add(name, columns[:, 0], columns[:, index], np.zeros(len(partition), dtype=np.int64), ["all"])
+
+        oldest = datetime.utcnow() - max(window[0] + window[1] for window in WINDOWS.values() if window)
+        rollups = models.UserEventRollup
+        windows = [window for window in WINDOWS if WINDOWS[window]]
+        query = select(rollups.user_id, rollups.bucket_start, rollups.event_type, rollups.event_count).where(
+            rollups.granularity == "hour",
+            rollups.bucket_start >= oldest
+        ).execution_options(yield_per=batch_size)
+        for partition in db.execute(query).partitions():
+            keys = np.array([row.user_id for row in partition], dtype=np.int64)
+            counts = np.array([row.event_count for row in partition], dtype=np.int64)
+            times = epoch_seconds(row.bucket_start for row in partition)
+            event_types = np.array([row.event_type for row in partition])
+            for name, (key, counted_types) in LEADERBOARDS.items():
+                if key != "user_id":
+                    continue
+                selected = np.ones(len(partition), dtype=bool) if counted_types is None else np.isin(event_types, counted_types)
+                seeded.add(name, keys[selected], counts[selected], times[selected], windows)
+
+        events = models.NoteEvent
+        query = select(events.note_id, events.timestamp).where(
+            events.event_type == "note.updated"
+        ).execution_options(yield_per=batch_size)
+        for partition in db.execute(query).partitions():
+            keys = np.array([row.note_id for row in partition], dtype=np.int64)
+            seeded.add("note_edits", keys, np.ones(len(keys), dtype=np.int64), epoch_seconds(row.timestamp for row in partition))
+
+        if not seeded.changed:
+            return
+        seeded.checkpoint(db)
+    logger.info("Seeded leaderboards from existing statistics and events")
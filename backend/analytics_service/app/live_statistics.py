@@ -0,0 +1,247 @@
+"""
+Live user statistics pushed to Server-Sent Events streams
+
+The event processor tells the hub which users a committed batch changed.
+The hub keeps only users with an open stream, waits a short coalescing
+window so a burst of commits becomes one update, reloads those users'
+statistics in a single query and offers the rows to each of their
+streams. Every stream has a small bounded buffer where only the latest
+row matters: when it is full the oldest row is dropped. A stream sends
+the fields that changed since its previous message (all fields first),
+and a heartbeat comment while nothing changes so proxies keep the
+connection open.
+
+When events are processed in other processes (the partitioned consumer
+pool) their commits never reach this hub, so it polls instead: one query
+per interval for all open streams, however many there are.
+"""
+import asyncio
+import json
+import logging
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Dict, Iterable, Optional, Set
+from sqlalchemy import select
+from . import models, schemas, database
+import sys
+sys.path.append('/app')
+from .shared.config import config
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Overlap between polls, so rows committed while the previous poll ran are not missed
+POLL_OVERLAP = timedelta(seconds=1)
+
+
+def statistics_snapshot(user_id: int, row: Optional[models.UserStatistics]) -> dict:
+    """JSON-ready statistics of a user (zeros before their first event)"""
+    if row is None:
+        return schemas.UserStatisticsResponse(
+            user_id=user_id,
+            total_notes=0,
+            total_notes_created=0,
+            total_notes_updated=0,
+            total_notes_deleted=0,
+            total_logins=0,
+            last_activity=None,
+            last_login=None,
+            registered_at=None
+        ).model_dump(mode="json")
+    return schemas.UserStatisticsResponse.model_validate(row).model_dump(mode="json")
+
+
+def load_snapshots(user_ids: Iterable[int], changed_since: Optional[datetime] = None) -> Dict[int, dict]:
+    """
+    Statistics of several users in one query
+
+    Args:
+        user_ids: Users to load
+        changed_since: Only users whose statistics were updated at or after this time
+
+    Returns:
+        Snapshot by user ID (users without a statistics row get zeros unless changed_since is given)
+    """
+    user_ids = list(user_ids)
+    query = select(models.UserStatistics).where(models.UserStatistics.user_id.in_(user_ids))
+    if changed_since is not None:
+        query = query.where(models.UserStatistics.updated_at >= changed_since)
+
+    db = database.SessionLocal()
+    try:
+        rows = {row.user_id: row for row in db.scalars(query)}
+        if changed_since is not None:
+            return {user_id: statistics_snapshot(user_id, row) for user_id, row in rows.items()}
+        return {user_id: statistics_snapshot(user_id, rows.get(user_id)) for user_id in user_ids}
+    finally:
+        db.close()
+
+
+def sse_message(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+class StatisticsSubscription:
+    """One open stream: a bounded buffer of statistics snapshots"""
+
+    def __init__(self, user_id: int, buffer_size: int):
+        self.user_id = user_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=buffer_size)
+        self.dropped = 0
+
+    def offer(self, snapshot: dict):
+        """Queue a snapshot; a full buffer drops its oldest one, which the newer one supersedes"""
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(snapshot)
+
+
+class StatisticsHub:
+    """
+    In-process fan-out of statistics changes to the open streams
+
+    Subscriptions are only touched on the event loop; notify() may be
+    called from any thread.
+    """
+
+    def __init__(
+        self,
+        coalesce_ms: Optional[int] = None,
+        heartbeat_seconds: Optional[float] = None,
+        buffer_size: Optional[int] = None,
+        poll_seconds: Optional[float] = None
+    ):
+        self.coalesce_seconds = (config.STREAM_COALESCE_MS if coalesce_ms is None else coalesce_ms) / 1000
+        self.heartbeat_seconds = config.STREAM_HEARTBEAT_SECONDS if heartbeat_seconds is None else heartbeat_seconds
+        self.buffer_size = buffer_size or config.STREAM_BUFFER_SIZE
+        self.poll_seconds = config.STREAM_POLL_SECONDS if poll_seconds is None else poll_seconds
+        self.polling = False
+        self._subscriptions: Dict[int, Set[StatisticsSubscription]] = defaultdict(set)
+        # Copy of the subscribed user IDs, read without a lock by notify()
+        self._subscribed: frozenset = frozenset()
+        self._changed: Set[int] = set()
+        self._changed_lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, poll: bool = False):
+        """
+        Start delivering updates (call from the running event loop)
+
+        Args:
+            poll: Also poll for changes committed by other processes
+        """
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self.polling = poll and self.poll_seconds > 0
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Statistics stream hub started ({'polling' if self.polling else 'push only'})")
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        self._loop = None
+
+    def notify(self, user_ids: Iterable[int]):
+        """Mark users whose statistics a committed batch changed (any thread)"""
+        subscribed = self._subscribed
+        if self._loop is None or not subscribed:
+            return
+        changed = [user_id for user_id in user_ids if user_id in subscribed]
+        if not changed:
+            return
+        with self._changed_lock:
+            self._changed.update(changed)
+        try:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+        except RuntimeError:
+            pass  # Event loop already closed (shutdown)
+
+    def _subscribe(self, user_id: int) -> StatisticsSubscription:
+        subscription = StatisticsSubscription(user_id, self.buffer_size)
+        self._subscriptions[user_id].add(subscription)
+        self._subscribed = frozenset(self._subscriptions)
+        return subscription
+
+    def _unsubscribe(self, subscription: StatisticsSubscription):
+        subscriptions = self._subscriptions.get(subscription.user_id)
+        if subscriptions is not None:
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self._subscriptions[subscription.user_id]
+        self._subscribed = frozenset(self._subscriptions)
+
+    async def _run(self):
+        last_poll = datetime.utcnow()
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_seconds if self.polling else None)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            # Let a burst of commits pile up into one reload
+            await asyncio.sleep(self.coalesce_seconds)
+
+            with self._changed_lock:
+                changed, self._changed = self._changed, set()
+            subscribed = set(self._subscriptions)
+            changed &= subscribed
+            try:
+                snapshots: Dict[int, dict] = {}
+                if changed:
+                    snapshots.update(await asyncio.to_thread(load_snapshots, changed))
+                if self.polling and subscribed and datetime.utcnow() - last_poll >= timedelta(seconds=self.poll_seconds):
+                    since, last_poll = last_poll - POLL_OVERLAP, datetime.utcnow()
+                    snapshots.update(await asyncio.to_thread(load_snapshots, subscribed - changed, since))
+            except Exception as e:
+                logger.error(f"Failed to load statistics for streams: {e}")
+                continue
+
+            for user_id, snapshot in snapshots.items():
+                for subscription in self._subscriptions.get(user_id, ()):
+                    subscription.offer(snapshot)
+
+    async def stream(self, user_id: int) -> AsyncIterator[str]:
+        """
+        SSE messages for one connection: the user's statistics, then changed fields as they change
+
+        Ends when the client disconnects (the response task is cancelled).
+        """
+        subscription = self._subscribe(user_id)
+        try:
+            last = (await asyncio.to_thread(load_snapshots, [user_id]))[user_id]
+            yield sse_message("statistics", last)
+            while True:
+                try:
+                    snapshot = await asyncio.wait_for(subscription.queue.get(), self.heartbeat_seconds)
+                except asyncio.TimeoutError:
+                    yield ": heartbeat\n\n"
+                    continue
+                while not subscription.queue.empty():
+                    snapshot = subscription.queue.get_nowait()
+
+                delta = {field: value for field, value in snapshot.items() if last.get(field) != value}
+                if delta:
+                    last = snapshot
+                    yield sse_message("statistics", delta)
+        finally:
+            self._unsubscribe(subscription)
+
+    def state(self) -> dict:
+        return {
+            "streams": sum(len(subscriptions) for subscriptions in self._subscriptions.values()),
+            "users": len(self._subscriptions),
+            "polling": self.polling,
+        }
+
+
+statistics_hub = StatisticsHub()
@@ -1,15 +1,33 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
+import asyncio
 import sys
 sys.path.append('/app')
 
-from . import models, database
-from .routers import analytics
+from . import models, database, migrations
+from .routers import admin, analytics
 from .event_processor import EventProcessor
-from .shared.rabbitmq_client import setup_rabbitmq_infrastructure
+from .leaderboard import start_leaderboard_checkpoints, stop_leaderboard_checkpoints
+from .live_statistics import statistics_hub
+from .async_consumer import create_async_consumers
+from .partitions import PartitionedConsumerPool
+from .retention import event_partitions, start_retention_scheduler, stop_retention_scheduler
+from .shared.config import config
+from .shared.memory_broker import MEMORY_URL_SCHEME
+from .shared.rabbitmq_client import ANALYTICS_NOTES_QUEUE, ANALYTICS_USERS_QUEUE, setup_analytics_queues
+from .shared.revocation import start_revocation_listener
 
 event_processor = EventProcessor()
+consumer_pool = PartitionedConsumerPool() if config.ANALYTICS_PARTITIONS > 1 else None
+# The in-memory broker only speaks the blocking client API, so it always uses threads
+use_async_consumers = (
+    consumer_pool is None
+    and config.CONSUMER_MODE == "asyncio"
+    and not config.RABBITMQ_URL.startswith(MEMORY_URL_SCHEME)
+)
+async_consumers = []
+consumer_threads = []
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -19,16 +37,40 @@ async def lifespan(app: FastAPI):
 
     # Create database tables
     models.Base.metadata.create_all(bind=database.engine)
+    migrations.upgrade_schema(database.engine)
+    event_partitions.setup()
 
     # Setup RabbitMQ infrastructure
     try:
-        setup_rabbitmq_infrastructure()
+        setup_analytics_queues()
     except Exception as e:
         print(f"Failed to setup RabbitMQ infrastructure: {e}")
 
-    # Start event consumers in background threads
+    # Keep the token revocation list in sync
+    start_revocation_listener()
+
+    # Create upcoming event partitions and drop expired events in the background
+    start_retention_scheduler()
+
+    # Push statistics changes to open streams; commits of consumer processes are only seen by polling
+    statistics_hub.start(poll=consumer_pool is not None and consumer_pool.use_processes)
+
+    # Leaderboards count the events stored in this process (worker processes checkpoint their own)
+    if consumer_pool is None or not consumer_pool.use_processes:
+        start_leaderboard_checkpoints()
+
+    # Start event consumers: a worker pool for partitioned queues, asyncio tasks or background threads
     try:
-        event_processor.start_all_consumers()
+        if consumer_pool is not None:
+            consumer_pool.start()
+        elif use_async_consumers:
+            async_consumers.extend(
+                create_async_consumers(event_processor, [ANALYTICS_USERS_QUEUE, ANALYTICS_NOTES_QUEUE])
+            )
+            for consumer in async_consumers:
+                consumer.start()
+        else:
+            consumer_threads.extend(event_processor.start_all_consumers())
         print("Event consumers started successfully")
     except Exception as e:
         print(f"Failed to start event consumers: {e}")
@@ -37,6 +79,14 @@ async def lifespan(app: FastAPI):
 
     # Shutdown
     print("Shutting down Analytics Service...")
+    stop_retention_scheduler()
+    await statistics_hub.stop()
+    # Finish and ack in-flight batches before the process exits
+    if consumer_pool is not None:
+        await asyncio.to_thread(consumer_pool.stop)
+    await asyncio.gather(*(consumer.stop() for consumer in async_consumers))
+    # Last checkpoint, after the consumers recorded their final batches
+    stop_leaderboard_checkpoints()
 
 app = FastAPI(
     title="Analytics Service",
@@ -52,6 +102,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 # Health check endpoint
@@ -61,7 +112,18 @@ async def root():
 
 @app.get("/health")
 async def health():
-    return {"status": "healthy"}
+    if consumer_pool is not None:
+        consumers = consumer_pool.state()
+        healthy = consumers["alive"] == consumers["workers"]
+    elif async_consumers:
+        consumers = {"mode": "asyncio", "queues": [consumer.status() for consumer in async_consumers]}
+        healthy = all(queue["state"] == "consuming" for queue in consumers["queues"])
+    else:
+        alive = sum(1 for thread in consumer_threads if thread.is_alive())
+        consumers = {"mode": "threads", "alive": alive, "threads": len(consumer_threads)}
+        healthy = alive == len(consumer_threads)
+    return {"status": "healthy" if healthy else "degraded", "consumers": consumers, "streams": statistics_hub.state()}
 
 # Include routers
 app.include_router(analytics.router, prefix="/analytics", tags=["analytics"])
+app.include_router(admin.router, prefix="/analytics/admin", tags=["admin"])
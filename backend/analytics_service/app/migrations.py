@@ -0,0 +1,82 @@
+import logging
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Engine
+from . import models
+from .active_users import backfill_active_users
+from .leaderboard import backfill_leaderboards
+from .note_statistics import backfill_note_statistics
+from .rollups import backfill_rollups
+from .system_stats import backfill_system_counters
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Columns added to existing tables after their first release: (model, column name)
+ADDED_COLUMNS = [
+    (models.NoteEvent, "event_id"),
+    (models.UserEvent, "event_id"),
+]
+
+# String columns widened after their first release: (model, column name)
+WIDENED_COLUMNS = [
+    (models.LeaderboardCheckpoint, "owner"),
+]
+
+# Indexes added to existing tables after their first release: (model, indexed column or index name)
+ADDED_INDEXES = [
+    (models.UserStatistics, "last_activity"),
+    (models.UserEventRollup, "bucket_start"),
+    (models.NoteEvent, "ix_note_events_user_timestamp_id"),
+    (models.UserEvent, "ix_user_events_user_timestamp_id"),
+]
+
+
+def upgrade_schema(engine: Engine):
+    """
+    Bring tables created by older versions up to date
+
+    `create_all` only creates missing tables, so columns added later (and
+    their indexes) are added here, columns widened later are altered, and
+    tables derived from stored events are filled in. Safe to run on every startup.
+
+    Args:
+        engine: Analytics database engine
+    """
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for model, column_name in ADDED_COLUMNS:
+            table = model.__table__
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            if column_name in existing:
+                continue
+
+            column = table.c[column_name]
+            column_type = column.type.compile(dialect=engine.dialect)
+            connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column_name} {column_type}"))
+            for index in table.indexes:
+                if column_name in index.columns:
+                    index.create(connection, checkfirst=True)
+            logger.info(f"Added column {table.name}.{column_name}")
+
+        for model, column_name in WIDENED_COLUMNS:
+            table = model.__table__
+            existing = {column["name"]: column["type"] for column in inspector.get_columns(table.name)}
+            length = getattr(existing.get(column_name), "length", None)
+            # SQLite does not enforce lengths
+            if engine.dialect.name == "sqlite" or length is None or length >= table.c[column_name].type.length:
+                continue
+
+            column_type = table.c[column_name].type.compile(dialect=engine.dialect)
+            connection.execute(text(f"ALTER TABLE {table.name} ALTER COLUMN {column_name} TYPE {column_type}"))
+            logger.info(f"Widened column {table.name}.{column_name} to {column_type}")
+
+        for model, name in ADDED_INDEXES:
+            for index in model.__table__.indexes:
+                if index.name == name or name in index.columns:
+                    index.create(connection, checkfirst=True)
+
+    backfill_rollups(engine)
+    backfill_active_users(engine)
+    backfill_system_counters(engine)
+    backfill_leaderboards(engine)
+    backfill_note_statistics(engine)
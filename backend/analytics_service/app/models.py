@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy import Column, Integer, String, DateTime, LargeBinary, Index
 from datetime import datetime
 from .database import Base
 
@@ -7,23 +7,35 @@ class NoteEvent(Base):
     __tablename__ = "note_events"
 
     id = Column(Integer, primary_key=True, index=True)
+    event_id = Column(String(32), unique=True, index=True)  # NULL for events published before IDs were assigned
     event_type = Column(String(50), nullable=False, index=True)  # note.created, note.updated, note.deleted
     note_id = Column(Integer, nullable=False, index=True)
     user_id = Column(Integer, nullable=False, index=True)
     title = Column(String(100))
     timestamp = Column(DateTime, nullable=False, default=datetime.utcnow, index=True)
 
+    __table_args__ = (
+        # A user's event history, newest first, paged by (timestamp, id)
+        Index("ix_note_events_user_timestamp_id", "user_id", timestamp.desc(), id.desc()),
+    )
+
 class UserEvent(Base):
     """Stores all user-related events"""
     __tablename__ = "user_events"
 
     id = Column(Integer, primary_key=True, index=True)
+    event_id = Column(String(32), unique=True, index=True)  # NULL for events published before IDs were assigned
     event_type = Column(String(50), nullable=False, index=True)  # user.registered, user.logged_in
     user_id = Column(Integer, nullable=False, index=True)
     username = Column(String(50), nullable=False)
     email = Column(String(100))
     timestamp = Column(DateTime, nullable=False, default=datetime.utcnow, index=True)
 
+    __table_args__ = (
+        # A user's event history, newest first, paged by (timestamp, id)
+        Index("ix_user_events_user_timestamp_id", "user_id", timestamp.desc(), id.desc()),
+    )
+
 class UserStatistics(Base):
     """Aggregated user statistics"""
     __tablename__ = "user_statistics"
@@ -34,7 +46,78 @@ class UserStatistics(Base):
     total_notes_updated = Column(Integer, default=0)
     total_notes_deleted = Column(Integer, default=0)
     total_logins = Column(Integer, default=0)
-    last_activity = Column(DateTime)
+    last_activity = Column(DateTime, index=True)
     last_login = Column(DateTime)
     registered_at = Column(DateTime)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class SystemCounters(Base):
+    """System-wide totals, split over a few rows so concurrent writers rarely touch the same one"""
+    __tablename__ = "system_counters"
+
+    shard = Column(Integer, primary_key=True)
+    total_users = Column(Integer, nullable=False, default=0)
+    total_notes_created = Column(Integer, nullable=False, default=0)
+    total_notes_updated = Column(Integer, nullable=False, default=0)
+    total_notes_deleted = Column(Integer, nullable=False, default=0)
+    total_logins = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class UserEventRollup(Base):
+    """Event counts per user, event type and hour or day, maintained during ingestion"""
+    __tablename__ = "user_event_rollups"
+
+    user_id = Column(Integer, primary_key=True)
+    granularity = Column(String(8), primary_key=True)  # hour, day
+    bucket_start = Column(DateTime, primary_key=True)
+    event_type = Column(String(50), primary_key=True)
+    event_count = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        # Distinct users per day across all users (exact active-user counts)
+        Index("ix_user_event_rollups_bucket", "granularity", "bucket_start"),
+    )
+
+class ActiveUserSketch(Base):
+    """HyperLogLog sketch (zlib-compressed registers) of the users active on a day, one row per shard"""
+    __tablename__ = "active_user_sketches"
+
+    day = Column(DateTime, primary_key=True)
+    shard = Column(Integer, primary_key=True)
+    registers = Column(LargeBinary, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class SystemEventRollup(Base):
+    """Event counts across all users per event type and hour or day"""
+    __tablename__ = "system_event_rollups"
+
+    granularity = Column(String(8), primary_key=True)  # hour, day
+    bucket_start = Column(DateTime, primary_key=True)
+    event_type = Column(String(50), primary_key=True)
+    event_count = Column(Integer, nullable=False, default=0)
+
+class LeaderboardCheckpoint(Base):
+    """Serialized leaderboard sketches of one ingesting process (see leaderboard.py)"""
+    __tablename__ = "leaderboard_checkpoints"
+
+    owner = Column(String(128), primary_key=True)  # <replica>/main, <replica>/worker-<n>, backfill
+    data = Column(LargeBinary, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class NoteStatistics(Base):
+    """Activity of one note, maintained from its events"""
+    __tablename__ = "note_statistics"
+
+    note_id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    edit_count = Column(Integer, nullable=False, default=0)
+    title = Column(String(100))  # title at the last creation or update
+    created_at = Column(DateTime)
+    last_updated_at = Column(DateTime)  # last creation or update
+    deleted_at = Column(DateTime)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        # A user's notes, most edited first
+        Index("ix_note_statistics_user_edits", "user_id", edit_count.desc(), note_id.desc()),
+    )
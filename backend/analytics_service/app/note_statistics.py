@@ -0,0 +1,148 @@
+"""
+Per-note activity statistics maintained from note events
+
+Every batch of stored note events is folded per note in memory (edit
+count, creation, last change and deletion times, title at the last
+change) and applied with one upsert per note. Timestamps keep the later
+value and the title follows the last change, so batches may arrive in any
+order. Answers about a note then come from one row instead of a scan of
+its raw events, which retention eventually deletes.
+"""
+import logging
+from datetime import datetime
+from typing import Dict, Iterable
+from sqlalchemy import Table, func, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from . import models
+from .rollups import to_utc_naive
+from .upsert import upsert_counters
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+NOTE_STATISTICS_KEEP_LATEST = ("created_at", "last_updated_at", "deleted_at")
+
+# Columns that only change together with a later timestamp column
+NOTE_STATISTICS_FOLLOW_LATEST = {"title": "last_updated_at"}
+
+# Event types that set a note's content (and so its title)
+CONTENT_EVENT_TYPES = ("note.created", "note.updated")
+
+
+def new_note_delta(user_id: int) -> dict:
+    return {
+        "user_id": user_id,
+        "edit_count": 0,
+        "title": None,
+        "created_at": None,
+        "last_updated_at": None,
+        "deleted_at": None,
+    }
+
+
+def _later(current: datetime, timestamp: datetime) -> datetime:
+    return timestamp if current is None or timestamp > current else current
+
+
+def fold_note_event(delta: dict, row: dict):
+    """
+    Add one stored note event to its note's delta
+
+    Args:
+        delta: Delta from new_note_delta, updated in place
+        row: Note event row with event_type, title and timestamp
+    """
+    event_type, timestamp = row["event_type"], to_utc_naive(row["timestamp"])
+    if event_type == "note.updated":
+        delta["edit_count"] += 1
+    elif event_type == "note.created":
+        delta["created_at"] = _later(delta["created_at"], timestamp)
+    elif event_type == "note.deleted":
+        delta["deleted_at"] = _later(delta["deleted_at"], timestamp)
+
+    if event_type in CONTENT_EVENT_TYPES and (
+        delta["last_updated_at"] is None or timestamp >= delta["last_updated_at"]
+    ):
+        delta["last_updated_at"] = timestamp
+        delta["title"] = row["title"]
+
+
+def count_note_statistics(rows: Iterable[dict]) -> Dict[int, dict]:
+    """
+    Fold note events per note
+
+    Args:
+        rows: Note event rows with note_id, user_id, event_type, title and timestamp
+
+    Returns:
+        Delta by note ID
+    """
+    deltas: Dict[int, dict] = {}
+    for row in rows:
+        delta = deltas.get(row["note_id"])
+        if delta is None:
+            delta = deltas[row["note_id"]] = new_note_delta(row["user_id"])
+        fold_note_event(delta, row)
+    return deltas
+
+
+def add_note_statistics(db: Session, deltas: Dict[int, dict], table: Table = None):
+    """
+    Apply per-note deltas from count_note_statistics (see upsert_counters)
+
+    Args:
+        db: Database session (committed by the caller)
+        deltas: Delta by note ID
+        table: Target table (default note_statistics)
+    """
+    upsert_counters(
+        db,
+        models.NoteStatistics.__table__ if table is None else table,
+        [{"note_id": note_id, **delta} for note_id, delta in deltas.items()],
+        key_columns=("note_id",),
+        counters=("edit_count",),
+        keep_latest=NOTE_STATISTICS_KEEP_LATEST,
+        follow_latest=NOTE_STATISTICS_FOLLOW_LATEST
+    )
+
+
+def upsert_note_statistics(db: Session, rows: Iterable[dict]):
+    """
+    Add stored note events to the per-note statistics
+
+    Args:
+        db: Database session (committed by the caller, with the events)
+        rows: Stored note event rows
+    """
+    add_note_statistics(db, count_note_statistics(rows))
+
+
+def backfill_note_statistics(engine: Engine, batch_size: int = 10000):
+    """
+    Build the per-note statistics from stored note events when they are still empty
+
+    Like backfill_rollups, this covers events stored before the table
+    existed; it does nothing once any row exists. Notes whose events
+    retention already deleted are not recovered.
+
+    Args:
+        engine: Analytics database engine
+        batch_size: Events read and folded per round trip
+    """
+    with Session(engine) as db:
+        if db.scalar(select(func.count()).select_from(models.NoteStatistics)):
+            return
+
+        events = models.NoteEvent
+        query = select(
+            events.note_id, events.user_id, events.event_type, events.title, events.timestamp
+        ).execution_options(yield_per=batch_size)
+        stored = 0
+        for partition in db.execute(query).partitions():
+            upsert_note_statistics(db, [row._mapping for row in partition])
+            stored += len(partition)
+        db.commit()
+
+    if stored:
+        logger.info(f"Backfilled note statistics from {stored} stored note events")
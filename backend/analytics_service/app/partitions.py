@@ -0,0 +1,210 @@
+import logging
+import multiprocessing
+import threading
+import time
+from typing import List, Optional, Tuple
+import sys
+sys.path.append('/app')
+from .shared.config import config
+from .shared.memory_broker import MEMORY_URL_SCHEME
+from .shared.rabbitmq_client import (
+    ANALYTICS_USERS_QUEUE,
+    ANALYTICS_NOTES_QUEUE,
+    backoff_delay,
+    consumer_queue_names,
+)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def assigned_queues(worker_index: int, workers: int) -> Tuple[List[str], List[str]]:
+    """
+    Queues a worker owns and queues it stands by for
+
+    Every worker subscribes to every partition queue. Partition queues are
+    single-active-consumer, so the broker delivers to whichever worker
+    subscribed first; standby subscriptions are delayed so that each
+    partition starts out on its home worker, and take over when that worker
+    goes away.
+
+    Args:
+        worker_index: Index of the worker in the pool
+        workers: Number of workers in the pool
+
+    Returns:
+        Home queues and standby queues
+    """
+    queues = consumer_queue_names(ANALYTICS_USERS_QUEUE) + consumer_queue_names(ANALYTICS_NOTES_QUEUE)
+    home = [queue for i, queue in enumerate(queues) if i % workers == worker_index]
+    standby = [queue for queue in queues if queue not in home]
+    return home, standby
+
+
+def _consume_until_stopped(queue_name: str, delay: float, stop, consumers: dict):
+    from .event_processor import EventProcessor
+
+    if stop.wait(delay):
+        return
+    attempt = 0
+    while not stop.is_set():
+        processor = consumers[queue_name] = EventProcessor()
+        started = time.monotonic()
+        processor.start_consuming_queue(queue_name)
+        # Consuming returns when stopped or when the connection is lost; reconnect with backoff
+        if time.monotonic() - started > config.RABBITMQ_RECONNECT_MAX_MS / 1000:
+            attempt = 0
+        if stop.wait(backoff_delay(attempt)):
+            return
+        attempt += 1
+
+
+def run_worker(worker_index: int, workers: int, stop=None):
+    """
+    Entry point of a worker: one consumer thread per assigned queue
+
+    Runs until `stop` (a threading or multiprocessing Event) is set, then
+    stops every consumer, which acks what it already processed, and returns
+    once they have all exited.
+    """
+    stop = stop or threading.Event()
+    home, standby = assigned_queues(worker_index, workers)
+    logger.info(f"Worker {worker_index}/{workers} owns {home}")
+    worker_process = multiprocessing.parent_process() is not None
+    if worker_process:
+        from .leaderboard import start_leaderboard_checkpoints
+
+        # Worker process: its leaderboard counts reach the API through checkpoints
+        start_leaderboard_checkpoints(f"worker-{worker_index}")
+
+    consumers = {}  # Current EventProcessor per queue
+    threads = [
+        threading.Thread(
+            target=_consume_until_stopped,
+            args=(queue_name, delay, stop, consumers),
+            name=f"consumer-{queue_name}",
+            daemon=True
+        )
+        for queues, delay in ((home, 0.0), (standby, config.ANALYTICS_STANDBY_DELAY_SECONDS))
+        for queue_name in queues
+    ]
+    for thread in threads:
+        thread.start()
+
+    stop.wait()
+    logger.info(f"Worker {worker_index}/{workers} stopping")
+    # Repeated until every consumer is gone: one may be (re)connecting when the first request is sent
+    while any(thread.is_alive() for thread in threads):
+        for processor in list(consumers.values()):
+            processor.rabbitmq_client.stop_consuming()
+        time.sleep(0.1)
+    if worker_process:
+        from .leaderboard import stop_leaderboard_checkpoints
+
+        # Counts of the batches acked above, which the next periodic checkpoint would never write
+        stop_leaderboard_checkpoints()
+    logger.info(f"Worker {worker_index}/{workers} stopped")
+
+
+class PartitionedConsumerPool:
+    """
+    Pool of workers consuming the partition queues
+
+    Workers are processes, so ingestion scales past one core; with the
+    in-memory broker (which cannot be shared between processes) they are
+    threads. A supervisor thread restarts workers that exit.
+    """
+
+    def __init__(self, workers: Optional[int] = None, use_processes: Optional[bool] = None):
+        """
+        Initialize consumer pool
+
+        Args:
+            workers: Number of workers (defaults to config value)
+            use_processes: Run workers as processes (default: unless the broker is in-memory)
+        """
+        self.workers = workers or config.ANALYTICS_WORKERS
+        if use_processes is None:
+            use_processes = not config.RABBITMQ_URL.startswith(MEMORY_URL_SCHEME)
+        self.use_processes = use_processes
+        self.restarts = 0
+        self._workers: list = [None] * self.workers
+        self._stopping = threading.Event()
+        # Shared with the workers: set on stop to make them finish their batches and exit
+        self._stop_workers = multiprocessing.get_context("spawn").Event() if use_processes else threading.Event()
+        self._supervisor = threading.Thread(target=self._supervise, name="consumer-pool", daemon=True)
+
+    def start(self):
+        for worker_index in range(self.workers):
+            self._spawn(worker_index)
+        self._supervisor.start()
+        logger.info(
+            f"Started {self.workers} consumer {'processes' if self.use_processes else 'threads'} "
+            f"for {config.ANALYTICS_PARTITIONS} partitions"
+        )
+
+    def _spawn(self, worker_index: int):
+        name = f"analytics-worker-{worker_index}"
+        if self.use_processes:
+            # spawn: workers must not inherit the parent's DB connections or broker sockets
+            context = multiprocessing.get_context("spawn")
+            worker = context.Process(
+                target=run_worker, args=(worker_index, self.workers, self._stop_workers), name=name, daemon=True
+            )
+        else:
+            worker = threading.Thread(
+                target=run_worker, args=(worker_index, self.workers, self._stop_workers), name=name, daemon=True
+            )
+        worker.start()
+        self._workers[worker_index] = worker
+
+    def _supervise(self):
+        while not self._stopping.wait(1.0):
+            for worker_index, worker in enumerate(self._workers):
+                if self._stopping.is_set():
+                    return
+                if worker is not None and not worker.is_alive():
+                    logger.warning(f"Consumer worker {worker_index} exited, restarting it")
+                    self.restarts += 1
+                    self._spawn(worker_index)
+
+    def stop(self, timeout: Optional[float] = None):
+        """
+        Stop the workers; their partitions move to standby consumers of other replicas
+
+        Workers stop consuming, process and ack what they were delivered,
+        and exit. Worker processes still running after the timeout are
+        terminated; their unacked deliveries are redelivered.
+
+        Args:
+            timeout: Seconds to wait for the workers (defaults to CONSUMER_SHUTDOWN_TIMEOUT_SECONDS)
+        """
+        timeout = config.CONSUMER_SHUTDOWN_TIMEOUT_SECONDS if timeout is None else timeout
+        self._stopping.set()
+        if self._supervisor.is_alive():
+            # No restarts from here on
+            self._supervisor.join()
+        self._stop_workers.set()
+
+        deadline = time.monotonic() + timeout
+        for worker in self._workers:
+            if worker is not None:
+                worker.join(max(0.0, deadline - time.monotonic()))
+        for worker_index, worker in enumerate(self._workers):
+            if worker is None or not worker.is_alive():
+                continue
+            if self.use_processes:
+                logger.warning(f"Consumer worker {worker_index} did not stop within {timeout}s, terminating it")
+                worker.terminate()
+                worker.join()
+            else:
+                logger.warning(f"Consumer worker {worker_index} did not stop within {timeout}s")
+
+    def state(self) -> dict:
+        return {
+            "mode": "processes" if self.use_processes else "threads",
+            "partitions": config.ANALYTICS_PARTITIONS,
+            "workers": self.workers,
+            "alive": sum(1 for worker in self._workers if worker is not None and worker.is_alive()),
+            "restarts": self.restarts,
+        }
@@ -0,0 +1,417 @@
+"""
+Rebuild analytics projections from the raw event log
+
+Recomputes user_statistics, the hourly/daily rollups, note_statistics, the
+system counters and the active-user sketches from note_events and user_events. Users are
+split into id ranges processed by a pool of worker processes, each
+streaming its events with a server-side cursor into staging tables. The
+staging tables then replace the live projections in one transaction.
+
+Retention (see retention.apply_retention) deletes raw events only after
+folding them into the rollups, so history before the first month that
+still has raw events is taken from the live projections instead: its
+rollup buckets are kept, its per-user counters are recounted from the
+daily rollups, and notes created before it keep their statistics. While
+the rebuild runs, retention is held off with the maintenance lock.
+
+Usage:
+    python -m app.rebuild [--workers 8] [--chunks 32] [--dry-run]
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import Column, MetaData, Table, delete, func, insert, or_, select, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+from . import models, database
+from .active_users import active_users, record_from_rollups
+from .event_processor import NOTE_EVENT_DELTAS, STATISTICS_COUNTERS, fold_event, new_delta
+from .note_statistics import add_note_statistics, fold_note_event, new_note_delta
+from .retention import MAINTENANCE_LOCK_ID, month_start
+from .rollups import count_rollups, to_utc_naive
+from .system_stats import SYSTEM_COUNTERS, count_registered_users
+from .upsert import upsert_counters
+sys.path.append('/app')
+from .shared.config import config
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+EVENT_MODELS = (models.NoteEvent, models.UserEvent)
+
+# Rows fetched per round trip of the server-side cursor
+STREAM_BATCH_SIZE = 20000
+
+# Rollup keys a worker accumulates before adding them to the staging table
+ROLLUP_FLUSH_KEYS = 200000
+
+STATISTICS_KEEP_LATEST = ("last_activity", "last_login", "registered_at")
+
+
+def _staging_table(table: Table) -> Table:
+    """Copy of a projection table under another name, with its primary key only (no secondary indexes)"""
+    return Table(
+        f"{table.name}_rebuild",
+        MetaData(),
+        *(Column(column.name, column.type, primary_key=column.primary_key) for column in table.columns)
+    )
+
+
+PROJECTIONS = [
+    (models.UserStatistics.__table__, _staging_table(models.UserStatistics.__table__)),
+    (models.UserEventRollup.__table__, _staging_table(models.UserEventRollup.__table__)),
+    (models.SystemEventRollup.__table__, _staging_table(models.SystemEventRollup.__table__)),
+    (models.NoteStatistics.__table__, _staging_table(models.NoteStatistics.__table__)),
+]
+STAGING = {live.name: staging for live, staging in PROJECTIONS}
+
+
+def _add_rollups(db: Session, user_counts: Counter, system_counts: Counter):
+    upsert_counters(
+        db,
+        STAGING["user_event_rollups"],
+        [
+            {"user_id": user_id, "granularity": granularity, "bucket_start": start,
+             "event_type": event_type, "event_count": count}
+            for (user_id, granularity, start, event_type), count in user_counts.items()
+        ],
+        key_columns=("user_id", "granularity", "bucket_start", "event_type"),
+        counters=("event_count",)
+    )
+    upsert_counters(
+        db,
+        STAGING["system_event_rollups"],
+        [
+            {"granularity": granularity, "bucket_start": start, "event_type": event_type, "event_count": count}
+            for (granularity, start, event_type), count in system_counts.items()
+        ],
+        key_columns=("granularity", "bucket_start", "event_type"),
+        counters=("event_count",)
+    )
+
+
+def _add_statistics(db: Session, statistics: Dict[int, dict]):
+    now = datetime.utcnow()
+    upsert_counters(
+        db,
+        STAGING["user_statistics"],
+        [{"user_id": user_id, **delta, "updated_at": now} for user_id, delta in statistics.items()],
+        key_columns=("user_id",),
+        counters=STATISTICS_COUNTERS,
+        keep_latest=STATISTICS_KEEP_LATEST
+    )
+
+
+def _fold_events(reader: Session, writer: Session, conditions: Dict[str, list], commit: bool = True) -> int:
+    """
+    Stream matching events of both tables and fold them into the staging tables
+
+    Args:
+        reader: Session streaming the events
+        writer: Session writing the staging tables
+        conditions: WHERE clauses per event table
+        commit: Commit the writer whenever accumulated rollups are written out (flush when False,
+            for a writer whose transaction must stay open)
+
+    Returns:
+        Number of events folded
+    """
+    statistics: Dict[int, dict] = {}
+    notes: Dict[int, dict] = {}
+    user_counts, system_counts = Counter(), Counter()
+    events = 0
+    for model in EVENT_MODELS:
+        note_columns = (model.note_id, model.title) if model is models.NoteEvent else ()
+        query = select(model.user_id, model.event_type, model.timestamp, *note_columns).where(
+            *conditions[model.__tablename__]
+        ).execution_options(stream_results=True, yield_per=STREAM_BATCH_SIZE)
+        for partition in reader.execute(query).partitions():
+            rows = [row._mapping for row in partition]
+            for row in rows:
+                fold_event(statistics.setdefault(row["user_id"], new_delta()), row)
+                if note_columns:
+                    note = notes.get(row["note_id"])
+                    if note is None:
+                        note = notes[row["note_id"]] = new_note_delta(row["user_id"])
+                    fold_note_event(note, row)
+            batch_user_counts, batch_system_counts = count_rollups(rows)
+            user_counts.update(batch_user_counts)
+            system_counts.update(batch_system_counts)
+            events += len(rows)
+
+            if len(user_counts) >= ROLLUP_FLUSH_KEYS:
+                _add_rollups(writer, user_counts, system_counts)
+                if commit:
+                    writer.commit()
+                else:
+                    writer.flush()
+                user_counts, system_counts = Counter(), Counter()
+
+    _add_rollups(writer, user_counts, system_counts)
+    _add_statistics(writer, statistics)
+    add_note_statistics(writer, notes, STAGING["note_statistics"])
+    return events
+
+
+def _history_boundary(db: Session) -> Optional[datetime]:
+    """Start of the first month with raw events; anything before it only survives in the projections"""
+    oldest = [db.scalar(select(func.min(model.timestamp))) for model in EVENT_MODELS]
+    oldest = [to_utc_naive(timestamp) for timestamp in oldest if timestamp is not None]
+    return month_start(min(oldest)) if oldest else None
+
+
+def _add_history(db: Session, boundary: datetime):
+    """
+    Add what the live projections know from before the boundary to the staging tables
+
+    Rollup buckets before it are copied as they are. Per-user counters are
+    recounted from the daily rollups before it, and the statistics'
+    timestamps before it (registration, last login, last activity) are
+    kept. Notes created before it keep their live statistics, which also
+    hold their later events. Writes through `db` without committing.
+
+    Args:
+        db: Database session (committed by the caller)
+        boundary: From _history_boundary
+    """
+    for name in ("user_event_rollups", "system_event_rollups"):
+        live, staging = models.Base.metadata.tables[name], STAGING[name]
+        db.execute(insert(staging).from_select(
+            [column.name for column in staging.columns],
+            select(*(live.c[column.name] for column in staging.columns)).where(live.c.bucket_start < boundary)
+        ))
+
+    rollups = models.UserEventRollup
+    counts = select(rollups.user_id, rollups.event_type, func.sum(rollups.event_count)).where(
+        rollups.granularity == "day", rollups.bucket_start < boundary
+    ).group_by(rollups.user_id, rollups.event_type).execution_options(yield_per=STREAM_BATCH_SIZE)
+    live = models.UserStatistics
+    timestamps = ("last_activity", "last_login", "registered_at")
+    latest = select(live.user_id, *(getattr(live, column) for column in timestamps)).where(
+        or_(*(getattr(live, column) < boundary for column in timestamps))
+    ).execution_options(yield_per=STREAM_BATCH_SIZE)
+
+    statistics: Dict[int, dict] = {}
+    for user_id, event_type, count in db.execute(counts):
+        delta = statistics.setdefault(user_id, new_delta())
+        for column, change in NOTE_EVENT_DELTAS.get(event_type, ()):
+            delta[column] += change * count
+        if event_type == "user.logged_in":
+            delta["total_logins"] += count
+        if len(statistics) >= ROLLUP_FLUSH_KEYS:
+            # Counters add up, so a user's history may be written in several parts
+            _add_statistics(db, statistics)
+            statistics = {}
+    for row in db.execute(latest):
+        delta = statistics.setdefault(row.user_id, new_delta())
+        for column in timestamps:
+            value = getattr(row, column)
+            if value is not None and to_utc_naive(value) < boundary:
+                delta[column] = value
+    _add_statistics(db, statistics)
+
+    notes, staging = models.NoteStatistics.__table__, STAGING["note_statistics"]
+    db.execute(delete(staging).where(
+        staging.c.note_id.in_(select(notes.c.note_id).where(notes.c.created_at < boundary))
+    ))
+    db.execute(insert(staging).from_select(
+        [column.name for column in staging.columns],
+        select(*(notes.c[column.name] for column in staging.columns)).where(
+            or_(notes.c.created_at < boundary, ~notes.c.note_id.in_(select(staging.c.note_id)))
+        )
+    ))
+
+
+@contextmanager
+def _retention_paused(engine):
+    """Keep retention from deleting events while the rebuild runs (PostgreSQL: the maintenance lock)"""
+    if engine.dialect.name != "postgresql":
+        yield
+        return
+    with engine.connect() as connection:
+        connection.execute(text("SELECT pg_advisory_lock(:id)"), {"id": MAINTENANCE_LOCK_ID})
+        connection.commit()
+        try:
+            yield
+        finally:
+            connection.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": MAINTENANCE_LOCK_ID})
+            connection.commit()
+
+
+def _rebuild_range(first_user: int, last_user: int, watermarks: Dict[str, int]) -> Tuple[int, int]:
+    """
+    Worker: fold the events of users first_user..last_user into the staging tables
+
+    Only events up to the watermark (highest id when the rebuild started)
+    are read; later ones are folded in during the swap.
+
+    Returns:
+        (users, events) processed
+    """
+    logging.getLogger().setLevel(logging.WARNING)
+    conditions = {
+        model.__tablename__: [
+            model.user_id >= first_user,
+            model.user_id <= last_user,
+            model.id <= watermarks[model.__tablename__],
+        ]
+        for model in EVENT_MODELS
+    }
+    # Separate sessions: the reader's connection holds the open server-side cursor
+    with Session(database.engine) as reader, Session(database.engine) as writer:
+        events = _fold_events(reader, writer, conditions)
+        writer.commit()
+        users = writer.scalar(
+            select(func.count()).select_from(STAGING["user_statistics"]).where(
+                STAGING["user_statistics"].c.user_id >= first_user,
+                STAGING["user_statistics"].c.user_id <= last_user
+            )
+        )
+    return users, events
+
+
+def _user_ranges(first_user: int, last_user: int, chunks: int) -> List[Tuple[int, int]]:
+    size = max(1, -(-(last_user - first_user + 1) // chunks))
+    return [(start, min(start + size - 1, last_user)) for start in range(first_user, last_user + 1, size)]
+
+
+def _lock_projections(connection: Connection):
+    """Wait for running ingestion transactions and hold new ones until the swap commits (PostgreSQL)"""
+    if connection.dialect.name != "postgresql":
+        return
+    tables = [live.name for live, _ in PROJECTIONS] + [models.SystemCounters.__tablename__]
+    connection.execute(text(f"LOCK TABLE {', '.join(tables)} IN SHARE ROW EXCLUSIVE MODE"))
+
+
+def _swap(watermarks: Dict[str, int], boundary: datetime) -> int:
+    """
+    Catch up with events stored since the rebuild started and replace the live projections
+
+    Everything happens in one transaction: readers see either the old or
+    the new projections, never a mix. Late events from before the history
+    boundary are not folded again: the history copied from the live
+    projections already holds them.
+
+    Returns:
+        Number of events folded during the catch-up
+    """
+    with Session(database.engine) as db:
+        _lock_projections(db.connection())
+        caught_up = _fold_events(db, db, {
+            model.__tablename__: [model.id > watermarks[model.__tablename__], model.timestamp >= boundary]
+            for model in EVENT_MODELS
+        }, commit=False)
+        _add_history(db, boundary)
+
+        for live, staging in PROJECTIONS:
+            db.execute(delete(live))
+            db.execute(insert(live).from_select([column.name for column in staging.columns], select(staging)))
+
+        statistics = STAGING["user_statistics"]
+        shard = (statistics.c.user_id % config.SYSTEM_COUNTER_SHARDS).label("shard")
+        db.execute(delete(models.SystemCounters))
+        db.execute(insert(models.SystemCounters).from_select(
+            ["shard", *SYSTEM_COUNTERS],
+            select(
+                shard,
+                count_registered_users(statistics.c.registered_at),
+                *(func.coalesce(func.sum(statistics.c[column]), 0) for column in SYSTEM_COUNTERS[1:])
+            ).group_by(shard)
+        ))
+
+        if active_users.mode != "exact":
+            db.execute(delete(models.ActiveUserSketch))
+            active_users.forget()
+            record_from_rollups(db)
+        db.commit()
+    return caught_up
+
+
+def _drift(db: Session) -> Dict[str, int]:
+    """Users whose live statistics differ from the rebuilt ones, and users missing from the live table"""
+    live = models.UserStatistics.__table__
+    staging = STAGING["user_statistics"]
+    columns = list(STATISTICS_COUNTERS) + ["registered_at"]
+    differing = db.scalar(
+        select(func.count()).select_from(live.join(staging, live.c.user_id == staging.c.user_id)).where(
+            or_(*(live.c[column].is_distinct_from(staging.c[column]) for column in columns))
+        )
+    )
+    missing = db.scalar(
+        select(func.count()).select_from(staging).where(~staging.c.user_id.in_(select(live.c.user_id)))
+    )
+    return {"differing": differing or 0, "missing": missing or 0}
+
+
+def rebuild(workers: int, chunks: int, dry_run: bool = False):
+    engine = database.engine
+    with _retention_paused(engine):
+        with Session(engine) as db:
+            boundary = _history_boundary(db)
+            watermarks = {
+                model.__tablename__: db.scalar(select(func.coalesce(func.max(model.id), 0))) for model in EVENT_MODELS
+            }
+            bounds = [db.execute(select(func.min(model.user_id), func.max(model.user_id))).one() for model in EVENT_MODELS]
+        if boundary is None:
+            # Retention may have compacted everything into the projections: nothing to rebuild them from
+            print("No raw events to rebuild from, leaving the projections as they are")
+            return
+
+        for _, staging in PROJECTIONS:
+            staging.drop(engine, checkfirst=True)
+            staging.create(engine)
+
+        first_users = [first for first, _ in bounds if first is not None]
+        last_users = [last for _, last in bounds if last is not None]
+        ranges = _user_ranges(min(first_users), max(last_users), chunks)
+        print(f"Rebuilding from {sum(watermarks.values())} events: {len(ranges)} user ranges, {workers} workers")
+        started = time.perf_counter()
+        users = events = 0
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+            futures = [pool.submit(_rebuild_range, first, last, watermarks) for first, last in ranges]
+            for done, future in enumerate(as_completed(futures), start=1):
+                range_users, range_events = future.result()
+                users += range_users
+                events += range_events
+                print(f"  {done}/{len(ranges)} ranges, {events} events")
+        seconds = time.perf_counter() - started
+        print(f"Folded {events} events of {users} users in {seconds:.1f}s ({events / max(seconds, 1e-9):.0f} events/s)")
+
+        if dry_run:
+            with Session(engine) as db:
+                _add_history(db, boundary)
+                db.commit()
+                drift = _drift(db)
+            print(f"Dry run: {drift['differing']} users differ, {drift['missing']} users have no statistics row")
+        else:
+            caught_up = _swap(watermarks, boundary)
+            print(
+                f"Swapped in the rebuilt projections ({caught_up} events stored during the rebuild folded in, "
+                f"history before {boundary:%Y-%m} kept)"
+            )
+
+        for _, staging in PROJECTIONS:
+            staging.drop(engine, checkfirst=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild analytics projections from the raw event log")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--chunks", type=int, default=None, help="User id ranges (default: 4 per worker)")
+    parser.add_argument("--dry-run", action="store_true", help="Report drift without replacing anything")
+    args = parser.parse_args()
+
+    rebuild(args.workers, args.chunks or args.workers * 4, dry_run=args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
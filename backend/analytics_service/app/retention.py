@@ -0,0 +1,380 @@
+import logging
+import re
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+from sqlalchemy import Table, delete, func, select, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateIndex
+from . import models, database
+from .rollups import add_rollup_counts, bucket_start, count_rollups
+import sys
+sys.path.append('/app')
+from .shared.config import config
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Raw event tables, partitioned by month on timestamp in PostgreSQL
+EVENT_MODELS = (models.NoteEvent, models.UserEvent)
+
+# Months after the current one that always have a partition
+PARTITIONS_AHEAD = 2
+
+# pg_try_advisory_lock key: one replica runs maintenance at a time
+MAINTENANCE_LOCK_ID = 4044
+
+PARTITION_SUFFIX = re.compile(r"_y(\d{4})m(\d{2})$")
+
+
+def month_start(timestamp: datetime) -> datetime:
+    return bucket_start(timestamp, "day").replace(day=1)
+
+
+def add_months(month: datetime, months: int) -> datetime:
+    index = month.year * 12 + month.month - 1 + months
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+
+def partition_name(table_name: str, month: datetime) -> str:
+    return f"{table_name}_y{month.year:04d}m{month.month:02d}"
+
+
+def default_partition_name(table_name: str) -> str:
+    return f"{table_name}_default"
+
+
+# ============================================
+# POSTGRESQL PARTITIONS
+# ============================================
+
+def _is_partitioned(connection: Connection, table_name: str) -> bool:
+    return connection.execute(
+        text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:name)"), {"name": table_name}
+    ).scalar() == "p"
+
+
+def _partitions(connection: Connection, table_name: str) -> Dict[datetime, str]:
+    """Monthly partitions of a table by month start"""
+    names = connection.execute(
+        text(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = to_regclass(:name)"
+        ),
+        {"name": table_name}
+    ).scalars()
+    partitions = {}
+    for name in names:
+        match = PARTITION_SUFFIX.search(name)
+        if match:
+            partitions[datetime(int(match.group(1)), int(match.group(2)), 1)] = name
+    return partitions
+
+
+def _create_default_partition(connection: Connection, table_name: str):
+    """Partition for events of months without their own partition (late events, gaps)"""
+    connection.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {default_partition_name(table_name)} PARTITION OF {table_name} DEFAULT"
+    ))
+
+
+def _create_partition(connection: Connection, table_name: str, month: datetime):
+    """
+    Create the partition of a month
+
+    Rows of that month already in the default partition would make the
+    creation fail, so they are moved into the new partition.
+    """
+    default = default_partition_name(table_name)
+    bounds = {"start": month, "end": add_months(month, 1)}
+    in_month = "\"timestamp\" >= :start AND \"timestamp\" < :end"
+    has_default = connection.execute(text("SELECT to_regclass(:name) IS NOT NULL"), {"name": default}).scalar()
+    move = has_default and connection.execute(
+        text(f"SELECT EXISTS (SELECT 1 FROM {default} WHERE {in_month})"), bounds
+    ).scalar()
+    if move:
+        connection.execute(text(f"CREATE TEMPORARY TABLE moved_events AS SELECT * FROM {default} WHERE {in_month}"), bounds)
+        connection.execute(text(f"DELETE FROM {default} WHERE {in_month}"), bounds)
+
+    connection.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {partition_name(table_name, month)} PARTITION OF {table_name} "
+        f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+    ))
+
+    if move:
+        connection.execute(text(f"INSERT INTO {table_name} SELECT * FROM moved_events"))
+        connection.execute(text("DROP TABLE moved_events"))
+
+
+def _convert_to_partitioned(connection: Connection, table: Table):
+    """
+    Replace a plain event table by one partitioned by month, keeping its rows
+
+    Unique keys of a partitioned table must contain the partition column,
+    so the primary key becomes (id, timestamp) and unique indexes get
+    timestamp appended. event_id stays unique in practice: a redelivered
+    event carries the same timestamp.
+    """
+    name = table.name
+    legacy = f"{name}_unpartitioned"
+    sequence = connection.execute(text("SELECT pg_get_serial_sequence(:table, 'id')"), {"table": name}).scalar()
+
+    connection.execute(text(f"ALTER TABLE {name} RENAME TO {legacy}"))
+    connection.execute(text(
+        f"CREATE TABLE {name} (LIKE {legacy} INCLUDING DEFAULTS) PARTITION BY RANGE (\"timestamp\")"
+    ))
+    months = connection.execute(
+        text(f"SELECT DISTINCT date_trunc('month', \"timestamp\") FROM {legacy}")
+    ).scalars().all()
+    current = month_start(datetime.utcnow())
+    for month in sorted(set(months) | {add_months(current, ahead) for ahead in range(PARTITIONS_AHEAD + 1)}):
+        _create_partition(connection, name, month)
+    _create_default_partition(connection, name)
+
+    connection.execute(text(f"INSERT INTO {name} SELECT * FROM {legacy}"))
+    if sequence:
+        # The id sequence is owned by the old table and would be dropped with it
+        connection.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY {name}.id"))
+    connection.execute(text(f"DROP TABLE {legacy}"))
+
+    connection.execute(text(f"ALTER TABLE {name} ADD PRIMARY KEY (id, \"timestamp\")"))
+    for index in table.indexes:
+        if not index.unique:
+            connection.execute(CreateIndex(index))
+            continue
+        columns = [column.name for column in index.columns]
+        if "timestamp" not in columns:
+            columns.append("timestamp")
+        quoted = ", ".join(f'"{column}"' for column in columns)
+        connection.execute(text(f"CREATE UNIQUE INDEX {index.name} ON {name} ({quoted})"))
+    logger.info(f"Partitioned {name} by month ({len(months)} months of existing events)")
+
+
+class EventPartitions:
+    """
+    Monthly partitions of the raw event tables (PostgreSQL only)
+
+    Partitions are only created at startup and by the maintenance job,
+    ahead of the months they hold: creating one locks the whole table, so
+    ingestion never does. Events of months without a partition (late or
+    replayed ones) land in the default partition; retention removes those
+    older than the cutoff like any other, so they never bring a dropped
+    month back.
+    """
+
+    def __init__(self, engine: Engine):
+        self.engine = engine
+        self._partitioned: Dict[str, bool] = {}
+
+    def is_partitioned(self, table_name: str) -> bool:
+        if self.engine.dialect.name != "postgresql":
+            return False
+        if table_name not in self._partitioned:
+            with self.engine.connect() as connection:
+                self._partitioned[table_name] = _is_partitioned(connection, table_name)
+        return self._partitioned[table_name]
+
+    def setup(self):
+        """Partition the event tables if enabled and not done yet (at startup, before consumers run)"""
+        if self.engine.dialect.name != "postgresql" or not config.EVENT_PARTITIONING:
+            return
+        for model in EVENT_MODELS:
+            with self.engine.begin() as connection:
+                if not _is_partitioned(connection, model.__tablename__):
+                    _convert_to_partitioned(connection, model.__table__)
+                else:
+                    # Tables partitioned before the default partition existed
+                    _create_default_partition(connection, model.__tablename__)
+            self._partitioned[model.__tablename__] = True
+        self.create_ahead()
+
+    def create_ahead(self, now: Optional[datetime] = None):
+        """Create the missing partitions of the current month and the PARTITIONS_AHEAD next ones"""
+        current = month_start(now or datetime.utcnow())
+        months = [add_months(current, ahead) for ahead in range(PARTITIONS_AHEAD + 1)]
+        for model in EVENT_MODELS:
+            table_name = model.__tablename__
+            if not self.is_partitioned(table_name):
+                continue
+            with self.engine.begin() as connection:
+                existing = _partitions(connection, table_name)
+                for month in months:
+                    if month not in existing:
+                        _create_partition(connection, table_name, month)
+                        logger.info(f"Created partition {partition_name(table_name, month)}")
+
+
+event_partitions = EventPartitions(database.engine)
+
+
+# ============================================
+# RETENTION
+# ============================================
+
+def fold_into_rollups(db: Session, model, start: datetime, end: datetime) -> int:
+    """
+    Make sure the rollups count every raw event from start to end
+
+    Rollups are maintained during ingestion, so normally nothing is
+    missing; anything that is (events stored before the rollups existed
+    and not backfilled) is added. Existing counts are never lowered, so
+    running it twice is harmless. Works a day at a time to bound memory.
+
+    Args:
+        db: Database session (committed by the caller)
+        model: Raw event model
+        start: First day (inclusive)
+        end: Last day (exclusive)
+
+    Returns:
+        Number of events that were missing from the rollups
+    """
+    missing_events = 0
+    day = bucket_start(start, "day")
+    while day < end:
+        next_day = day + timedelta(days=1)
+        rows = db.execute(
+            select(model.user_id, model.event_type, model.timestamp).where(
+                model.timestamp >= day, model.timestamp < next_day
+            ).execution_options(yield_per=10000)
+        )
+        user_counts, system_counts = count_rollups(row._mapping for row in rows)
+
+        stored_user = {
+            (row.user_id, row.granularity, row.bucket_start, row.event_type): row.event_count
+            for row in db.execute(select(models.UserEventRollup).where(
+                models.UserEventRollup.bucket_start >= day, models.UserEventRollup.bucket_start < next_day
+            )).scalars()
+        }
+        stored_system = {
+            (row.granularity, row.bucket_start, row.event_type): row.event_count
+            for row in db.execute(select(models.SystemEventRollup).where(
+                models.SystemEventRollup.bucket_start >= day, models.SystemEventRollup.bucket_start < next_day
+            )).scalars()
+        }
+        missing_user = Counter({
+            key: count - stored_user.get(key, 0)
+            for key, count in user_counts.items()
+            if count > stored_user.get(key, 0)
+        })
+        missing_system = Counter({
+            key: count - stored_system.get(key, 0)
+            for key, count in system_counts.items()
+            if count > stored_system.get(key, 0)
+        })
+        add_rollup_counts(db, missing_user, missing_system)
+        missing_events += sum(count for (_, granularity, _, _), count in missing_user.items() if granularity == "day")
+        day = next_day
+    return missing_events
+
+
+def apply_retention(engine: Engine, now: Optional[datetime] = None) -> int:
+    """
+    Drop raw events older than EVENT_RETENTION_MONTHS whole months
+
+    Expired events are folded into the rollups first. Partitioned tables
+    lose whole partitions (detach and drop, no row-by-row delete);
+    elsewhere, and in the default partition, the rows are deleted.
+
+    Args:
+        engine: Analytics database engine
+        now: Current time (defaults to now, UTC)
+
+    Returns:
+        Number of partitions dropped plus rows deleted
+    """
+    if config.EVENT_RETENTION_MONTHS <= 0:
+        return 0
+    cutoff = add_months(month_start(now or datetime.utcnow()), -config.EVENT_RETENTION_MONTHS)
+
+    removed = 0
+    for model in EVENT_MODELS:
+        table_name = model.__tablename__
+        if event_partitions.is_partitioned(table_name):
+            with engine.connect() as connection:
+                partitions = _partitions(connection, table_name)
+            for month, name in sorted(partitions.items()):
+                if add_months(month, 1) > cutoff:
+                    continue
+                with Session(engine) as db:
+                    missing = fold_into_rollups(db, model, month, add_months(month, 1))
+                    db.commit()
+                with engine.begin() as connection:
+                    connection.execute(text(f"ALTER TABLE {table_name} DETACH PARTITION {name}"))
+                    connection.execute(text(f"DROP TABLE {name}"))
+                removed += 1
+                logger.info(f"Dropped partition {name} ({missing} events were missing from the rollups)")
+
+        # Rows of tables without partitions, or of the default partition (the only one left before the cutoff)
+        with Session(engine) as db:
+            oldest = db.scalar(select(func.min(model.timestamp)))
+            if oldest is None or oldest >= cutoff:
+                continue
+            missing = fold_into_rollups(db, model, oldest, cutoff)
+            deleted = db.execute(delete(model).where(model.timestamp < cutoff)).rowcount
+            db.commit()
+        removed += deleted
+        logger.info(
+            f"Deleted {deleted} {table_name} rows before {cutoff:%Y-%m} ({missing} were missing from the rollups)"
+        )
+    return removed
+
+
+def run_maintenance(engine: Engine):
+    """Create upcoming partitions and apply retention, unless another replica is doing it"""
+    if engine.dialect.name != "postgresql":
+        apply_retention(engine)
+        return
+
+    with engine.connect() as lock_connection:
+        locked = lock_connection.execute(text("SELECT pg_try_advisory_lock(:id)"), {"id": MAINTENANCE_LOCK_ID})
+        if not locked.scalar():
+            return
+        try:
+            event_partitions.create_ahead()
+            apply_retention(engine)
+        finally:
+            lock_connection.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": MAINTENANCE_LOCK_ID})
+            lock_connection.commit()
+
+
+# ============================================
+# SCHEDULER
+# ============================================
+
+_scheduler_stop = threading.Event()
+
+
+def _run_scheduler(interval_seconds: float):
+    while not _scheduler_stop.is_set():
+        try:
+            run_maintenance(database.engine)
+        except Exception as e:
+            logger.error(f"Event table maintenance failed: {e}")
+        _scheduler_stop.wait(interval_seconds)
+
+
+def start_retention_scheduler(interval_seconds: Optional[float] = None) -> threading.Thread:
+    """
+    Start a background thread running run_maintenance periodically
+
+    It only touches old partitions and rollup rows, so consumers keep
+    ingesting while it runs.
+
+    Args:
+        interval_seconds: Time between runs (defaults to EVENT_MAINTENANCE_INTERVAL_HOURS)
+
+    Returns:
+        The scheduler thread
+    """
+    interval_seconds = interval_seconds or config.EVENT_MAINTENANCE_INTERVAL_HOURS * 3600
+    _scheduler_stop.clear()
+    thread = threading.Thread(target=_run_scheduler, args=(interval_seconds,), daemon=True, name="event-maintenance")
+    thread.start()
+    return thread
+
+
+def stop_retention_scheduler():
+    _scheduler_stop.set()
@@ -0,0 +1,193 @@
+import logging
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import func, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from . import models
+from .upsert import upsert_counters
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Supported bucket sizes and their length
+GRANULARITIES = {
+    "hour": timedelta(hours=1),
+    "day": timedelta(days=1),
+}
+
+# Upper bound on the points returned by one time-series query
+MAX_TIMESERIES_BUCKETS = 1000
+
+
+def to_utc_naive(timestamp: datetime) -> datetime:
+    """Naive UTC datetime, as the event tables store them"""
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+def bucket_start(timestamp: datetime, granularity: str) -> datetime:
+    """
+    Start of the hour or day (UTC) containing a timestamp
+
+    Args:
+        timestamp: Event time, naive UTC or timezone-aware
+        granularity: "hour" or "day"
+
+    Returns:
+        Naive UTC datetime, like the event tables store
+    """
+    timestamp = to_utc_naive(timestamp).replace(minute=0, second=0, microsecond=0)
+    if granularity == "day":
+        timestamp = timestamp.replace(hour=0)
+    return timestamp
+
+
+def count_rollups(rows: Iterable[dict]) -> Tuple[Counter, Counter]:
+    """
+    Count events per rollup key
+
+    Args:
+        rows: Event rows with user_id, event_type and timestamp
+
+    Returns:
+        Counts keyed by (user_id, granularity, bucket_start, event_type), and
+        system-wide counts keyed by (granularity, bucket_start, event_type)
+    """
+    user_counts, system_counts = Counter(), Counter()
+    for row in rows:
+        user_id, event_type = row["user_id"], row["event_type"]
+        hour = bucket_start(row["timestamp"], "hour")
+        day = hour.replace(hour=0)
+        user_counts[(user_id, "hour", hour, event_type)] += 1
+        user_counts[(user_id, "day", day, event_type)] += 1
+        system_counts[("hour", hour, event_type)] += 1
+        system_counts[("day", day, event_type)] += 1
+    return user_counts, system_counts
+
+
+def upsert_rollups(db: Session, rows: Iterable[dict]):
+    """
+    Add stored events to the hourly and daily rollups
+
+    The batch is counted in memory first, so each (bucket, event type)
+    becomes one upsert however many events fall into it.
+
+    Args:
+        db: Database session (committed by the caller, with the events)
+        rows: Stored event rows with user_id, event_type and timestamp
+    """
+    add_rollup_counts(db, *count_rollups(rows))
+
+
+def add_rollup_counts(db: Session, user_counts: Counter, system_counts: Counter):
+    """Add counts from count_rollups to the rollup tables"""
+    upsert_counters(
+        db,
+        models.UserEventRollup.__table__,
+        [
+            {"user_id": user_id, "granularity": granularity, "bucket_start": start,
+             "event_type": event_type, "event_count": count}
+            for (user_id, granularity, start, event_type), count in user_counts.items()
+        ],
+        key_columns=("user_id", "granularity", "bucket_start", "event_type"),
+        counters=("event_count",)
+    )
+    upsert_counters(
+        db,
+        models.SystemEventRollup.__table__,
+        [
+            {"granularity": granularity, "bucket_start": start, "event_type": event_type, "event_count": count}
+            for (granularity, start, event_type), count in system_counts.items()
+        ],
+        key_columns=("granularity", "bucket_start", "event_type"),
+        counters=("event_count",)
+    )
+
+
+def timeseries(
+    db: Session,
+    granularity: str,
+    start: datetime,
+    end: datetime,
+    user_id: Optional[int] = None,
+    event_type: Optional[str] = None
+) -> List[dict]:
+    """
+    Event counts per bucket from the rollups, with empty buckets filled in
+
+    Reads one rollup row per non-empty (bucket, event type) in the range,
+    so the cost depends on the number of buckets, not of events.
+
+    Args:
+        db: Database session
+        granularity: "hour" or "day"
+        start: First bucket (inclusive, truncated to the bucket)
+        end: Last bucket (inclusive, truncated to the bucket)
+        user_id: Only this user's events (system-wide when None)
+        event_type: Only this event type (all types when None)
+
+    Returns:
+        One {"bucket_start", "counts"} dict per bucket, oldest first
+
+    Raises:
+        ValueError: If the granularity is unknown or the range has too many buckets
+    """
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"Unknown bucket '{granularity}', expected one of: {', '.join(GRANULARITIES)}")
+    step = GRANULARITIES[granularity]
+    start, end = bucket_start(start, granularity), bucket_start(end, granularity)
+    buckets = (end - start) // step + 1
+    if buckets > MAX_TIMESERIES_BUCKETS:
+        raise ValueError(f"Range spans {buckets} buckets, at most {MAX_TIMESERIES_BUCKETS} are allowed")
+
+    model = models.SystemEventRollup if user_id is None else models.UserEventRollup
+    query = select(model.bucket_start, model.event_type, model.event_count).where(
+        model.granularity == granularity,
+        model.bucket_start >= start,
+        model.bucket_start <= end
+    )
+    if user_id is not None:
+        query = query.where(model.user_id == user_id)
+    if event_type is not None:
+        query = query.where(model.event_type == event_type)
+
+    counts: Dict[datetime, Dict[str, int]] = {}
+    for row in db.execute(query):
+        counts.setdefault(row.bucket_start, {})[row.event_type] = row.event_count
+
+    points = []
+    for index in range(max(buckets, 0)):
+        current = start + index * step
+        points.append({"bucket_start": current, "counts": counts.get(current, {})})
+    return points
+
+
+def backfill_rollups(engine: Engine, batch_size: int = 10000):
+    """
+    Build the rollups from stored events when they are still empty
+
+    Rollups are maintained during ingestion; this covers events stored
+    before the rollup tables existed. Runs at startup, before consumers
+    start, and does nothing once any rollup row exists.
+
+    Args:
+        engine: Analytics database engine
+        batch_size: Events read and counted per round trip
+    """
+    with Session(engine) as db:
+        if db.scalar(select(func.count()).select_from(models.SystemEventRollup)):
+            return
+
+        stored = 0
+        for model in (models.NoteEvent, models.UserEvent):
+            query = select(model.user_id, model.event_type, model.timestamp).execution_options(yield_per=batch_size)
+            for partition in db.execute(query).partitions():
+                upsert_rollups(db, [row._mapping for row in partition])
+                stored += len(partition)
+        db.commit()
+
+    if stored:
+        logger.info(f"Backfilled rollups from {stored} stored events")
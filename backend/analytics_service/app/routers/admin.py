@@ -0,0 +1,110 @@
+from fastapi import APIRouter, Depends, HTTPException, status
+from sqlalchemy.orm import Session
+from typing import Optional
+from datetime import datetime
+import numpy as np
+from .. import schemas, database, rollups
+from ..analytics_queries import (
+    METRICS,
+    activity_by_hour,
+    analytics_snapshot,
+    histogram,
+    percentiles,
+    retention_cohorts,
+)
+import sys
+sys.path.append('/app')
+from ..shared.jwt_utils import get_admin_user_id
+
+router = APIRouter(dependencies=[Depends(get_admin_user_id)])
+
+# Upper bounds of the cohort and histogram query parameters
+MAX_COHORTS = 104
+MAX_COHORT_WEEKS = 52
+MAX_HISTOGRAM_BINS = 200
+
+# ============================================
+# COHORT AND DISTRIBUTION ENDPOINTS (ADMIN)
+# ============================================
+
+def _check_range(name: str, value: int, maximum: int):
+    if not 1 <= value <= maximum:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"{name} must be between 1 and {maximum}"
+        )
+
+@router.get("/cohorts", response_model=schemas.RetentionCohortsResponse)
+async def get_retention_cohorts(
+    cohorts: int = 12,
+    weeks: int = 8,
+    db: Session = Depends(database.get_db)
+):
+    """Get weekly retention of the users who registered in each of the last `cohorts` weeks"""
+    _check_range("cohorts", cohorts, MAX_COHORTS)
+    _check_range("weeks", weeks, MAX_COHORT_WEEKS)
+
+    arrays = analytics_snapshot.get(db)
+    statistics, active_days = arrays["statistics"], arrays["active_days"]
+    return schemas.RetentionCohortsResponse(
+        snapshot_at=analytics_snapshot.loaded_at,
+        cohorts=retention_cohorts(
+            statistics["user_id"],
+            statistics["registered_at"],
+            active_days["user_id"],
+            active_days["day"],
+            cohorts,
+            weeks,
+            now=analytics_snapshot.loaded_at
+        )
+    )
+
+@router.get("/distribution", response_model=schemas.DistributionResponse)
+async def get_distribution(
+    metric: str = "total_notes",
+    bins: int = 20,
+    db: Session = Depends(database.get_db)
+):
+    """Get percentiles and a histogram of a per-user statistic across all users"""
+    if metric not in METRICS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"metric must be one of: {', '.join(METRICS)}"
+        )
+    _check_range("bins", bins, MAX_HISTOGRAM_BINS)
+
+    values = analytics_snapshot.get(db)["statistics"][metric]
+    return schemas.DistributionResponse(
+        snapshot_at=analytics_snapshot.loaded_at,
+        metric=metric,
+        users=len(values),
+        mean=float(values.mean()) if len(values) else 0.0,
+        max=int(values.max()) if len(values) else 0,
+        percentiles=percentiles(values),
+        histogram=histogram(values, bins)
+    )
+
+@router.get("/activity-by-hour", response_model=schemas.HourlyActivityResponse)
+async def get_activity_by_hour(
+    event_type: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    db: Session = Depends(database.get_db)
+):
+    """Get events per hour of day (UTC), optionally of one event type and from start to end"""
+    hourly = analytics_snapshot.get(db)["hourly"]
+    selected = np.ones(len(hourly["hour"]), dtype=bool)
+    if event_type is not None:
+        selected &= hourly["event_type"] == event_type
+    if start is not None:
+        selected &= hourly["hour"] >= np.datetime64(rollups.to_utc_naive(start), "h")
+    if end is not None:
+        selected &= hourly["hour"] <= np.datetime64(rollups.to_utc_naive(end), "h")
+
+    return schemas.HourlyActivityResponse(
+        snapshot_at=analytics_snapshot.loaded_at,
+        event_type=event_type,
+        start=start,
+        end=end,
+        counts=activity_by_hour(hourly["hour"][selected], hourly["event_count"][selected])
+    )
@@ -1,15 +1,31 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Response, status
+from fastapi.responses import StreamingResponse
+from sqlalchemy import tuple_
 from sqlalchemy.orm import Session
-from sqlalchemy import func
-from typing import List
+from typing import List, Literal, Optional, Tuple
 from datetime import datetime, timedelta
-from .. import models, schemas, database
+import base64
+import math
+from .. import models, schemas, database, rollups
+from ..active_users import active_users
+from ..leaderboard import K_MAX, LEADERBOARDS, SKETCH_WIDTH, WINDOWS, leaderboard_view
+from ..live_statistics import statistics_hub
+from ..system_stats import system_statistics
 import sys
 sys.path.append('/app')
-from ..shared.jwt_utils import get_current_user_id
+from ..shared.jwt_utils import get_current_user_id, get_stream_user_id
 
 router = APIRouter()
 
+# Buckets returned by a time-series query without an explicit start
+DEFAULT_TIMESERIES_BUCKETS = 30
+
+# Largest page of event history
+MAX_EVENTS_LIMIT = 500
+
+# Most notes returned by the hottest notes query
+MAX_HOTTEST_NOTES = 100
+
 # ============================================
 # USER STATISTICS ENDPOINTS
 # ============================================
@@ -40,6 +56,21 @@ async def get_my_statistics(
 
     return user_stats
 
+@router.get("/users/me/stream")
+async def stream_my_statistics(current_user_id: int = Depends(get_stream_user_id)):
+    """
+    Stream the authenticated user's statistics as Server-Sent Events
+
+    The first `statistics` event carries all fields, later ones only the
+    fields that changed. EventSource cannot send headers, so the token may
+    be passed as the `token` query parameter.
+    """
+    return StreamingResponse(
+        statistics_hub.stream(current_user_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @router.get("/users/{user_id}/statistics", response_model=schemas.UserStatisticsResponse)
 async def get_user_statistics(
     user_id: int,
@@ -65,49 +96,202 @@ async def get_user_statistics(
 
     return user_stats
 
+# ============================================
+# NOTE STATISTICS ENDPOINTS
+# ============================================
+
+@router.get("/users/me/notes/hottest", response_model=List[schemas.NoteStatisticsResponse])
+async def get_my_hottest_notes(
+    limit: int = 10,
+    include_deleted: bool = False,
+    current_user_id: int = Depends(get_current_user_id),
+    db: Session = Depends(database.get_db)
+):
+    """Get the authenticated user's most edited notes, most edits first"""
+    if not 1 <= limit <= MAX_HOTTEST_NOTES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"limit must be between 1 and {MAX_HOTTEST_NOTES}"
+        )
+
+    query = db.query(models.NoteStatistics).filter(models.NoteStatistics.user_id == current_user_id)
+    if not include_deleted:
+        query = query.filter(models.NoteStatistics.deleted_at.is_(None))
+    return query.order_by(
+        models.NoteStatistics.edit_count.desc(), models.NoteStatistics.note_id.desc()
+    ).limit(limit).all()
+
+@router.get("/notes/{note_id}/statistics", response_model=schemas.NoteStatisticsResponse)
+async def get_note_statistics(
+    note_id: int,
+    current_user_id: int = Depends(get_current_user_id),
+    db: Session = Depends(database.get_db)
+):
+    """Get activity statistics of a note (must be owned by the authenticated user)"""
+    note_stats = db.get(models.NoteStatistics, note_id)
+
+    if not note_stats:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Statistics not found for this note"
+        )
+
+    if note_stats.user_id != current_user_id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="You can only view statistics of your own notes"
+        )
+
+    return note_stats
+
 # ============================================
 # EVENT HISTORY ENDPOINTS
 # ============================================
 
+def encode_cursor(timestamp: datetime, event_id: int) -> str:
+    """Opaque cursor pointing at an event: its timestamp and row ID"""
+    return base64.urlsafe_b64encode(f"{timestamp.isoformat()}|{event_id}".encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        timestamp, event_id = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode().split("|")
+        return datetime.fromisoformat(timestamp), int(event_id)
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+def _event_page(
+    db: Session,
+    response: Response,
+    model,
+    user_id: int,
+    limit: int,
+    before: Optional[str],
+    event_type: Optional[str],
+    start: Optional[datetime],
+    end: Optional[datetime]
+) -> list:
+    """
+    One page of a user's events, newest first
+
+    Pages are keyed by (timestamp, id) rather than an offset, so every page
+    is a range scan of the (user_id, timestamp DESC, id DESC) index however
+    deep it is. When more events follow, the X-Next-Cursor header holds the
+    cursor to pass as `before` for the next page.
+    """
+    if not 1 <= limit <= MAX_EVENTS_LIMIT:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"limit must be between 1 and {MAX_EVENTS_LIMIT}"
+        )
+
+    query = db.query(model).filter(model.user_id == user_id)
+    if event_type is not None:
+        query = query.filter(model.event_type == event_type)
+    if start is not None:
+        query = query.filter(model.timestamp >= rollups.to_utc_naive(start))
+    if end is not None:
+        query = query.filter(model.timestamp <= rollups.to_utc_naive(end))
+    if before is not None:
+        query = query.filter(tuple_(model.timestamp, model.id) < tuple_(*decode_cursor(before)))
+
+    events = query.order_by(model.timestamp.desc(), model.id.desc()).limit(limit + 1).all()
+    if len(events) > limit:
+        events = events[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor(events[-1].timestamp, events[-1].id)
+    return events
+
 @router.get("/users/{user_id}/events/notes", response_model=List[schemas.NoteEventResponse])
 async def get_user_note_events(
     user_id: int,
+    response: Response,
     limit: int = 50,
+    before: Optional[str] = None,
+    event_type: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
     current_user_id: int = Depends(get_current_user_id),
     db: Session = Depends(database.get_db)
 ):
-    """Get note events for a specific user (must be the authenticated user)"""
+    """Get note events for a specific user, newest first (must be the authenticated user)"""
     if user_id != current_user_id:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="You can only view your own events"
         )
 
-    events = db.query(models.NoteEvent).filter(
-        models.NoteEvent.user_id == user_id
-    ).order_by(models.NoteEvent.timestamp.desc()).limit(limit).all()
-
-    return events
+    return _event_page(db, response, models.NoteEvent, user_id, limit, before, event_type, start, end)
 
 @router.get("/users/{user_id}/events/activity", response_model=List[schemas.UserEventResponse])
 async def get_user_activity_events(
     user_id: int,
+    response: Response,
     limit: int = 50,
+    before: Optional[str] = None,
+    event_type: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
     current_user_id: int = Depends(get_current_user_id),
     db: Session = Depends(database.get_db)
 ):
-    """Get user activity events (must be the authenticated user)"""
+    """Get user activity events, newest first (must be the authenticated user)"""
     if user_id != current_user_id:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="You can only view your own events"
         )
 
-    events = db.query(models.UserEvent).filter(
-        models.UserEvent.user_id == user_id
-    ).order_by(models.UserEvent.timestamp.desc()).limit(limit).all()
+    return _event_page(db, response, models.UserEvent, user_id, limit, before, event_type, start, end)
 
-    return events
+# ============================================
+# TIME SERIES ENDPOINTS
+# ============================================
+
+def _timeseries_response(
+    db: Session,
+    bucket: str,
+    start: Optional[datetime],
+    end: Optional[datetime],
+    user_id: Optional[int],
+    event_type: Optional[str]
+) -> schemas.TimeseriesResponse:
+    end = rollups.to_utc_naive(end) if end else datetime.utcnow()
+    start = rollups.to_utc_naive(start) if start else end - rollups.GRANULARITIES[bucket] * (DEFAULT_TIMESERIES_BUCKETS - 1)
+    if start > end:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="start must not be after end")
+    try:
+        points = rollups.timeseries(db, bucket, start, end, user_id=user_id, event_type=event_type)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+    return schemas.TimeseriesResponse(
+        bucket=bucket,
+        start=rollups.bucket_start(start, bucket),
+        end=rollups.bucket_start(end, bucket),
+        points=points
+    )
+
+@router.get("/users/me/timeseries", response_model=schemas.TimeseriesResponse)
+async def get_my_timeseries(
+    bucket: Literal["hour", "day"] = "day",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    event_type: Optional[str] = None,
+    current_user_id: int = Depends(get_current_user_id),
+    db: Session = Depends(database.get_db)
+):
+    """Get the authenticated user's event counts per hour or day (defaults to the last 30 buckets)"""
+    return _timeseries_response(db, bucket, start, end, current_user_id, event_type)
+
+@router.get("/system/timeseries", response_model=schemas.TimeseriesResponse)
+async def get_system_timeseries(
+    bucket: Literal["hour", "day"] = "day",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    event_type: Optional[str] = None,
+    db: Session = Depends(database.get_db)
+):
+    """Get event counts across all users per hour or day (public endpoint)"""
+    return _timeseries_response(db, bucket, start, end, None, event_type)
 
 # ============================================
 # SYSTEM STATISTICS ENDPOINTS (PUBLIC)
@@ -115,31 +299,51 @@ async def get_user_activity_events(
 
 @router.get("/system/statistics", response_model=schemas.SystemStatistics)
 async def get_system_statistics(db: Session = Depends(database.get_db)):
-    """Get overall system statistics (public endpoint)"""
-    # Count total users
-    total_users = db.query(func.count(models.UserStatistics.user_id)).scalar() or 0
-
-    # Sum all note statistics
-    stats = db.query(
-        func.sum(models.UserStatistics.total_notes_created).label("total_created"),
-        func.sum(models.UserStatistics.total_notes_updated).label("total_updated"),
-        func.sum(models.UserStatistics.total_notes_deleted).label("total_deleted"),
-        func.sum(models.UserStatistics.total_logins).label("total_logins")
-    ).first()
+    """Get overall system statistics (public endpoint, refreshed every few seconds)"""
+    return system_statistics.get(db)
+
+@router.get("/system/active-users", response_model=schemas.ActiveUsersResponse)
+async def get_active_users(
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    db: Session = Depends(database.get_db)
+):
+    """Get distinct users active from start to end, whole days (defaults to the last 30 days; public endpoint)"""
+    end = rollups.bucket_start(end or datetime.utcnow(), "day")
+    start = rollups.bucket_start(start, "day") if start else end - timedelta(days=29)
+    if start > end:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="start must not be after end")
+
+    return schemas.ActiveUsersResponse(
+        start=start,
+        end=end,
+        active_users=active_users.count(db, start, end),
+        mode=active_users.mode,
+        relative_error=active_users.relative_error
+    )
+
+@router.get("/system/leaderboard", response_model=schemas.LeaderboardResponse)
+async def get_leaderboard(
+    by: str = "events",
+    window: str = "all",
+    k: int = 10,
+    db: Session = Depends(database.get_db)
+):
+    """Get the users (or notes, by=note_edits) with the most events, all-time or over the last 24h/7d (public endpoint)"""
+    if by not in LEADERBOARDS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"by must be one of: {', '.join(LEADERBOARDS)}")
+    if window not in WINDOWS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"window must be one of: {', '.join(WINDOWS)}")
+    if not 1 <= k <= K_MAX:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"k must be between 1 and {K_MAX}")
 
-    # Count active users today
-    today = datetime.utcnow().date()
-    active_users_today = db.query(func.count(models.UserStatistics.user_id)).filter(
-        func.date(models.UserStatistics.last_activity) == today
-    ).scalar() or 0
-
-    return schemas.SystemStatistics(
-        total_users=total_users,
-        total_notes_created=stats.total_created or 0,
-        total_notes_updated=stats.total_updated or 0,
-        total_notes_deleted=stats.total_deleted or 0,
-        total_logins=stats.total_logins or 0,
-        active_users_today=active_users_today
+    entries, events = leaderboard_view.top(db, by, window, k)
+    return schemas.LeaderboardResponse(
+        by=by,
+        window=window,
+        as_of=leaderboard_view.as_of,
+        entries=[schemas.LeaderboardEntry(id=key, count=count) for key, count in entries],
+        max_error=math.ceil(math.e / SKETCH_WIDTH * events)
     )
 
 @router.get("/health")
@@ -1,6 +1,6 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, computed_field
 from datetime import datetime
-from typing import Optional
+from typing import Dict, List, Optional
 
 # ============================================
 # ANALYTICS SCHEMAS
@@ -20,6 +20,26 @@ class UserStatisticsResponse(BaseModel):
     class Config:
         from_attributes = True
 
+class NoteStatisticsResponse(BaseModel):
+    note_id: int
+    user_id: int
+    edit_count: int
+    title: Optional[str]
+    created_at: Optional[datetime]
+    last_updated_at: Optional[datetime]
+    deleted_at: Optional[datetime]
+
+    @computed_field
+    @property
+    def lifetime_seconds(self) -> Optional[float]:
+        """Time from creation to deletion, for deleted notes"""
+        if self.created_at is None or self.deleted_at is None:
+            return None
+        return (self.deleted_at - self.created_at).total_seconds()
+
+    class Config:
+        from_attributes = True
+
 class NoteEventResponse(BaseModel):
     id: int
     event_type: str
@@ -49,3 +69,68 @@ class SystemStatistics(BaseModel):
     total_notes_deleted: int
     total_logins: int
     active_users_today: int
+    active_users_week: int
+    active_users_month: int
+
+class ActiveUsersResponse(BaseModel):
+    start: datetime
+    end: datetime
+    active_users: int
+    mode: str  # hll, exact
+    relative_error: float  # standard error of the estimate (0 when exact)
+
+class LeaderboardEntry(BaseModel):
+    id: int  # user ID, or note ID for note_edits
+    count: int  # estimated, never below the true count
+
+class LeaderboardResponse(BaseModel):
+    by: str
+    window: str  # all, 24h, 7d
+    as_of: datetime
+    entries: List[LeaderboardEntry]
+    max_error: int  # counts exceed the true ones by at most this (98% probability)
+
+class TimeseriesPoint(BaseModel):
+    bucket_start: datetime
+    counts: Dict[str, int]  # events per event type, empty for a bucket without events
+
+class TimeseriesResponse(BaseModel):
+    bucket: str
+    start: datetime
+    end: datetime
+    points: List[TimeseriesPoint]
+
+# ============================================
+# ADMIN ANALYTICS SCHEMAS
+# ============================================
+
+class RetentionCohort(BaseModel):
+    week_start: datetime  # Monday of the registration week
+    users: int
+    active: List[int]  # users active in each week since registration, week 0 first
+    retention: List[float]  # the same as shares of `users`
+
+class RetentionCohortsResponse(BaseModel):
+    snapshot_at: datetime
+    cohorts: List[RetentionCohort]
+
+class HistogramBucket(BaseModel):
+    start: int
+    end: int  # inclusive
+    count: int
+
+class DistributionResponse(BaseModel):
+    snapshot_at: datetime
+    metric: str
+    users: int
+    mean: float
+    max: int
+    percentiles: Dict[str, float]  # p50, p75, p90, p95, p99
+    histogram: List[HistogramBucket]
+
+class HourlyActivityResponse(BaseModel):
+    snapshot_at: datetime
+    event_type: Optional[str] = None
+    start: Optional[datetime] = None
+    end: Optional[datetime] = None
+    counts: List[int]  # events per hour of day (UTC), hour 0 first
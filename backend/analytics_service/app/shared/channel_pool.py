@@ -0,0 +1,276 @@
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import List, Optional, Set
+from pydantic import BaseModel
+from .config import config
+from .rabbitmq_client import RabbitMQClient
+from .spool import EventSpool, SpoolReplayer, make_record, publish_record, spool_path
+from .codec import encode_event
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Slot last used by the current thread or asyncio task (contextvars give per-task values)
+_preferred_slot: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar("rabbitmq_pool_slot", default=None)
+
+
+class PoolTimeout(Exception):
+    """Raised when no pooled channel becomes free in time"""
+
+
+class PooledChannel:
+    """A pooled connection and its channel, leased to one thread at a time"""
+
+    def __init__(self, index: int, rabbitmq_url: str):
+        self.index = index
+        self.client = RabbitMQClient(rabbitmq_url)
+
+    def is_healthy(self) -> bool:
+        connection = self.client.connection
+        channel = self.client.channel
+        return (
+            connection is not None and connection.is_open
+            and channel is not None and channel.is_open
+        )
+
+    def ensure_open(self):
+        """Reconnect if the connection or channel has been closed"""
+        if not self.is_healthy():
+            self.reset()
+            # Fail fast: callers spool instead of sleeping through reconnect backoff
+            self.client.connect(max_attempts=1)
+
+    def reset(self):
+        try:
+            self.client.close()
+        except Exception:
+            pass
+        self.client.connection = None
+        self.client.channel = None
+
+
+class RabbitMQChannelPool:
+    """
+    Fixed-size pool of RabbitMQ connections with checkout/return semantics
+
+    pika connections are not thread-safe, so a slot (one connection and its
+    channel) is leased exclusively. A thread or asyncio task gets the slot
+    it used last when that slot is free, which keeps publishes from the same
+    caller on the same socket.
+    """
+
+    def __init__(
+        self,
+        rabbitmq_url: Optional[str] = None,
+        size: Optional[int] = None,
+        checkout_timeout: Optional[float] = None
+    ):
+        """
+        Initialize channel pool
+
+        Args:
+            rabbitmq_url: RabbitMQ connection URL (defaults to config value)
+            size: Number of pooled connections
+            checkout_timeout: Seconds to wait for a free slot before raising PoolTimeout
+        """
+        rabbitmq_url = rabbitmq_url or config.RABBITMQ_URL
+        self.size = size or config.RABBITMQ_POOL_SIZE
+        self.checkout_timeout = (
+            config.RABBITMQ_POOL_CHECKOUT_TIMEOUT_MS / 1000 if checkout_timeout is None else checkout_timeout
+        )
+        self._slots: List[PooledChannel] = [PooledChannel(i, rabbitmq_url) for i in range(self.size)]
+        self._free: Set[int] = set(range(self.size))
+        self._condition = threading.Condition()
+        self._closed = False
+        self._health_thread: Optional[threading.Thread] = None
+        self.connects = 0
+        self.broken = 0
+        self.checkouts = 0
+        self.checkout_wait_max_ms = 0.0
+
+    def checkout(self, timeout: Optional[float] = None) -> PooledChannel:
+        """
+        Lease a slot, reconnecting it if it is no longer healthy
+
+        Args:
+            timeout: Seconds to wait for a free slot (defaults to the pool setting)
+
+        Returns:
+            Leased slot; must be handed back with checkin
+        """
+        timeout = self.checkout_timeout if timeout is None else timeout
+        started = time.monotonic()
+        preferred = _preferred_slot.get()
+
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._free or self._closed, timeout):
+                raise PoolTimeout(f"No RabbitMQ channel available within {timeout}s")
+            if self._closed:
+                raise RuntimeError("Channel pool is closed")
+
+            index = preferred if preferred in self._free else next(iter(self._free))
+            self._free.remove(index)
+            self.checkouts += 1
+            self.checkout_wait_max_ms = max(self.checkout_wait_max_ms, (time.monotonic() - started) * 1000)
+
+        slot = self._slots[index]
+        try:
+            if not slot.is_healthy():
+                slot.ensure_open()
+                self.connects += 1
+        except Exception:
+            self.checkin(slot)
+            raise
+
+        _preferred_slot.set(index)
+        return slot
+
+    def checkin(self, slot: PooledChannel, broken: bool = False):
+        """
+        Return a leased slot to the pool
+
+        Args:
+            slot: Slot returned by checkout
+            broken: Whether the slot failed while leased (it is reconnected on next checkout)
+        """
+        if broken:
+            self.broken += 1
+            slot.reset()
+
+        with self._condition:
+            self._free.add(slot.index)
+            self._condition.notify()
+
+    @contextmanager
+    def channel(self, timeout: Optional[float] = None):
+        """Context manager leasing a slot and returning it afterwards"""
+        slot = self.checkout(timeout)
+        try:
+            yield slot.client
+        except Exception:
+            self.checkin(slot, broken=True)
+            raise
+        else:
+            self.checkin(slot)
+
+    def health_check(self):
+        """Service heartbeats on idle slots and drop the ones that have died"""
+        for slot in self._slots:
+            with self._condition:
+                if slot.index not in self._free:
+                    continue
+                self._free.remove(slot.index)
+
+            try:
+                if slot.client.connection is not None and slot.client.connection.is_open:
+                    slot.client.connection.process_data_events(time_limit=0)
+                if slot.client.connection is not None and not slot.is_healthy():
+                    slot.reset()
+            except Exception as e:
+                logger.warning(f"Pooled RabbitMQ connection {slot.index} failed health check: {e}")
+                slot.reset()
+            finally:
+                self.checkin(slot)
+
+    def start_health_checks(self, interval: Optional[float] = None):
+        """Run health_check periodically in a background thread"""
+        interval = interval or config.RABBITMQ_POOL_HEALTH_CHECK_SECONDS
+
+        def run():
+            while not self._closed:
+                time.sleep(interval)
+                self.health_check()
+
+        self._health_thread = threading.Thread(target=run, name="rabbitmq-pool-health", daemon=True)
+        self._health_thread.start()
+
+    def stats(self) -> dict:
+        with self._condition:
+            in_use = self.size - len(self._free)
+        return {
+            "size": self.size,
+            "in_use": in_use,
+            "healthy": sum(1 for slot in self._slots if slot.is_healthy()),
+            "checkouts": self.checkouts,
+            "connects": self.connects,
+            "broken": self.broken,
+            "checkout_wait_max_ms": self.checkout_wait_max_ms,
+        }
+
+    def close(self):
+        """Close all pooled connections"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        for slot in self._slots:
+            slot.reset()
+
+
+class PooledRabbitMQClient:
+    """
+    Synchronous publisher backed by a RabbitMQChannelPool
+
+    When the broker is unreachable events are appended to a disk spool
+    instead of being lost; a replayer thread publishes them in order once a
+    connection can be made again. While the spool is non-empty new events
+    are spooled too, so they are never published ahead of older ones.
+    """
+
+    def __init__(self, pool: Optional[RabbitMQChannelPool] = None, spool: Optional[EventSpool] = None):
+        self.pool = pool or RabbitMQChannelPool()
+        self.pool.start_health_checks()
+        self.spool = spool or EventSpool(spool_path("events"))
+        self.replayer = SpoolReplayer(self.spool, self._publish_record)
+        self.replayer.start()
+
+    def publish(self, exchange_name: str, message: BaseModel, routing_key: str = ""):
+        """
+        Publish a message on a pooled channel, spooling it if that fails
+
+        A publish that fails on a broken connection is retried once on a
+        fresh connection before the event is spooled.
+
+        Args:
+            exchange_name: Name of the exchange
+            message: Pydantic model to publish
+            routing_key: Routing key for message (defaults to the event type)
+        """
+        routing_key = routing_key or message.event_type
+        record = make_record(exchange_name, routing_key, message.event_type, encode_event(message))
+
+        if self.spool.has_pending():
+            self._spool(record)
+            return
+
+        for attempt in range(2):
+            try:
+                self._publish_record(record)
+                break
+            except PoolTimeout:
+                self._spool(record)
+                return
+            except Exception as e:
+                if attempt:
+                    logger.warning(f"Publishing failed, spooling event: {e}")
+                    self._spool(record)
+                    return
+        logger.info(f"Published message to {exchange_name}: {message.event_type}")
+
+    def _publish_record(self, record: dict):
+        with self.pool.channel() as client:
+            publish_record(client, record)
+
+    def _spool(self, record: dict):
+        self.spool.append([record])
+        self.replayer.notify()
+
+    def get_metrics(self) -> dict:
+        return {"mode": "sync", "pool": self.pool.stats(), "spool": self.spool.stats()}
+
+    def close(self):
+        self.replayer.stop()
+        self.pool.close()
+        self.spool.close()
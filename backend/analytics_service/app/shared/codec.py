@@ -0,0 +1,170 @@
+import json
+import logging
+import zlib
+from typing import List, NamedTuple, Optional
+from pydantic import BaseModel
+from .config import config
+
+try:
+    import msgpack
+except ImportError:  # msgpack is optional for producers that only speak JSON
+    msgpack = None
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE_JSON = "application/json"
+CONTENT_TYPE_MSGPACK = "application/msgpack"
+CONTENT_ENCODING_ZLIB = "zlib"
+
+# AMQP `type` property of messages carrying many events ({"events": [...]})
+BATCH_MESSAGE_TYPE = "event-batch"
+
+
+class EncodedMessage(NamedTuple):
+    """Serialized message body together with its AMQP content headers"""
+    body: bytes
+    content_type: str
+    content_encoding: Optional[str] = None
+    message_type: Optional[str] = None
+    partition_key: Optional[str] = None
+
+
+def partition_key_of(message: BaseModel) -> Optional[str]:
+    """Key that keeps a user's events together in partitioned consumers (the user ID)"""
+    user_id = getattr(message, "user_id", None)
+    return None if user_id is None else str(user_id)
+
+
+def _pack(payload, content_type: str) -> bytes:
+    if content_type == CONTENT_TYPE_MSGPACK:
+        return msgpack.packb(payload, use_bin_type=True)
+    return json.dumps(payload, separators=(",", ":")).encode()
+
+
+def _resolve_content_type(content_type: Optional[str]) -> str:
+    content_type = content_type or config.EVENT_CONTENT_TYPE
+    if content_type == CONTENT_TYPE_MSGPACK and msgpack is None:
+        logger.warning("msgpack is not installed, falling back to JSON encoding")
+        return CONTENT_TYPE_JSON
+    if content_type not in (CONTENT_TYPE_JSON, CONTENT_TYPE_MSGPACK):
+        raise ValueError(f"Unsupported content type: {content_type}")
+    return content_type
+
+
+def encode_payload(
+    payload,
+    content_type: Optional[str] = None,
+    compression: Optional[str] = None
+) -> EncodedMessage:
+    """
+    Encode a JSON-compatible payload for publishing
+
+    Args:
+        payload: Dict or list of JSON-compatible values
+        content_type: CONTENT_TYPE_JSON or CONTENT_TYPE_MSGPACK (defaults to config value)
+        compression: "zlib" or "none" (defaults to config value); only bodies of at
+            least EVENT_COMPRESSION_MIN_BYTES are compressed
+
+    Returns:
+        Encoded message
+    """
+    content_type = _resolve_content_type(content_type)
+    body = _pack(payload, content_type)
+
+    compression = compression or config.EVENT_COMPRESSION
+    if compression == CONTENT_ENCODING_ZLIB and len(body) >= config.EVENT_COMPRESSION_MIN_BYTES:
+        return EncodedMessage(zlib.compress(body), content_type, CONTENT_ENCODING_ZLIB)
+    return EncodedMessage(body, content_type)
+
+
+def encode_event(message: BaseModel, content_type: Optional[str] = None) -> EncodedMessage:
+    """
+    Encode an event model for publishing
+
+    Values are converted to their JSON forms first (datetimes become ISO
+    strings), so consumers see the same dict whichever encoding was used.
+
+    Args:
+        message: Pydantic event model
+        content_type: CONTENT_TYPE_JSON or CONTENT_TYPE_MSGPACK (defaults to config value)
+
+    Returns:
+        Encoded message
+    """
+    content_type = _resolve_content_type(content_type)
+    if content_type == CONTENT_TYPE_JSON and config.EVENT_COMPRESSION != CONTENT_ENCODING_ZLIB:
+        # Fast path: pydantic serializes straight to JSON bytes
+        return EncodedMessage(message.model_dump_json().encode(), content_type, partition_key=partition_key_of(message))
+    encoded = encode_payload(message.model_dump(mode="json"), content_type)
+    return encoded._replace(partition_key=partition_key_of(message))
+
+
+def encode_batch(messages: List[BaseModel], content_type: Optional[str] = None) -> EncodedMessage:
+    """
+    Encode many event models as a single batch envelope
+
+    Envelopes are large and repetitive, so EVENT_COMPRESSION pays off most here.
+    An envelope only gets a partition key if all its events share one.
+
+    Args:
+        messages: Pydantic event models
+        content_type: CONTENT_TYPE_JSON or CONTENT_TYPE_MSGPACK (defaults to config value)
+
+    Returns:
+        Encoded envelope
+    """
+    payload = {"events": [message.model_dump(mode="json") for message in messages]}
+    partition_keys = {partition_key_of(message) for message in messages}
+    return encode_payload(payload, content_type)._replace(
+        message_type=BATCH_MESSAGE_TYPE,
+        partition_key=partition_keys.pop() if len(partition_keys) == 1 else None
+    )
+
+
+def unpack_envelope(payload, message_type: Optional[str] = None) -> List[dict]:
+    """
+    Events carried by a decoded message
+
+    Args:
+        payload: Decoded message body
+        message_type: AMQP type property of the message
+
+    Returns:
+        The envelope's events, or a single-element list for a plain event
+    """
+    if message_type == BATCH_MESSAGE_TYPE:
+        return payload["events"]
+    return [payload]
+
+
+def decode_body(body: bytes, content_type: Optional[str] = None, content_encoding: Optional[str] = None):
+    """
+    Decode a message body according to its AMQP content headers
+
+    Messages without a content type are treated as JSON, which is what
+    producers sent before content types were negotiated.
+
+    Args:
+        body: Raw message body
+        content_type: AMQP content_type property
+        content_encoding: AMQP content_encoding property
+
+    Returns:
+        Decoded payload
+
+    Raises:
+        ValueError: If the content type or encoding is not supported
+    """
+    if content_encoding == CONTENT_ENCODING_ZLIB:
+        body = zlib.decompress(body)
+    elif content_encoding not in (None, "", "identity", "utf-8"):
+        raise ValueError(f"Unsupported content encoding: {content_encoding}")
+
+    if content_type in (None, "", CONTENT_TYPE_JSON):
+        return json.loads(body)
+    if content_type == CONTENT_TYPE_MSGPACK:
+        if msgpack is None:
+            raise ValueError("Received msgpack message but msgpack is not installed")
+        return msgpack.unpackb(body, raw=False)
+    raise ValueError(f"Unsupported content type: {content_type}")
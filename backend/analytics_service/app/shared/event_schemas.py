@@ -1,7 +1,12 @@
-from pydantic import BaseModel
+import uuid
+from pydantic import BaseModel, Field
 from datetime import datetime
 from typing import Optional
 
+def new_event_id() -> str:
+    """Producer-assigned event ID; consumers use it to drop redeliveries"""
+    return uuid.uuid4().hex
+
 # ============================================
 # USER EVENTS
 # ============================================
@@ -9,6 +14,7 @@ from typing import Optional
 class UserRegisteredEvent(BaseModel):
     """Event published when a new user registers"""
     event_type: str = "user.registered"
+    event_id: str = Field(default_factory=new_event_id)
     user_id: int
     username: str
     email: str
@@ -17,6 +23,7 @@ class UserRegisteredEvent(BaseModel):
 class UserLoggedInEvent(BaseModel):
     """Event published when a user logs in"""
     event_type: str = "user.logged_in"
+    event_id: str = Field(default_factory=new_event_id)
     user_id: int
     username: str
     timestamp: datetime
@@ -28,6 +35,7 @@ class UserLoggedInEvent(BaseModel):
 class NoteCreatedEvent(BaseModel):
     """Event published when a note is created"""
     event_type: str = "note.created"
+    event_id: str = Field(default_factory=new_event_id)
     note_id: int
     user_id: int
     title: str
@@ -36,6 +44,7 @@ class NoteCreatedEvent(BaseModel):
 class NoteUpdatedEvent(BaseModel):
     """Event published when a note is updated"""
     event_type: str = "note.updated"
+    event_id: str = Field(default_factory=new_event_id)
     note_id: int
     user_id: int
     title: str
@@ -44,6 +53,20 @@ class NoteUpdatedEvent(BaseModel):
 class NoteDeletedEvent(BaseModel):
     """Event published when a note is deleted"""
     event_type: str = "note.deleted"
+    event_id: str = Field(default_factory=new_event_id)
     note_id: int
     user_id: int
     timestamp: datetime
+
+# ============================================
+# AUTH EVENTS
+# ============================================
+
+class TokenRevokedEvent(BaseModel):
+    """Event published when an access token is revoked"""
+    event_type: str = "token.revoked"
+    event_id: str = Field(default_factory=new_event_id)
+    jti: str
+    user_id: int
+    expires_at: datetime
+    timestamp: datetime
@@ -1,13 +1,60 @@
 import pika
-import json
 import logging
-from typing import Callable, Optional
+import random
+import time
+from datetime import datetime
+from typing import Callable, List, Optional
 from pydantic import BaseModel
 from .config import config
+from .codec import (
+    BATCH_MESSAGE_TYPE,
+    CONTENT_TYPE_JSON,
+    EncodedMessage,
+    decode_body,
+    encode_batch,
+    encode_event,
+    encode_payload,
+    partition_key_of,
+    unpack_envelope,
+)
+
+from . import memory_broker
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def open_connection(rabbitmq_url: str):
+    """
+    Open a blocking connection for a broker URL
+
+    amqp:// URLs connect to RabbitMQ through pika; memory:// URLs connect to a
+    process-local broker with the same API, for tests and benchmarks that run
+    the whole pipeline in one process.
+
+    Args:
+        rabbitmq_url: Broker connection URL
+
+    Returns:
+        pika.BlockingConnection or memory_broker.InMemoryConnection
+    """
+    if rabbitmq_url.startswith(memory_broker.MEMORY_URL_SCHEME):
+        return memory_broker.connect(rabbitmq_url)
+    return pika.BlockingConnection(pika.URLParameters(rabbitmq_url))
+
+
+def backoff_delay(attempt: int) -> float:
+    """
+    Delay before a reconnect attempt (exponential backoff with full jitter)
+
+    Args:
+        attempt: Number of failed attempts so far, starting at 0
+
+    Returns:
+        Delay in seconds
+    """
+    cap = min(config.RABBITMQ_RECONNECT_MAX_MS, config.RABBITMQ_RECONNECT_BASE_MS * (2 ** attempt))
+    return random.uniform(0, cap) / 1000
+
 class RabbitMQClient:
     """RabbitMQ client for publishing and consuming messages"""
 
@@ -22,16 +69,44 @@ class RabbitMQClient:
         self.connection = None
         self.channel = None
 
-    def connect(self):
-        """Establish connection to RabbitMQ"""
+    def connect(self, max_attempts: Optional[int] = None):
+        """
+        Establish connection to RabbitMQ, retrying with jittered exponential backoff
+
+        Args:
+            max_attempts: Number of connection attempts (defaults to config value)
+        """
+        max_attempts = max_attempts or config.RABBITMQ_CONNECT_MAX_ATTEMPTS
+
+        for attempt in range(max_attempts):
+            try:
+                self.connection = open_connection(self.rabbitmq_url)
+                self.channel = self.connection.channel()
+                logger.info("Connected to RabbitMQ")
+                return
+            except Exception as e:
+                if attempt + 1 >= max_attempts:
+                    logger.error(f"Failed to connect to RabbitMQ: {e}")
+                    raise
+
+                delay = backoff_delay(attempt)
+                logger.warning(f"Failed to connect to RabbitMQ ({e}), retrying in {delay:.2f}s")
+                time.sleep(delay)
+
+    def stop_consuming(self):
+        """
+        Make a running consume/consume_batches return (callable from any thread)
+
+        The consumer stops on its own thread, and acks what it already
+        processed (consume_batches first processes its pending batch).
+        """
+        connection, channel = self.connection, self.channel
+        if connection is None or channel is None or connection.is_closed:
+            return
         try:
-            parameters = pika.URLParameters(self.rabbitmq_url)
-            self.connection = pika.BlockingConnection(parameters)
-            self.channel = self.connection.channel()
-            logger.info("Connected to RabbitMQ")
+            connection.add_callback_threadsafe(channel.stop_consuming)
         except Exception as e:
-            logger.error(f"Failed to connect to RabbitMQ: {e}")
-            raise
+            logger.warning(f"Failed to stop consuming: {e}")
 
     def close(self):
         """Close RabbitMQ connection"""
@@ -39,13 +114,14 @@ class RabbitMQClient:
             self.connection.close()
             logger.info("Closed RabbitMQ connection")
 
-    def declare_exchange(self, exchange_name: str, exchange_type: str = "fanout"):
+    def declare_exchange(self, exchange_name: str, exchange_type: str = "fanout", arguments: Optional[dict] = None):
         """
         Declare an exchange
 
         Args:
             exchange_name: Name of the exchange
-            exchange_type: Type of exchange (fanout, direct, topic, headers)
+            exchange_type: Type of exchange (fanout, direct, topic, headers, x-consistent-hash)
+            arguments: Optional exchange arguments (hash-header, ...)
         """
         if not self.channel:
             self.connect()
@@ -53,22 +129,39 @@ class RabbitMQClient:
         self.channel.exchange_declare(
             exchange=exchange_name,
             exchange_type=exchange_type,
-            durable=True
+            durable=True,
+            arguments=arguments
         )
         logger.info(f"Declared exchange: {exchange_name} ({exchange_type})")
 
-    def declare_queue(self, queue_name: str):
+    def declare_queue(
+        self,
+        queue_name: str,
+        durable: bool = True,
+        exclusive: bool = False,
+        arguments: Optional[dict] = None
+    ) -> str:
         """
         Declare a queue
 
         Args:
-            queue_name: Name of the queue
+            queue_name: Name of the queue (empty string for a server-named queue)
+            durable: Whether the queue survives broker restarts
+            exclusive: Whether the queue is private to this connection
+            arguments: Optional queue arguments (x-message-ttl, x-dead-letter-exchange, ...)
+
+        Returns:
+            Name of the declared queue
         """
         if not self.channel:
             self.connect()
 
-        self.channel.queue_declare(queue=queue_name, durable=True)
+        result = self.channel.queue_declare(
+            queue=queue_name, durable=durable, exclusive=exclusive, arguments=arguments
+        )
+        queue_name = result.method.queue
         logger.info(f"Declared queue: {queue_name}")
+        return queue_name
 
     def bind_queue(self, queue_name: str, exchange_name: str, routing_key: str = ""):
         """
@@ -87,7 +180,41 @@ class RabbitMQClient:
             exchange=exchange_name,
             routing_key=routing_key
         )
-        logger.info(f"Bound queue {queue_name} to exchange {exchange_name}")
+        logger.info(f"Bound queue {queue_name} to exchange {exchange_name} ({routing_key or '*'})")
+
+    def unbind_queue(self, queue_name: str, exchange_name: str, routing_key: str = ""):
+        """
+        Remove a binding between a queue and an exchange (no-op if it does not exist)
+
+        Args:
+            queue_name: Name of the queue
+            exchange_name: Name of the exchange
+            routing_key: Routing key of the binding
+        """
+        if not self.channel:
+            self.connect()
+
+        self.channel.queue_unbind(
+            queue=queue_name,
+            exchange=exchange_name,
+            routing_key=routing_key
+        )
+        logger.info(f"Unbound queue {queue_name} from exchange {exchange_name}")
+
+    def bind_exchange(self, destination: str, source: str, routing_key: str = ""):
+        """
+        Bind an exchange to another exchange
+
+        Args:
+            destination: Exchange receiving the messages
+            source: Exchange the messages are published to
+            routing_key: Routing key for binding
+        """
+        if not self.channel:
+            self.connect()
+
+        self.channel.exchange_bind(destination=destination, source=source, routing_key=routing_key)
+        logger.info(f"Bound exchange {destination} to exchange {source} ({routing_key or '*'})")
 
     def publish(self, exchange_name: str, message: BaseModel, routing_key: str = ""):
         """
@@ -96,53 +223,206 @@ class RabbitMQClient:
         Args:
             exchange_name: Name of the exchange
             message: Pydantic model to publish
+            routing_key: Routing key for message (defaults to the event type)
+        """
+        routing_key = routing_key or message.event_type
+        self.publish_encoded(exchange_name, encode_event(message), routing_key)
+        logger.info(f"Published message to {exchange_name}: {message.event_type}")
+
+    def publish_body(
+        self,
+        exchange_name: str,
+        body: bytes,
+        routing_key: str = "",
+        content_type: str = CONTENT_TYPE_JSON,
+        content_encoding: Optional[str] = None,
+        message_type: Optional[str] = None,
+        headers: Optional[dict] = None
+    ):
+        """
+        Publish an already serialized message body to an exchange
+
+        Args:
+            exchange_name: Name of the exchange
+            body: Serialized message
             routing_key: Routing key for message
+            content_type: MIME type of the body, used by consumers to pick a decoder
+            content_encoding: Compression applied to the body, if any
+            message_type: AMQP type property (BATCH_MESSAGE_TYPE for envelopes)
+            headers: Optional message headers
         """
         if not self.channel:
             self.connect()
 
-        message_body = message.model_dump_json()
-
         self.channel.basic_publish(
             exchange=exchange_name,
             routing_key=routing_key,
-            body=message_body,
+            body=body,
             properties=pika.BasicProperties(
                 delivery_mode=2,  # Make message persistent
-                content_type="application/json"
+                content_type=content_type,
+                content_encoding=content_encoding,
+                type=message_type,
+                headers=headers
             )
         )
-        logger.info(f"Published message to {exchange_name}: {message.event_type}")
+
+    def publish_encoded(self, exchange_name: str, encoded: EncodedMessage, routing_key: str = ""):
+        """Publish an EncodedMessage together with its content headers and partition key"""
+        self.publish_body(
+            exchange_name,
+            encoded.body,
+            routing_key,
+            encoded.content_type,
+            encoded.content_encoding,
+            encoded.message_type,
+            {PARTITION_KEY_HEADER: encoded.partition_key} if encoded.partition_key is not None else None
+        )
+
+    def publish_batch(self, exchange_name: str, messages: List[BaseModel], routing_key: str = ""):
+        """
+        Publish many events as one batch envelope
+
+        Consumers unpack envelopes transparently, so this is a drop-in
+        replacement for calling publish in a loop.
+
+        Args:
+            exchange_name: Name of the exchange
+            messages: Pydantic models to publish
+            routing_key: Routing key for the envelope (defaults to the shared event type)
+
+        Raises:
+            ValueError: If the events do not share one partition key, or mix
+                event types without an explicit routing key
+        """
+        if not messages:
+            return
+
+        # Partitioned consumers route a whole envelope by its key, so it must hold one user's events
+        if len({partition_key_of(message) for message in messages}) > 1:
+            raise ValueError("A batch must not mix events of different partition keys")
+
+        if not routing_key:
+            event_types = {message.event_type for message in messages}
+            if len(event_types) > 1:
+                raise ValueError("A batch with mixed event types needs an explicit routing key")
+            routing_key = event_types.pop()
+
+        self.publish_encoded(exchange_name, encode_batch(messages), routing_key)
+        logger.info(f"Published batch of {len(messages)} messages to {exchange_name}: {routing_key}")
+
+    def begin_transactions(self):
+        """
+        Put the channel in transaction mode
+
+        Publishes are then written without waiting for the broker, and take
+        effect together on commit, which waits for the broker once. If the
+        connection fails before the commit returns, none of them took effect.
+        """
+        if not self.channel:
+            self.connect()
+
+        self.channel.tx_select()
+
+    def commit(self):
+        """Commit the messages published since the last commit (see begin_transactions)"""
+        self.channel.tx_commit()
 
     def consume(
         self,
         queue_name: str,
         callback: Callable,
-        auto_ack: bool = False
+        auto_ack: bool = False,
+        prefetch_count: Optional[int] = None,
+        ack_batch_size: Optional[int] = None,
+        ack_interval_ms: Optional[int] = None,
+        retry: bool = False
     ):
         """
         Start consuming messages from a queue
 
+        Successfully processed messages are acknowledged cumulatively
+        (`multiple=True`) every `ack_batch_size` messages or `ack_interval_ms`,
+        whichever comes first. A failed message first settles the window of
+        successes before it and is then rejected on its own.
+
+        With `retry` enabled a failed message is not rejected but moved to the
+        next delayed retry queue (see declare_retry_queues), and to the
+        dead-letter queue once the retry tiers are exhausted.
+
         Args:
             queue_name: Name of the queue to consume from
             callback: Callback function to process messages
             auto_ack: Whether to automatically acknowledge messages
+            prefetch_count: Maximum number of unacknowledged messages delivered to this consumer
+            ack_batch_size: Number of processed messages acknowledged together
+            ack_interval_ms: Maximum time a processed message waits for its acknowledgement
+            retry: Whether failed messages go through the retry tiers and dead-letter queue
         """
         if not self.channel:
             self.connect()
 
-        def wrapper_callback(ch, method, properties, body):
+        prefetch_count = prefetch_count or config.CONSUMER_PREFETCH_COUNT
+        # The broker stops delivering at prefetch_count unacked messages, so a larger window could never fill
+        ack_batch_size = min(ack_batch_size or config.CONSUMER_ACK_BATCH_SIZE, prefetch_count)
+        ack_interval = (ack_interval_ms or config.CONSUMER_ACK_INTERVAL_MS) / 1000
+
+        window = AckWindow(self.channel, ack_batch_size, ack_interval)
+
+        def handle_failure(method, properties, encoded: EncodedMessage, error: Exception, retryable: bool) -> bool:
+            """Route a failed message or event; returns False if the delivery had to be rejected"""
+            if auto_ack:
+                return True
+            if not retry:
+                window.nack(method.delivery_tag)
+                return False
+
             try:
-                message = json.loads(body)
-                logger.info(f"Received message from {queue_name}: {message.get('event_type')}")
-                callback(message)
+                self.route_failed_message(queue_name, method, properties, encoded, error, retryable)
+            except Exception as e:
+                logger.error(f"Failed to route failed message, requeueing it: {e}")
+                window.nack(method.delivery_tag, requeue=True)
+                return False
+            return True
 
-                if not auto_ack:
-                    ch.basic_ack(delivery_tag=method.delivery_tag)
+        def wrapper_callback(ch, method, properties, body):
+            original = EncodedMessage(body, properties.content_type, properties.content_encoding, properties.type)
+            try:
+                payload = decode_body(body, properties.content_type, properties.content_encoding)
+                events = unpack_envelope(payload, properties.type)
             except Exception as e:
-                logger.error(f"Error processing message: {e}")
-                if not auto_ack:
-                    ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+                # Retrying cannot fix a body we cannot decode
+                logger.error(f"Undecodable message from {queue_name}: {e}")
+                if handle_failure(method, properties, original, e, retryable=False) and not auto_ack:
+                    window.ack(method.delivery_tag)
+                return
+
+            for event in events:
+                try:
+                    logger.info(f"Received message from {queue_name}: {event.get('event_type')}")
+                    callback(event)
+                except Exception as e:
+                    logger.error(f"Error processing message: {e}")
+                    # Events of an envelope are retried one by one, as plain messages
+                    failed = original if len(events) == 1 and properties.type != BATCH_MESSAGE_TYPE else (
+                        encode_payload(event, properties.content_type)
+                    )
+                    if not handle_failure(method, properties, failed, e, retryable=True):
+                        return
+
+            if not auto_ack:
+                window.ack(method.delivery_tag)
+
+        def flush_on_timer():
+            window.flush_if_due()
+            self.connection.call_later(ack_interval, flush_on_timer)
+
+        if not auto_ack:
+            self.channel.basic_qos(prefetch_count=prefetch_count)
+            self.connection.call_later(ack_interval, flush_on_timer)
+        if retry:
+            # The original is only acked once its retry copy has been confirmed by the broker
+            self.channel.confirm_delivery()
 
         self.channel.basic_consume(
             queue=queue_name,
@@ -150,44 +430,437 @@ class RabbitMQClient:
             auto_ack=auto_ack
         )
 
-        logger.info(f"Started consuming from queue: {queue_name}")
-        self.channel.start_consuming()
+        logger.info(f"Started consuming from queue: {queue_name} (prefetch={prefetch_count}, ack_batch={ack_batch_size})")
+        try:
+            self.channel.start_consuming()
+        finally:
+            if not auto_ack and self.channel.is_open:
+                window.flush()
+
+    def consume_batches(
+        self,
+        queue_name: str,
+        batch_callback: Callable[[List[dict]], None],
+        event_callback: Callable[[dict], None],
+        batch_size: Optional[int] = None,
+        batch_interval_ms: Optional[int] = None,
+        prefetch_count: Optional[int] = None,
+        retry: bool = False
+    ):
+        """
+        Start consuming messages, processing their events in micro-batches
+
+        Events are collected until there are `batch_size` of them or the
+        oldest has waited `batch_interval_ms`, then handed to batch_callback
+        together. Once it returns, every message of the batch is acknowledged
+        with a single multi-message ack.
+
+        If batch_callback raises, the batch is processed again event by event
+        with event_callback, so only the events that fail on their own are
+        rejected, or retried when `retry` is enabled (see consume).
+
+        Args:
+            queue_name: Name of the queue to consume from
+            batch_callback: Callback processing a list of events at once
+            event_callback: Callback processing a single event (fallback path)
+            batch_size: Maximum number of events per batch
+            batch_interval_ms: Maximum time an event waits for its batch to fill
+            prefetch_count: Maximum number of unacknowledged messages delivered to this consumer
+            retry: Whether failed events go through the retry tiers and dead-letter queue
+        """
+        if not self.channel:
+            self.connect()
+
+        batch_size = batch_size or config.CONSUMER_BATCH_SIZE
+        batch_interval = (batch_interval_ms or config.CONSUMER_BATCH_INTERVAL_MS) / 1000
+        # A batch can only fill if the broker delivers at least that many unacked messages
+        prefetch_count = max(prefetch_count or config.CONSUMER_PREFETCH_COUNT, batch_size)
+
+        pending = []  # (method, properties, original message, events) per delivery
+        rejected = set()  # Delivery tags of the current batch already settled by a nack
+        state = {"events": 0, "opened_at": 0.0}
+
+        def handle_failure(method, properties, encoded: EncodedMessage, error: Exception, retryable: bool) -> bool:
+            """Route a failed event; returns False if its delivery had to be rejected"""
+            if retry:
+                try:
+                    self.route_failed_message(queue_name, method, properties, encoded, error, retryable)
+                    return True
+                except Exception as e:
+                    logger.error(f"Failed to route failed message, requeueing it: {e}")
+                    self.channel.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+                    rejected.add(method.delivery_tag)
+                    return False
+            self.channel.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+            rejected.add(method.delivery_tag)
+            return False
+
+        def process_one_by_one(deliveries):
+            for method, properties, original, events in deliveries:
+                for event in events:
+                    try:
+                        event_callback(event)
+                    except Exception as e:
+                        logger.error(f"Error processing message: {e}")
+                        failed = original if len(events) == 1 and properties.type != BATCH_MESSAGE_TYPE else (
+                            encode_payload(event, properties.content_type)
+                        )
+                        if not handle_failure(method, properties, failed, e, retryable=True):
+                            break
+
+        def flush():
+            if not pending:
+                return
+            deliveries = list(pending)
+            pending.clear()
+            events = [event for _, _, _, delivery_events in deliveries for event in delivery_events]
+            state["events"] = 0
+
+            try:
+                batch_callback(events)
+            except Exception as e:
+                logger.warning(f"Batch of {len(events)} events from {queue_name} failed, processing them one by one: {e}")
+                process_one_by_one(deliveries)
+
+            # Acking a nacked tag would close the channel, so the ack names the last delivery still
+            # outstanding; with multiple=True it settles every outstanding one before it as well
+            outstanding = [method.delivery_tag for method, _, _, _ in deliveries if method.delivery_tag not in rejected]
+            rejected.clear()
+            if outstanding:
+                self.channel.basic_ack(delivery_tag=outstanding[-1], multiple=True)
+
+        def wrapper_callback(ch, method, properties, body):
+            original = EncodedMessage(body, properties.content_type, properties.content_encoding, properties.type)
+            try:
+                payload = decode_body(body, properties.content_type, properties.content_encoding)
+                events = unpack_envelope(payload, properties.type)
+            except Exception as e:
+                logger.error(f"Undecodable message from {queue_name}: {e}")
+                # Settle the batch first: the ack below must not cover unprocessed messages
+                flush()
+                if handle_failure(method, properties, original, e, retryable=False):
+                    self.channel.basic_ack(delivery_tag=method.delivery_tag)
+                return
+
+            if not pending:
+                state["opened_at"] = time.monotonic()
+            pending.append((method, properties, original, events))
+            state["events"] += len(events)
+            if state["events"] >= batch_size:
+                flush()
+
+        def flush_on_timer():
+            if pending and time.monotonic() - state["opened_at"] >= batch_interval:
+                flush()
+            self.connection.call_later(batch_interval / 2, flush_on_timer)
+
+        self.channel.basic_qos(prefetch_count=prefetch_count)
+        self.connection.call_later(batch_interval / 2, flush_on_timer)
+        if retry:
+            self.channel.confirm_delivery()
+
+        self.channel.basic_consume(queue=queue_name, on_message_callback=wrapper_callback)
+
+        logger.info(f"Started batch consuming from queue: {queue_name} (prefetch={prefetch_count}, batch={batch_size})")
+        try:
+            self.channel.start_consuming()
+        finally:
+            if self.channel.is_open:
+                flush()
+
+    def route_failed_message(
+        self,
+        queue_name: str,
+        method,
+        properties,
+        encoded: EncodedMessage,
+        error: Exception,
+        retryable: bool
+    ):
+        """
+        Move a failed message to its next retry queue or to the dead-letter queue
+
+        Args:
+            queue_name: Queue the message was consumed from
+            method: Delivery method frame
+            properties: Message properties
+            encoded: Body and content headers of the failed message or event
+            error: Exception raised while processing the message
+            retryable: Whether another attempt could succeed
+        """
+        retry_count = int((properties.headers or {}).get("x-retry-count", 0))
+        target, headers = failure_destination(
+            queue_name, method.exchange, method.routing_key, properties.headers, error, retryable
+        )
+
+        self.channel.basic_publish(
+            exchange="",
+            routing_key=target,
+            body=encoded.body,
+            properties=pika.BasicProperties(
+                delivery_mode=2,
+                content_type=encoded.content_type,
+                content_encoding=encoded.content_encoding,
+                type=encoded.message_type,
+                headers=headers
+            )
+        )
+        logger.warning(f"Moved failed message from {queue_name} to {target} (attempt {retry_count + 1})")
+
+
+def failure_destination(
+    queue_name: str,
+    exchange: str,
+    routing_key: str,
+    headers: Optional[dict],
+    error: Exception,
+    retryable: bool
+):
+    """
+    Where a failed message goes next, and the headers it carries there
+
+    Args:
+        queue_name: Queue the message was consumed from
+        exchange: Exchange the message was originally published to
+        routing_key: Routing key it was originally published with
+        headers: Headers of the failed message
+        error: Exception raised while processing the message
+        retryable: Whether another attempt could succeed
+
+    Returns:
+        Tuple of the target queue (next retry tier or dead-letter queue) and the new headers
+    """
+    headers = dict(headers or {})
+    retry_count = int(headers.get("x-retry-count", 0))
+    tiers = config.CONSUMER_RETRY_TIERS_MS
+
+    headers.setdefault("x-original-exchange", exchange)
+    headers.setdefault("x-original-routing-key", routing_key)
+    headers["x-last-error"] = f"{type(error).__name__}: {error}"[:1000]
+    headers["x-failed-at"] = datetime.utcnow().isoformat()
+
+    if retryable and retry_count < len(tiers):
+        headers["x-retry-count"] = retry_count + 1
+        return retry_queue_name(queue_name, tiers[retry_count]), headers
+    return dead_letter_queue_name(queue_name), headers
+
+
+class AckWindow:
+    """Accumulates acknowledgements and settles them with one multi-message ack"""
+
+    def __init__(self, channel, batch_size: int, interval: float):
+        """
+        Initialize acknowledgement window
+
+        Args:
+            channel: Channel the messages were delivered on
+            batch_size: Number of messages acknowledged together
+            interval: Seconds after which a non-empty window is flushed
+        """
+        self.channel = channel
+        self.batch_size = batch_size
+        self.interval = interval
+        self.last_tag: Optional[int] = None
+        self.pending = 0
+        self.opened_at = 0.0
+
+    def ack(self, delivery_tag: int):
+        """Record a successfully processed message"""
+        if self.pending == 0:
+            self.opened_at = time.monotonic()
+        self.last_tag = delivery_tag
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.flush()
+
+    def nack(self, delivery_tag: int, requeue: bool = False):
+        """Reject a failed message without acknowledging any message after it"""
+        self.flush()
+        self.channel.basic_nack(delivery_tag=delivery_tag, requeue=requeue)
+
+    def flush(self):
+        """Acknowledge every processed message up to the last one"""
+        if self.pending:
+            self.channel.basic_ack(delivery_tag=self.last_tag, multiple=True)
+            self.pending = 0
+
+    def flush_if_due(self):
+        if self.pending and time.monotonic() - self.opened_at >= self.interval:
+            self.flush()
 
 
 # ============================================
 # EXCHANGE AND QUEUE NAMES
 # ============================================
 
-# Exchanges
-USERS_EXCHANGE = "users.events"
-NOTES_EXCHANGE = "notes.events"
+# Exchanges (topic: routing key is the event_type, e.g. "note.updated")
+USERS_EXCHANGE = "users.topic"
+NOTES_EXCHANGE = "notes.topic"
+REVOCATIONS_EXCHANGE = "auth.revocations"
+
+# Fanout exchanges used before topic routing; kept bound while older producers still publish to them
+LEGACY_USERS_EXCHANGE = "users.events"
+LEGACY_NOTES_EXCHANGE = "notes.events"
 
 # Queues
 ANALYTICS_USERS_QUEUE = "analytics.users.queue"
 ANALYTICS_NOTES_QUEUE = "analytics.notes.queue"
 
+# Partitioned consumption (ANALYTICS_PARTITIONS > 1): the topic exchanges feed consistent-hash
+# exchanges that spread events over partition queues by the user ID in this header
+PARTITION_KEY_HEADER = "x-partition-key"
+ANALYTICS_USERS_PARTITION_EXCHANGE = "analytics.users.partitions"
+ANALYTICS_NOTES_PARTITION_EXCHANGE = "analytics.notes.partitions"
+
+def partition_queue_name(queue_name: str, partition: int) -> str:
+    """Name of a partition queue of a consumer queue"""
+    return f"{queue_name}.p{partition}"
+
+def consumer_queue_names(queue_name: str) -> List[str]:
+    """Queues consumed in place of a consumer queue: the queue itself plus its partitions, if enabled"""
+    if config.ANALYTICS_PARTITIONS <= 1:
+        return [queue_name]
+    return [queue_name] + [partition_queue_name(queue_name, p) for p in range(config.ANALYTICS_PARTITIONS)]
+
+def retry_queue_name(queue_name: str, delay_ms: int) -> str:
+    """Name of the delayed retry queue of a consumer queue"""
+    return f"{queue_name}.retry.{delay_ms}ms"
+
+def dead_letter_queue_name(queue_name: str) -> str:
+    """Name of the dead-letter queue of a consumer queue"""
+    return f"{queue_name}.dlq"
+
+def declare_retry_queues(client: RabbitMQClient, queue_name: str):
+    """
+    Declare the retry tiers and dead-letter queue of a consumer queue
+
+    Each retry queue holds messages for its TTL and then dead-letters them
+    through the default exchange back onto the consumer queue, so retries
+    are delayed by the broker instead of hot-looping in the consumer.
+
+    Args:
+        client: Connected RabbitMQ client
+        queue_name: Consumer queue
+    """
+    for delay_ms in config.CONSUMER_RETRY_TIERS_MS:
+        client.declare_queue(
+            retry_queue_name(queue_name, delay_ms),
+            arguments={
+                "x-message-ttl": delay_ms,
+                "x-dead-letter-exchange": "",
+                "x-dead-letter-routing-key": queue_name,
+            }
+        )
+    client.declare_queue(dead_letter_queue_name(queue_name))
+
+def declare_partitions(client: RabbitMQClient, queue_name: str, exchange: str, patterns: List[str], partition_exchange: str):
+    """
+    Replace a consumer queue's topic bindings with partition queues
+
+    The partition exchange (x-consistent-hash, rabbitmq_consistent_hash_exchange
+    plugin) hashes PARTITION_KEY_HEADER, so all events of a user land in the
+    same partition. Partition queues are single-active-consumer: any number of
+    workers may subscribe, one of them receives the messages and another takes
+    over when it goes away, which keeps per-user ordering across replicas.
+    The original queue keeps its legacy fanout bindings and is drained as before.
+
+    Args:
+        client: Connected RabbitMQ client
+        queue_name: Consumer queue being partitioned
+        exchange: Topic exchange the events are published to
+        patterns: Event type patterns the queue receives
+        partition_exchange: Name of the consistent-hash exchange
+    """
+    client.declare_exchange(partition_exchange, "x-consistent-hash", arguments={"hash-header": PARTITION_KEY_HEADER})
+    for pattern in patterns:
+        client.bind_exchange(partition_exchange, exchange, pattern)
+        client.unbind_queue(queue_name, exchange, pattern)
+
+    for partition in range(config.ANALYTICS_PARTITIONS):
+        partition_queue = partition_queue_name(queue_name, partition)
+        client.declare_queue(partition_queue, arguments={"x-single-active-consumer": True})
+        declare_retry_queues(client, partition_queue)
+        # The binding key of a consistent-hash exchange is the queue's weight
+        client.bind_queue(partition_queue, partition_exchange, "1")
+
+# Binding patterns of each consumer queue
+ANALYTICS_USERS_BINDINGS = ["user.*"]
+ANALYTICS_NOTES_BINDINGS = ["note.*"]
+
+
+def declare_event_exchanges(client: RabbitMQClient):
+    """Declare the exchanges events are published to (and the legacy fanout exchanges)"""
+    client.declare_exchange(USERS_EXCHANGE, "topic")
+    client.declare_exchange(NOTES_EXCHANGE, "topic")
+    client.declare_exchange(REVOCATIONS_EXCHANGE, "fanout")
+    client.declare_exchange(LEGACY_USERS_EXCHANGE, "fanout")
+    client.declare_exchange(LEGACY_NOTES_EXCHANGE, "fanout")
+
 
 def setup_rabbitmq_infrastructure():
     """
-    Setup RabbitMQ exchanges and queues
+    Setup the RabbitMQ exchanges a producer publishes to
     Should be called on application startup
+
+    Producers only declare exchanges. Queues and bindings belong to the
+    consumer (see setup_analytics_queues): a producer running with other
+    settings must never change how the analytics queues are bound.
     """
     client = RabbitMQClient()
     try:
         client.connect()
+        declare_event_exchanges(client)
+        logger.info("RabbitMQ exchanges setup completed")
+    finally:
+        client.close()
+
+
+def setup_analytics_queues():
+    """
+    Setup the analytics queues and their bindings (called by the analytics service only)
+
+    Queues are bound to the topic exchanges by event type pattern. With
+    RABBITMQ_LEGACY_FANOUT_BINDINGS enabled they also stay bound to the old
+    fanout exchanges, so events from producers that have not been upgraded
+    yet are still delivered; once every producer publishes to the topic
+    exchanges, disabling it removes those bindings.
 
-        # Declare exchanges
-        client.declare_exchange(USERS_EXCHANGE, "fanout")
-        client.declare_exchange(NOTES_EXCHANGE, "fanout")
+    With ANALYTICS_PARTITIONS > 1 the topic bindings are replaced by
+    partition queues (see declare_partitions), and the queue itself gets
+    no topic bindings.
+    """
+    client = RabbitMQClient()
+    try:
+        client.connect()
+        declare_event_exchanges(client)
 
         # Declare queues
         client.declare_queue(ANALYTICS_USERS_QUEUE)
         client.declare_queue(ANALYTICS_NOTES_QUEUE)
+        declare_retry_queues(client, ANALYTICS_USERS_QUEUE)
+        declare_retry_queues(client, ANALYTICS_NOTES_QUEUE)
 
         # Bind queues to exchanges
-        client.bind_queue(ANALYTICS_USERS_QUEUE, USERS_EXCHANGE)
-        client.bind_queue(ANALYTICS_NOTES_QUEUE, NOTES_EXCHANGE)
-
-        logger.info("RabbitMQ infrastructure setup completed")
+        for queue_name, exchange, patterns, partition_exchange in (
+            (ANALYTICS_USERS_QUEUE, USERS_EXCHANGE, ANALYTICS_USERS_BINDINGS, ANALYTICS_USERS_PARTITION_EXCHANGE),
+            (ANALYTICS_NOTES_QUEUE, NOTES_EXCHANGE, ANALYTICS_NOTES_BINDINGS, ANALYTICS_NOTES_PARTITION_EXCHANGE),
+        ):
+            if config.ANALYTICS_PARTITIONS > 1:
+                declare_partitions(client, queue_name, exchange, patterns, partition_exchange)
+            else:
+                for pattern in patterns:
+                    client.bind_queue(queue_name, exchange, pattern)
+
+        # Migration from fanout exchanges
+        for queue_name, legacy_exchange in (
+            (ANALYTICS_USERS_QUEUE, LEGACY_USERS_EXCHANGE),
+            (ANALYTICS_NOTES_QUEUE, LEGACY_NOTES_EXCHANGE),
+        ):
+            if config.RABBITMQ_LEGACY_FANOUT_BINDINGS:
+                client.bind_queue(queue_name, legacy_exchange)
+            else:
+                client.unbind_queue(queue_name, legacy_exchange)
+
+        logger.info("Analytics queues setup completed")
     finally:
         client.close()
@@ -0,0 +1,176 @@
+import logging
+import threading
+import time
+from collections import Counter
+from typing import Dict, Optional, Set
+from sqlalchemy import func, select, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from . import models, schemas
+from .active_users import active_users
+from .upsert import insert_new_rows, upsert_counters
+import sys
+sys.path.append('/app')
+from .shared.config import config
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Totals kept in system_counters. total_users counts registered users: users whose
+# user_statistics row has registered_at set (see count_registered_users)
+SYSTEM_COUNTERS = (
+    "total_users", "total_notes_created", "total_notes_updated", "total_notes_deleted", "total_logins"
+)
+
+
+def count_registered_users(registered_at):
+    """SQL aggregate of total_users over user_statistics rows (or a copy of the table)"""
+    return func.count(registered_at)
+
+
+def claim_registrations(db: Session, deltas: Dict[int, dict]) -> Set[int]:
+    """
+    Set registered_at of users registering in this batch, where not set yet
+
+    Each claim is a single statement that only succeeds on a row without
+    registered_at (a new row, or one created by the user's other events),
+    so of two transactions registering the same user only one gets it,
+    whatever they read before.
+
+    Args:
+        db: Database session (committed by the caller, with the events)
+        deltas: Per-user statistic deltas of the batch
+
+    Returns:
+        IDs of the users registered for the first time
+    """
+    registering = {
+        user_id: delta["registered_at"] for user_id, delta in deltas.items() if delta["registered_at"] is not None
+    }
+    if not registering:
+        return set()
+
+    statistics = models.UserStatistics
+    claimed = insert_new_rows(
+        db,
+        statistics.__table__,
+        [{"user_id": user_id, "registered_at": registered_at} for user_id, registered_at in sorted(registering.items())],
+        key_column="user_id"
+    )
+    for user_id, registered_at in sorted(registering.items()):
+        if user_id in claimed:
+            continue
+        statement = update(statistics).where(
+            statistics.user_id == user_id, statistics.registered_at.is_(None)
+        ).values(registered_at=registered_at)
+        if db.execute(statement).rowcount:
+            claimed.add(user_id)
+    return claimed
+
+
+def upsert_system_counters(db: Session, deltas: Dict[int, dict]):
+    """
+    Add a batch's effect to the system-wide totals
+
+    Each user's delta goes to shard `user_id % SYSTEM_COUNTER_SHARDS`, so
+    workers handling different users mostly update different rows instead
+    of queueing on one. A user counts towards total_users when their first
+    registration is stored (see claim_registrations), so this must run
+    before the batch's deltas are applied to user_statistics.
+
+    Args:
+        db: Database session (committed by the caller, with the events)
+        deltas: Per-user statistic deltas of the batch
+    """
+    shards: Dict[int, Counter] = {}
+    for user_id, delta in deltas.items():
+        shard = shards.setdefault(user_id % config.SYSTEM_COUNTER_SHARDS, Counter())
+        for column in SYSTEM_COUNTERS[1:]:
+            shard[column] += delta[column]
+
+    for user_id in claim_registrations(db, deltas):
+        shards[user_id % config.SYSTEM_COUNTER_SHARDS]["total_users"] += 1
+
+    upsert_counters(
+        db,
+        models.SystemCounters.__table__,
+        [
+            {"shard": shard, **{column: counts[column] for column in SYSTEM_COUNTERS}}
+            for shard, counts in shards.items()
+            if any(counts.values())
+        ],
+        key_columns=("shard",),
+        counters=SYSTEM_COUNTERS
+    )
+
+
+def load_system_statistics(db: Session) -> schemas.SystemStatistics:
+    """Read the totals (one row per shard) and the daily, weekly and monthly active users"""
+    totals = db.query(*(func.sum(getattr(models.SystemCounters, column)) for column in SYSTEM_COUNTERS)).one()
+    active = active_users.counts(db)
+
+    return schemas.SystemStatistics(
+        **{column: total or 0 for column, total in zip(SYSTEM_COUNTERS, totals)},
+        active_users_today=active["daily"],
+        active_users_week=active["weekly"],
+        active_users_month=active["monthly"]
+    )
+
+
+class SystemStatisticsSnapshot:
+    """
+    System statistics cached in memory and refreshed at most every few seconds
+
+    The endpoint is public, so the database sees at most one refresh per
+    interval per process however many requests arrive. While one request
+    refreshes, the others keep getting the previous snapshot.
+    """
+
+    def __init__(self, refresh_seconds: Optional[float] = None):
+        self.refresh_seconds = config.SYSTEM_STATS_REFRESH_SECONDS if refresh_seconds is None else refresh_seconds
+        self._lock = threading.Lock()
+        self._value: Optional[schemas.SystemStatistics] = None
+        self._loaded_at = 0.0
+
+    def get(self, db: Session) -> schemas.SystemStatistics:
+        if self._value is not None and time.monotonic() - self._loaded_at < self.refresh_seconds:
+            return self._value
+
+        if not self._lock.acquire(blocking=self._value is None):
+            return self._value
+        try:
+            if self._value is None or time.monotonic() - self._loaded_at >= self.refresh_seconds:
+                self._value = load_system_statistics(db)
+                self._loaded_at = time.monotonic()
+            return self._value
+        finally:
+            self._lock.release()
+
+
+system_statistics = SystemStatisticsSnapshot()
+
+
+def backfill_system_counters(engine: Engine):
+    """
+    Seed the system totals from user_statistics when they are still empty
+
+    Covers databases from before the counters existed; afterwards the
+    event processor keeps them up to date.
+
+    Args:
+        engine: Analytics database engine
+    """
+    with Session(engine) as db:
+        if db.scalar(select(func.count()).select_from(models.SystemCounters)):
+            return
+
+        users = db.scalar(select(func.count()).select_from(models.UserStatistics))
+        if not users:
+            return
+        stats = db.query(
+            count_registered_users(models.UserStatistics.registered_at),
+            *(func.sum(getattr(models.UserStatistics, column)) for column in SYSTEM_COUNTERS[1:])
+        ).one()
+        db.add(models.SystemCounters(shard=0, **{column: value or 0 for column, value in zip(SYSTEM_COUNTERS, stats)}))
+        db.commit()
+        logger.info(f"Seeded system counters from statistics of {users} users")
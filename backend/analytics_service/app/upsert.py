@@ -0,0 +1,149 @@
+from datetime import datetime
+from typing import Dict, List, Sequence, Set
+from sqlalchemy import Table, and_, bindparam, case, func, insert, or_, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+# Dialects with INSERT ... ON CONFLICT DO UPDATE
+ON_CONFLICT_INSERTS = {
+    "postgresql": postgresql.insert,
+    "sqlite": sqlite.insert,
+}
+
+
+def upsert_counters(
+    db: Session,
+    table: Table,
+    rows: List[dict],
+    key_columns: Sequence[str],
+    counters: Sequence[str] = (),
+    keep_latest: Sequence[str] = (),
+    assign: Dict[str, object] = None,
+    follow_latest: Dict[str, str] = None
+):
+    """
+    Add deltas to counter rows atomically, creating rows that do not exist yet
+
+    On PostgreSQL and SQLite each row becomes one
+    `INSERT ... ON CONFLICT (key) DO UPDATE SET c = table.c + excluded.c`,
+    so concurrent writers never lose increments and no read is needed.
+    Other databases fall back to UPDATE-then-INSERT, retrying the UPDATE
+    when a concurrent INSERT wins the race.
+
+    Rows are written in key order, so two transactions touching the same
+    keys lock them in the same order and cannot deadlock.
+
+    Args:
+        db: Database session (committed by the caller)
+        table: Target table
+        rows: Key values and deltas, one dict per row
+        key_columns: Columns of the unique key
+        counters: Columns incremented by the row's value
+        keep_latest: Columns keeping the later of the stored and the row's value (NULL never wins)
+        assign: Columns set to a fixed value on update (e.g. updated_at)
+        follow_latest: Columns taken from the row when its value of another (keep_latest)
+            column is not older than the stored one, e.g. {"title": "last_updated_at"}
+    """
+    if not rows:
+        return
+
+    rows = sorted(rows, key=lambda row: tuple(row[column] for column in key_columns))
+    assign = dict(assign or {})
+    if "updated_at" in table.c and "updated_at" not in assign:
+        assign["updated_at"] = datetime.utcnow()
+
+    dialect = db.get_bind().dialect.name
+    make_insert = ON_CONFLICT_INSERTS.get(dialect)
+    if make_insert is not None:
+        statement = make_insert(table)
+        excluded = statement.excluded
+        values = {column: table.c[column] + excluded[column] for column in counters}
+        values.update({column: _later(dialect, excluded[column], table.c[column]) for column in keep_latest})
+        values.update({
+            column: _if_not_older(excluded[column], table.c[column], excluded[timestamp], table.c[timestamp])
+            for column, timestamp in (follow_latest or {}).items()
+        })
+        values.update(assign)
+        db.execute(
+            statement.on_conflict_do_update(index_elements=[table.c[column] for column in key_columns], set_=values),
+            rows
+        )
+        return
+
+    values = {column: table.c[column] + bindparam(f"d_{column}") for column in counters}
+    values.update({
+        column: _if_not_older(bindparam(f"d_{column}"), table.c[column], bindparam(f"d_{column}"), table.c[column])
+        for column in keep_latest
+    })
+    values.update({
+        column: _if_not_older(
+            bindparam(f"d_{column}"), table.c[column], bindparam(f"d_{timestamp}"), table.c[timestamp]
+        )
+        for column, timestamp in (follow_latest or {}).items()
+    })
+    values.update(assign)
+    statement = update(table).where(
+        and_(*(table.c[column] == bindparam(f"d_{column}") for column in key_columns))
+    ).values(**values)
+
+    connection = db.connection()
+    for row in rows:
+        params = {f"d_{column}": value for column, value in row.items()}
+        if connection.execute(statement, params).rowcount:
+            continue
+        try:
+            with connection.begin_nested():
+                connection.execute(insert(table), row)
+        except IntegrityError:
+            # Another transaction inserted the row after our UPDATE missed it
+            connection.execute(statement, params)
+
+
+def _later(dialect: str, new, current):
+    # Batches can arrive out of order, so a later-processed batch must not move timestamps back
+    if dialect == "postgresql":
+        return func.greatest(new, current)  # ignores NULLs
+    return func.max(func.coalesce(new, current), func.coalesce(current, new))
+
+
+def _if_not_older(new, current, new_timestamp, current_timestamp):
+    # NULL never wins, neither as a value nor as its timestamp
+    return case(
+        (or_(current_timestamp.is_(None), new_timestamp >= current_timestamp), func.coalesce(new, current)),
+        else_=current
+    )
+
+
+def insert_new_rows(db: Session, table: Table, rows: List[dict], key_column: str = "event_id") -> Set:
+    """
+    Insert rows, skipping those whose unique key already exists
+
+    On PostgreSQL and SQLite this is one `INSERT ... ON CONFLICT DO NOTHING
+    RETURNING key`; elsewhere existing keys are looked up first. Rows with a
+    NULL key are always inserted.
+
+    Args:
+        db: Database session (committed by the caller)
+        table: Target table
+        rows: Rows to insert
+        key_column: Column with a unique constraint
+
+    Returns:
+        Keys of the rows that were inserted
+    """
+    if not rows:
+        return set()
+
+    make_insert = ON_CONFLICT_INSERTS.get(db.get_bind().dialect.name)
+    if make_insert is not None:
+        # No conflict target: any unique violation skips the row, whichever index reports it
+        statement = make_insert(table).on_conflict_do_nothing().returning(table.c[key_column])
+        return set(db.execute(statement, rows).scalars())
+
+    keys = [row[key_column] for row in rows if row[key_column] is not None]
+    existing = set(db.scalars(select(table.c[key_column]).where(table.c[key_column].in_(keys)))) if keys else set()
+    new_rows = [row for row in rows if row[key_column] not in existing]
+    if new_rows:
+        db.execute(insert(table), new_rows)
+    return {row[key_column] for row in new_rows}
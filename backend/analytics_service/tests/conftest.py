@@ -0,0 +1,31 @@
+"""
+Run the analytics service against a throwaway database and the in-memory broker
+
+The database is a fresh SQLite file unless TEST_DATABASE_URL points at
+another database (e.g. PostgreSQL, to test real row locking). Its tables
+are dropped and recreated for every test.
+
+Usage (from the analytics_service directory):
+    python -m pytest -q tests
+"""
+import os
+import sys
+import tempfile
+
+WORKDIR = tempfile.mkdtemp(prefix="analytics-tests-")
+os.environ["DATABASE_URL"] = os.getenv("TEST_DATABASE_URL", f"sqlite:///{os.path.join(WORKDIR, 'analytics.db')}")
+os.environ["RABBITMQ_URL"] = "memory://"
+os.environ["SPOOL_DIR"] = os.path.join(WORKDIR, "spool")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import pytest  # noqa: E402
+from app import database, models  # noqa: E402
+
+
+@pytest.fixture
+def analytics_db():
+    models.Base.metadata.drop_all(bind=database.engine)
+    models.Base.metadata.create_all(bind=database.engine)
+    yield database.engine
+    database.engine.dispose()
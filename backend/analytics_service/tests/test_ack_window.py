@@ -0,0 +1,84 @@
+"""
+Cumulative acks never settle a rejected delivery
+
+Consumers ack processed messages with one multi-message ack per window.
+A failed message flushes the window of successes before it and is then
+rejected on its own, so a later multi-ack must not cover it: the broker
+closes the channel (406) on an unknown delivery tag.
+"""
+from datetime import datetime
+from app.shared import memory_broker
+from app.shared.event_schemas import UserLoggedInEvent
+from app.shared.rabbitmq_client import AckWindow, RabbitMQClient
+
+QUEUE = "ack-window-test"
+
+
+def connect_with_queue(messages: int) -> RabbitMQClient:
+    memory_broker.reset_brokers()
+    client = RabbitMQClient()
+    client.connect()
+    client.channel.queue_declare(QUEUE, durable=True)
+    now = datetime.utcnow()
+    for user_id in range(1, messages + 1):
+        event = UserLoggedInEvent(user_id=user_id, username=f"user{user_id}", timestamp=now)
+        client.publish("", event, routing_key=QUEUE)
+    return client
+
+
+def test_window_with_interleaved_nacks():
+    client = connect_with_queue(10)
+    channel = client.channel
+    tags = [channel.basic_get(QUEUE)[0].delivery_tag for _ in range(10)]
+
+    window = AckWindow(channel, batch_size=3, interval=60)
+    for position, tag in enumerate(tags, start=1):
+        if position == 4:
+            window.nack(tag)
+        elif position == 9:
+            window.nack(tag, requeue=True)
+        else:
+            window.ack(tag)
+    window.flush()
+
+    assert channel.is_open
+    assert not channel._unacked
+    # Only the requeued delivery is back in the queue
+    assert len(memory_broker.get_broker().queues[QUEUE].messages) == 1
+    client.close()
+    memory_broker.reset_brokers()
+
+
+def test_window_flushes_when_due():
+    client = connect_with_queue(2)
+    channel = client.channel
+    window = AckWindow(channel, batch_size=100, interval=0)
+    window.ack(channel.basic_get(QUEUE)[0].delivery_tag)
+    window.ack(channel.basic_get(QUEUE)[0].delivery_tag)
+    assert len(channel._unacked) == 2
+    window.flush_if_due()
+    assert not channel._unacked and window.pending == 0
+    client.close()
+    memory_broker.reset_brokers()
+
+
+def test_consume_acks_around_failures():
+    client = connect_with_queue(20)
+    processed, failing = [], {3, 4, 10, 17}
+
+    def callback(event):
+        processed.append(event["user_id"])
+        if len(processed) == 20:
+            client.channel.stop_consuming()
+        if event["user_id"] in failing:
+            raise RuntimeError("event failed")
+
+    client.consume(QUEUE, callback, prefetch_count=5, ack_batch_size=3, ack_interval_ms=60000)
+
+    assert processed == list(range(1, 21))
+    assert client.channel.is_open
+    assert not client.channel._unacked
+    # Rejected without requeue: nothing redelivered
+    assert not memory_broker.get_broker().queues[QUEUE].messages
+    client.close()
+    memory_broker.reset_brokers()
@@ -0,0 +1,53 @@
+"""
+Active users are counted from the daily HyperLogLog sketches at any precision
+
+The sketches of a range of days are merged and counted; the merged
+sketch must keep the configured precision (HLL_PRECISION), not the
+default one.
+"""
+from datetime import datetime, timedelta
+import pytest
+from app import database
+from app.active_users import ActiveUsers
+from app.hyperloglog import HyperLogLog
+
+DAY = datetime(2026, 5, 4)
+
+
+@pytest.mark.parametrize("precision", [10, 12, 14])
+def test_active_users_at_precision(analytics_db, precision):
+    active_users = ActiveUsers(mode="hll", precision=precision)
+    rows = [
+        {"user_id": user_id, "timestamp": DAY - timedelta(days=user_id % 10) + timedelta(hours=1)}
+        for user_id in range(1, 2001)
+    ]
+    with database.SessionLocal() as db:
+        active_users.record(db, rows)
+        db.commit()
+
+        error = 4 * active_users.relative_error
+        daily = active_users.count(db, DAY, DAY)
+        weekly = active_users.count(db, DAY - timedelta(days=6), DAY)
+        assert abs(daily - 200) <= 200 * error
+        assert abs(weekly - 1400) <= 1400 * error
+        assert active_users.count(db, DAY + timedelta(days=1), DAY + timedelta(days=3)) == 0
+
+
+def test_exact_mode_counts_rollups(analytics_db):
+    from app.rollups import upsert_rollups
+
+    rows = [
+        {"user_id": user_id, "event_type": "user.logged_in", "timestamp": DAY + timedelta(minutes=user_id)}
+        for user_id in range(1, 51)
+    ]
+    with database.SessionLocal() as db:
+        upsert_rollups(db, rows)
+        db.commit()
+        assert ActiveUsers(mode="exact").counts(db, DAY) == {"daily": 50, "weekly": 50, "monthly": 50}
+
+
+def test_sketch_round_trip_keeps_precision():
+    sketch = HyperLogLog(12)
+    sketch.update(range(1000))
+    restored = HyperLogLog.from_bytes(sketch.to_bytes())
+    assert (restored.precision, restored.count()) == (12, sketch.count())
@@ -0,0 +1,176 @@
+"""
+Parallel consumers must count every event exactly once
+
+Several consumers process the same users' and notes' events at the same
+time, each batch in its own transaction, with part of the events
+delivered twice (to the same or to another consumer). Every consumer
+has its own dedupe cache, as separate worker processes do, so duplicates
+that reach different consumers are only stopped by the event_id unique
+constraint. The projections must come out exactly as if every event had
+been processed once.
+"""
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List
+from sqlalchemy import func, select
+from sqlalchemy.exc import DBAPIError
+from app import database, event_processor, models
+from app.dedupe import DedupeCache
+from app.shared.event_schemas import (
+    NoteCreatedEvent,
+    NoteDeletedEvent,
+    NoteUpdatedEvent,
+    UserLoggedInEvent,
+    UserRegisteredEvent,
+)
+
+CONSUMERS = 8
+USERS = 3
+NOTES_PER_USER = 10
+EDITS_PER_NOTE = 6
+LOGINS_PER_USER = 12
+BATCH_SIZE = 10
+# Share of the events delivered a second time
+REDELIVERED = 0.3
+# A failed batch is redelivered, up to this many times
+MAX_DELIVERIES = 50
+
+
+class PerConsumerCache:
+    """Dedupe cache private to each consumer thread, like each worker process has"""
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def _cache(self) -> DedupeCache:
+        if not hasattr(self._local, "cache"):
+            self._local.cache = DedupeCache()
+        return self._local.cache
+
+    def __contains__(self, event_id) -> bool:
+        return event_id in self._cache()
+
+    def add(self, event_ids):
+        self._cache().add(event_ids)
+
+
+def make_events(start: datetime):
+    user_events, note_events = [], []
+    for user_id in range(1, USERS + 1):
+        user_events.append(UserRegisteredEvent(
+            user_id=user_id, username=f"user{user_id}", email=f"user{user_id}@example.com", timestamp=start
+        ))
+        for login in range(LOGINS_PER_USER):
+            user_events.append(UserLoggedInEvent(
+                user_id=user_id, username=f"user{user_id}", timestamp=start + timedelta(minutes=login)
+            ))
+        for index in range(NOTES_PER_USER):
+            note_id = user_id * 1000 + index
+            created = start + timedelta(hours=index)
+            note_events.append(NoteCreatedEvent(note_id=note_id, user_id=user_id, title="v0", timestamp=created))
+            for edit in range(1, EDITS_PER_NOTE + 1):
+                note_events.append(NoteUpdatedEvent(
+                    note_id=note_id, user_id=user_id, title=f"v{edit}", timestamp=created + timedelta(minutes=edit)
+                ))
+            if index % 3 == 0:
+                note_events.append(NoteDeletedEvent(
+                    note_id=note_id, user_id=user_id, timestamp=created + timedelta(days=1)
+                ))
+    return user_events, note_events
+
+
+def deliveries(events: List, rng: random.Random) -> List[List[List[dict]]]:
+    """Shuffled batches per consumer, with some events delivered twice"""
+    messages = [event.model_dump(mode="json") for event in events]
+    messages += rng.sample(messages, int(len(messages) * REDELIVERED))
+    rng.shuffle(messages)
+    batches = [messages[i:i + BATCH_SIZE] for i in range(0, len(messages), BATCH_SIZE)]
+    return [batches[consumer::CONSUMERS] for consumer in range(CONSUMERS)]
+
+
+def consume(processor, process: str, batches: List[List[dict]], start: threading.Barrier, errors: list):
+    start.wait()
+    for batch in batches:
+        for delivery in range(MAX_DELIVERIES):
+            try:
+                getattr(processor, process)(batch)
+                break
+            except DBAPIError:
+                # Lock timeouts roll the batch back; the broker would redeliver it
+                time.sleep(0.01 * (delivery + 1))
+        else:
+            errors.append(batch)
+
+
+def expected_statistics(user_events, note_events) -> Dict[int, dict]:
+    expected = {}
+    for user_id in range(1, USERS + 1):
+        logins = [e.timestamp for e in user_events if e.user_id == user_id and e.event_type == "user.logged_in"]
+        notes = [e for e in note_events if e.user_id == user_id]
+        created = sum(e.event_type == "note.created" for e in notes)
+        deleted = sum(e.event_type == "note.deleted" for e in notes)
+        expected[user_id] = {
+            "total_notes": created - deleted,
+            "total_notes_created": created,
+            "total_notes_updated": sum(e.event_type == "note.updated" for e in notes),
+            "total_notes_deleted": deleted,
+            "total_logins": len(logins),
+            "last_login": max(logins),
+            "last_activity": max(e.timestamp for e in user_events + note_events if e.user_id == user_id),
+        }
+    return expected
+
+
+def test_parallel_consumers_count_every_event_once(analytics_db, monkeypatch):
+    monkeypatch.setattr(event_processor, "processed_events", PerConsumerCache())
+    rng = random.Random(37)
+    user_events, note_events = make_events(datetime(2026, 1, 5, 8, 0))
+
+    processor = event_processor.EventProcessor()
+    start = threading.Barrier(2 * CONSUMERS)
+    errors: list = []
+    threads = [
+        threading.Thread(target=consume, args=(processor, process, batches, start, errors))
+        for process, events in (("process_user_events", user_events), ("process_note_events", note_events))
+        for batches in deliveries(events, rng)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+
+    db = database.SessionLocal()
+    try:
+        # event_id dedupe: every event stored exactly once
+        for model, events in ((models.UserEvent, user_events), (models.NoteEvent, note_events)):
+            stored = db.execute(select(model.event_id, func.count()).group_by(model.event_id)).all()
+            assert {event_id: count for event_id, count in stored} == {event.event_id: 1 for event in events}
+
+        statistics = {row.user_id: row for row in db.scalars(select(models.UserStatistics))}
+        assert set(statistics) == set(range(1, USERS + 1))
+        for user_id, expected in expected_statistics(user_events, note_events).items():
+            row = statistics[user_id]
+            assert {column: getattr(row, column) for column in expected} == expected
+
+        notes = {row.note_id: row for row in db.scalars(select(models.NoteStatistics))}
+        assert len(notes) == USERS * NOTES_PER_USER
+        for note_id, row in notes.items():
+            events = [e for e in note_events if e.note_id == note_id]
+            created = next(e for e in events if e.event_type == "note.created")
+            last_edit = max((e for e in events if e.event_type == "note.updated"), key=lambda e: e.timestamp)
+            deleted = next((e.timestamp for e in events if e.event_type == "note.deleted"), None)
+            assert (row.user_id, row.edit_count, row.created_at, row.last_updated_at, row.deleted_at, row.title) == (
+                created.user_id, EDITS_PER_NOTE, created.timestamp, last_edit.timestamp, deleted, last_edit.title
+            )
+
+        totals = db.execute(select(
+            func.sum(models.SystemCounters.total_users),
+            func.sum(models.SystemCounters.total_notes_created),
+            func.sum(models.SystemCounters.total_logins),
+        )).one()
+        assert tuple(totals) == (USERS, USERS * NOTES_PER_USER, USERS * LOGINS_PER_USER)
+    finally:
+        db.close()
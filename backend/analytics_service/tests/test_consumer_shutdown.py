@@ -0,0 +1,115 @@
+"""
+Consumers settle every delivery exactly once, also when they stop
+
+A batch that fails is processed event by event, and deliveries that
+cannot be routed to a retry queue are nacked; the batch ack must then
+skip them, since acking a settled delivery is a channel error. On
+shutdown the partition workers stop consuming and ack what they were
+delivered instead of being killed mid-batch.
+"""
+import asyncio
+import time
+from datetime import datetime
+from app import partitions
+from app.async_consumer import AsyncEventConsumer
+from app.shared import memory_broker
+from app.shared.config import config
+from app.shared.event_schemas import UserLoggedInEvent
+from app.shared.rabbitmq_client import (
+    ANALYTICS_USERS_QUEUE,
+    USERS_EXCHANGE,
+    RabbitMQClient,
+    partition_queue_name,
+    setup_analytics_queues,
+)
+
+PARTITIONS = 4
+
+
+class FakeMessage:
+    """aio-pika message that, like aio-pika, refuses to be settled twice"""
+
+    def __init__(self, delivery_tag: int, settled: dict):
+        self.delivery_tag = delivery_tag
+        self.settled = settled
+        self.exchange = USERS_EXCHANGE
+        self.routing_key = "user.logged_in"
+        self.headers = {}
+        self.type = None
+        self.content_type = "application/json"
+
+    def _settle(self, how: str):
+        if self.delivery_tag in self.settled:
+            raise RuntimeError("Message already processed")
+        self.settled[self.delivery_tag] = how
+
+    async def ack(self, multiple: bool = False):
+        self._settle("ack")
+        if multiple:
+            for tag in range(1, self.delivery_tag):
+                self.settled.setdefault(tag, "ack")
+
+    async def nack(self, requeue: bool = True):
+        self._settle("nack")
+
+
+def test_async_flush_does_not_ack_rejected_deliveries(monkeypatch):
+    def fail_batch(events):
+        raise RuntimeError("batch failed")
+
+    def fail_event(event):
+        if event["user_id"] == 3:
+            raise RuntimeError("event failed")
+
+    consumer = AsyncEventConsumer(ANALYTICS_USERS_QUEUE, fail_batch, fail_event, batch_size=10)
+
+    async def unroutable(channel, message, encoded, error, retryable):
+        await message.nack(requeue=True)
+        return False
+
+    monkeypatch.setattr(consumer, "_route_failure", unroutable)
+    settled = {}
+    messages = [FakeMessage(tag, settled) for tag in range(1, 4)]
+    consumer._pending = [(message, None, [{"user_id": message.delivery_tag}]) for message in messages]
+
+    asyncio.run(consumer._flush(channel=None))
+    assert settled == {1: "ack", 2: "ack", 3: "nack"}
+    assert (consumer.processed, consumer.failed, consumer.batches) == (2, 1, 1)
+
+
+def test_pool_stop_drains_workers(analytics_db, monkeypatch):
+    memory_broker.reset_brokers()
+    monkeypatch.setattr(config, "ANALYTICS_PARTITIONS", PARTITIONS)
+    # Batches only fill on the timer, so stopping has to flush them
+    monkeypatch.setattr(config, "CONSUMER_BATCH_INTERVAL_MS", 60000)
+    setup_analytics_queues()
+
+    stored = []
+    monkeypatch.setattr(
+        "app.event_processor.EventProcessor.process_user_events", lambda self, events: stored.extend(events)
+    )
+    pool = partitions.PartitionedConsumerPool(workers=2, use_processes=False)
+    pool.start()
+
+    now = datetime.utcnow()
+    client = RabbitMQClient()
+    client.connect()
+    try:
+        for user_id in range(1, 41):
+            client.publish(USERS_EXCHANGE, UserLoggedInEvent(user_id=user_id, username=f"user{user_id}", timestamp=now))
+    finally:
+        client.close()
+
+    broker = memory_broker.get_broker()
+    queues = [broker.queues[partition_queue_name(ANALYTICS_USERS_QUEUE, p)] for p in range(PARTITIONS)]
+    deadline = time.monotonic() + 5
+    while any(queue.messages for queue in queues) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert not stored
+
+    pool.stop(timeout=5)
+    assert pool.state()["alive"] == 0
+    assert sorted(event["user_id"] for event in stored) == list(range(1, 41))
+    # Acked, not requeued by closing the channels
+    assert not any(queue.messages for queue in queues)
+    memory_broker.reset_brokers()
@@ -0,0 +1,79 @@
+"""
+Event history pages neither skip nor repeat events
+
+Pages are keyed by (timestamp, id), so events sharing a timestamp are
+split between pages by their ID, and events stored while a client pages
+through the history do not shift the pages that follow.
+"""
+import uuid
+from datetime import datetime, timedelta
+import pytest
+from fastapi import HTTPException, Response
+from sqlalchemy import insert
+from app import database, models
+from app.routers.analytics import _event_page
+
+START = datetime(2026, 10, 1, 12, 0)
+
+
+def store_logins(user_id: int, timestamps):
+    with database.SessionLocal() as db:
+        db.execute(insert(models.UserEvent), [
+            {
+                "event_id": str(uuid.uuid4()),
+                "event_type": "user.logged_in",
+                "user_id": user_id,
+                "username": f"user{user_id}",
+                "timestamp": timestamp,
+            }
+            for timestamp in timestamps
+        ])
+        db.commit()
+
+
+def all_pages(limit: int, between_pages=None) -> list:
+    events, before = [], None
+    with database.SessionLocal() as db:
+        while True:
+            response = Response()
+            page = _event_page(db, response, models.UserEvent, 1, limit, before, None, None, None)
+            events += [(event.timestamp, event.id) for event in page]
+            before = response.headers.get("X-Next-Cursor")
+            if before is None:
+                return events
+            if between_pages is not None:
+                between_pages()
+
+
+def test_pages_split_equal_timestamps(analytics_db):
+    # Five timestamps with five events each, interleaved with another user's events
+    for _ in range(5):
+        store_logins(1, [START + timedelta(minutes=minute) for minute in range(5)])
+        store_logins(2, [START + timedelta(minutes=minute) for minute in range(5)])
+    with database.SessionLocal() as db:
+        expected = [
+            (event.timestamp, event.id)
+            for event in db.query(models.UserEvent).filter(models.UserEvent.user_id == 1)
+            .order_by(models.UserEvent.timestamp.desc(), models.UserEvent.id.desc())
+        ]
+
+    for limit in (1, 3, 4, 7, 25, 30):
+        assert all_pages(limit) == expected
+
+
+def test_pages_are_stable_while_events_arrive(analytics_db):
+    store_logins(1, [START] * 6 + [START - timedelta(minutes=1)] * 6)
+    with database.SessionLocal() as db:
+        expected = [
+            (event.timestamp, event.id)
+            for event in db.query(models.UserEvent).order_by(models.UserEvent.timestamp.desc(), models.UserEvent.id.desc())
+        ]
+
+    # Newer events (some with the same timestamp as the first page) arrive after every page
+    assert all_pages(5, between_pages=lambda: store_logins(1, [START, START + timedelta(minutes=1)])) == expected
+
+
+def test_invalid_cursor_is_rejected(analytics_db):
+    with database.SessionLocal() as db, pytest.raises(HTTPException) as raised:
+        _event_page(db, Response(), models.UserEvent, 1, 10, "not-a-cursor", None, None, None)
+    assert raised.value.status_code == 400
@@ -0,0 +1,94 @@
+"""
+Leaderboards count keys approximately but never undercount them
+
+Each process keeps count-min sketches per leaderboard and window and
+checkpoints them under a replica-qualified owner; the served top lists
+add up the sketches of all processes. Estimates may only overcount, keys
+with many events must make the top list, and counts outside a window
+must fall out of it once their slice has expired.
+"""
+import time
+import numpy as np
+from app import database, leaderboard, models
+from app.leaderboard import CountMinSketch, Leaderboards, TopK, merge_top
+from app.shared.config import config
+
+HEAVY_KEYS = {7: 500, 11: 300, 13: 200}
+
+
+def heavy_and_noise(seed: int):
+    """Counts of a few heavy keys and many keys seen a few times"""
+    rng = np.random.default_rng(seed)
+    keys = np.concatenate([
+        np.repeat(list(HEAVY_KEYS), list(HEAVY_KEYS.values())),
+        rng.integers(1000, 100000, 5000),
+    ])
+    rng.shuffle(keys)
+    return keys.astype(np.int64)
+
+
+def test_sketch_never_undercounts():
+    keys = heavy_and_noise(1)
+    sketch = CountMinSketch()
+    sketch.add(keys, np.ones(len(keys), dtype=np.int64))
+
+    unique, exact = np.unique(keys, return_counts=True)
+    estimates = sketch.estimate(unique)
+    assert (estimates >= exact).all()
+    # Every event lands once in each row
+    assert (sketch.table.sum(axis=1) == len(keys)).all()
+    for key, count in HEAVY_KEYS.items():
+        assert sketch.estimate(np.array([key]))[0] < count * 1.2
+
+
+def test_merged_boards_find_heavy_keys():
+    now = int(time.time())
+    boards = []
+    for seed in (1, 2):
+        keys = heavy_and_noise(seed)
+        board = TopK()
+        board.add(keys, np.ones(len(keys), dtype=np.int64), np.full(len(keys), now), now)
+        boards.append(board)
+
+    top, events = merge_top(boards, k=3)
+    assert [key for key, _ in top] == list(HEAVY_KEYS)
+    assert all(count >= 2 * HEAVY_KEYS[key] for key, count in top)
+    assert events == sum(len(heavy_and_noise(seed)) for seed in (1, 2))
+
+
+def test_window_expires_old_slices():
+    window = leaderboard.WINDOWS["24h"]
+    now = int(time.time())
+    board = TopK(window)
+    keys = np.array([1, 2], dtype=np.int64)
+    counts = np.array([5, 3], dtype=np.int64)
+    board.add(keys, counts, np.array([now - 2 * 3600, now]), now)
+    # Older than the window: never counted
+    board.add(np.array([3]), np.array([9]), np.array([now - 3 * 86400]), now)
+    assert merge_top([board])[0] == [(1, 5), (2, 3)]
+
+    # A day later the slice of key 1 has ended before the window start
+    board.expire(now + 86400)
+    assert merge_top([board])[0] == [(2, 3)]
+    assert int(board.total.table[0].sum()) == 3
+
+
+def test_checkpoint_round_trip_with_replica_owner(analytics_db, monkeypatch):
+    # Hostnames (the default replica ID) may be 63 characters long
+    monkeypatch.setattr(config, "REPLICA_ID", "h" * 63)
+    owner = leaderboard.checkpoint_owner("worker-12")
+    assert len(owner) <= models.LeaderboardCheckpoint.__table__.c.owner.type.length
+
+    now = int(time.time())
+    boards = Leaderboards(owner)
+    keys = heavy_and_noise(3)
+    boards.add("events", keys, np.ones(len(keys), dtype=np.int64), np.full(len(keys), now))
+    with database.SessionLocal() as db:
+        boards.checkpoint(db)
+
+    restored = Leaderboards(owner)
+    with database.SessionLocal() as db:
+        restored.restore(db)
+    for window in leaderboard.WINDOWS:
+        assert merge_top([restored.boards[("events", window)]], k=3) == merge_top([boards.boards[("events", window)]], k=3)
+    assert merge_top([restored.boards[("events", "all")]], k=3)[0][0][0] == 7
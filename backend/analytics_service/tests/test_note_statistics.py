@@ -0,0 +1,84 @@
+"""
+Per-note statistics do not depend on how events arrive
+
+Batches are folded per note and applied with keep-latest timestamps and
+a title that follows the last change, so any split into batches, in any
+order, and redeliveries give the same rows as folding all events at
+once; the backfill of an empty table gives them too.
+"""
+import random
+from datetime import datetime, timedelta
+from sqlalchemy import delete, select, update
+from app import database, models
+from app.event_processor import EventProcessor
+from app.note_statistics import backfill_note_statistics, count_note_statistics
+from app.shared.event_schemas import NoteCreatedEvent, NoteDeletedEvent, NoteUpdatedEvent
+
+START = datetime(2026, 9, 1, 8, 0)
+NOTES = 6
+COLUMNS = ("user_id", "edit_count", "title", "created_at", "last_updated_at", "deleted_at")
+
+
+def make_events():
+    events = []
+    for note_id in range(1, NOTES + 1):
+        user_id = note_id % 3 + 1
+        created = START + timedelta(hours=note_id)
+        events.append(NoteCreatedEvent(note_id=note_id, user_id=user_id, title="v0", timestamp=created))
+        for edit in range(1, note_id + 1):
+            events.append(NoteUpdatedEvent(
+                note_id=note_id, user_id=user_id, title=f"v{edit}", timestamp=created + timedelta(minutes=edit)
+            ))
+        if note_id % 2 == 0:
+            events.append(NoteDeletedEvent(note_id=note_id, user_id=user_id, timestamp=created + timedelta(days=1)))
+    return [event.model_dump(mode="json") for event in events]
+
+
+def stored_statistics() -> dict:
+    with database.SessionLocal() as db:
+        return {
+            row.note_id: tuple(getattr(row, column) for column in COLUMNS)
+            for row in db.scalars(select(models.NoteStatistics))
+        }
+
+
+def expected_statistics(events) -> dict:
+    rows = [{**event, "timestamp": datetime.fromisoformat(event["timestamp"])} for event in events]
+    return {
+        note_id: tuple(delta[column] for column in COLUMNS)
+        for note_id, delta in count_note_statistics(rows).items()
+    }
+
+
+def test_batches_in_any_order_fold_the_same(analytics_db):
+    events = make_events()
+    expected = expected_statistics(events)
+    assert expected[4][1:3] == (4, "v4") and expected[4][5] is not None
+
+    shuffled = events[:]
+    random.Random(4050).shuffle(shuffled)
+    processor = EventProcessor()
+    for start in range(0, len(shuffled), 5):
+        processor.process_note_events(shuffled[start:start + 5])
+    # Redelivered batch (same event IDs)
+    processor.process_note_events(shuffled[:5])
+    assert stored_statistics() == expected
+
+
+def test_backfill_builds_empty_table_only(analytics_db):
+    events = make_events()
+    EventProcessor().process_note_events(events)
+    built = stored_statistics()
+
+    with database.SessionLocal() as db:
+        db.execute(delete(models.NoteStatistics))
+        db.commit()
+    backfill_note_statistics(database.engine, batch_size=4)
+    assert stored_statistics() == built == expected_statistics(events)
+
+    # Rows exist: nothing is recounted
+    with database.SessionLocal() as db:
+        db.execute(update(models.NoteStatistics).where(models.NoteStatistics.note_id == 1).values(edit_count=99))
+        db.commit()
+    backfill_note_statistics(database.engine)
+    assert stored_statistics()[1][1] == 99
@@ -0,0 +1,51 @@
+"""
+A batch envelope is routed like the events it carries
+
+Partitioned consumers route a whole envelope by its partition key, so
+an envelope may only hold events of one user; one that mixed users
+would reach a single partition without the per-user ordering.
+"""
+from datetime import datetime
+import pytest
+from app.shared import memory_broker
+from app.shared.config import config
+from app.shared.event_schemas import UserLoggedInEvent
+from app.shared.rabbitmq_client import (
+    ANALYTICS_USERS_QUEUE,
+    PARTITION_KEY_HEADER,
+    USERS_EXCHANGE,
+    RabbitMQClient,
+    partition_queue_name,
+    setup_analytics_queues,
+)
+
+PARTITIONS = 4
+
+
+def logins(*user_ids: int):
+    now = datetime.utcnow()
+    return [UserLoggedInEvent(user_id=user_id, username=f"user{user_id}", timestamp=now) for user_id in user_ids]
+
+
+def test_batch_keeps_one_partition_key(monkeypatch):
+    memory_broker.reset_brokers()
+    monkeypatch.setattr(config, "ANALYTICS_PARTITIONS", PARTITIONS)
+    setup_analytics_queues()
+
+    client = RabbitMQClient()
+    client.connect()
+    try:
+        with pytest.raises(ValueError):
+            client.publish_batch(USERS_EXCHANGE, logins(1, 2))
+        client.publish_batch(USERS_EXCHANGE, logins(5, 5, 5))
+        client.publish(USERS_EXCHANGE, logins(5)[0])
+    finally:
+        client.close()
+
+    broker = memory_broker.get_broker()
+    queues = [broker.queues[partition_queue_name(ANALYTICS_USERS_QUEUE, p)] for p in range(PARTITIONS)]
+    # Nothing of the rejected batch was published; the envelope went where user 5's events go
+    assert sorted(len(queue.messages) for queue in queues) == [0] * (PARTITIONS - 1) + [2]
+    for message in next(queue for queue in queues if queue.messages).messages:
+        assert message.properties.headers[PARTITION_KEY_HEADER] == "5"
+    memory_broker.reset_brokers()
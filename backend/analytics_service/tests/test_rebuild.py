@@ -0,0 +1,108 @@
+"""
+Rebuilding the projections after retention keeps the compacted history
+
+Retention deletes raw events once they are folded into the rollups, so a
+rebuild from the remaining events alone would lose lifetime counters,
+old rollup buckets and statistics of old notes. A rebuild after
+retention must reproduce the projections exactly, and the catch-up in
+the swap must never commit the swap transaction early.
+"""
+from datetime import datetime, timedelta
+from sqlalchemy import func, select
+from app import database, models, rebuild, retention
+from app.event_processor import EventProcessor
+from app.shared.config import config
+from app.shared.event_schemas import (
+    NoteCreatedEvent,
+    NoteDeletedEvent,
+    NoteUpdatedEvent,
+    UserLoggedInEvent,
+    UserRegisteredEvent,
+)
+
+NOW = datetime(2026, 10, 19, 12, 0)
+USERS = 4
+
+
+def make_events():
+    user_events, note_events = [], []
+    for user_id in range(1, USERS + 1):
+        registered = NOW - timedelta(days=400 + user_id)
+        user_events.append(UserRegisteredEvent(
+            user_id=user_id, username=f"user{user_id}", email=f"user{user_id}@example.com", timestamp=registered
+        ))
+        for days_ago in range(0, 400, 37):
+            user_events.append(UserLoggedInEvent(
+                user_id=user_id, username=f"user{user_id}", timestamp=NOW - timedelta(days=days_ago, hours=user_id)
+            ))
+        # A note that only lives in the compacted history, and one created then but edited since
+        old_note, edited_note = user_id * 10, user_id * 10 + 1
+        note_events += [
+            NoteCreatedEvent(note_id=old_note, user_id=user_id, title="old", timestamp=registered + timedelta(days=1)),
+            NoteUpdatedEvent(note_id=old_note, user_id=user_id, title="old 2", timestamp=registered + timedelta(days=2)),
+            NoteDeletedEvent(note_id=old_note, user_id=user_id, timestamp=registered + timedelta(days=3)),
+            NoteCreatedEvent(note_id=edited_note, user_id=user_id, title="v0", timestamp=registered + timedelta(days=4)),
+            NoteUpdatedEvent(note_id=edited_note, user_id=user_id, title="v1", timestamp=NOW - timedelta(days=3)),
+        ]
+    # Notes created and edited within the retained months
+    for note_id in range(100, 110):
+        created = NOW - timedelta(days=note_id - 90)
+        note_events += [
+            NoteCreatedEvent(note_id=note_id, user_id=note_id % USERS + 1, title="new", timestamp=created),
+            NoteUpdatedEvent(note_id=note_id, user_id=note_id % USERS + 1, title="new 2", timestamp=created + timedelta(hours=2)),
+        ]
+    return user_events, note_events
+
+
+def projections() -> dict:
+    with database.SessionLocal() as db:
+        def rows(table, skip=()):
+            columns = [column for column in table.columns if column.name not in skip]
+            return sorted(tuple(row) for row in db.execute(select(*columns)).all())
+
+        return {
+            "user_statistics": rows(models.UserStatistics.__table__, skip=("updated_at",)),
+            "user_event_rollups": rows(models.UserEventRollup.__table__),
+            "system_event_rollups": rows(models.SystemEventRollup.__table__),
+            "note_statistics": rows(models.NoteStatistics.__table__, skip=("updated_at",)),
+            "system_counters": db.execute(select(
+                *(func.sum(getattr(models.SystemCounters, column)) for column in rebuild.SYSTEM_COUNTERS)
+            )).one(),
+        }
+
+
+def test_rebuild_after_retention_keeps_history(analytics_db, monkeypatch):
+    processor = EventProcessor()
+    user_events, note_events = make_events()
+    processor.process_user_events([event.model_dump(mode="json") for event in user_events])
+    processor.process_note_events([event.model_dump(mode="json") for event in note_events])
+    before = projections()
+
+    monkeypatch.setattr(config, "EVENT_RETENTION_MONTHS", 6)
+    assert retention.apply_retention(database.engine, NOW) > 0
+    with database.SessionLocal() as db:
+        boundary = rebuild._history_boundary(db)
+    assert boundary > min(event.timestamp for event in user_events)
+
+    rebuild.rebuild(workers=1, chunks=2)
+    assert projections() == before
+
+
+def test_swap_catch_up_does_not_commit(analytics_db, monkeypatch):
+    processor = EventProcessor()
+    user_events, _ = make_events()
+    processor.process_user_events([event.model_dump(mode="json") for event in user_events])
+    for _, staging in rebuild.PROJECTIONS:
+        staging.drop(database.engine, checkfirst=True)
+        staging.create(database.engine)
+
+    # Every partition overflows the rollup buffer, which used to commit the writer
+    monkeypatch.setattr(rebuild, "ROLLUP_FLUSH_KEYS", 1)
+    with database.SessionLocal() as db:
+        folded = rebuild._fold_events(db, db, {model.__tablename__: [] for model in rebuild.EVENT_MODELS}, commit=False)
+        assert folded == len(user_events)
+        db.rollback()
+    with database.SessionLocal() as db:
+        assert db.scalar(select(func.count()).select_from(rebuild.STAGING["user_event_rollups"])) == 0
+    for _, staging in rebuild.PROJECTIONS:
+        staging.drop(database.engine, checkfirst=True)
@@ -0,0 +1,88 @@
+"""
+Retention removes old raw events without losing their counts
+
+Events older than EVENT_RETENTION_MONTHS whole months are folded into
+the rollups (adding whatever the rollups miss) and then deleted. Events
+that arrive late, already older than the cutoff, are counted when they
+are stored and removed by the next run; ingestion never creates
+partitions for them.
+"""
+from datetime import datetime, timedelta
+from sqlalchemy import delete, func, select
+from app import database, models, retention
+from app.event_processor import EventProcessor
+from app.shared.config import config
+from app.shared.event_schemas import UserLoggedInEvent
+
+NOW = datetime(2026, 10, 19, 12, 0)
+CUTOFF = datetime(2026, 7, 1)
+USERS = 3
+
+
+def logins(timestamps):
+    return [
+        UserLoggedInEvent(user_id=user_id, username=f"user{user_id}", timestamp=timestamp).model_dump(mode="json")
+        for timestamp in timestamps
+        for user_id in range(1, USERS + 1)
+    ]
+
+
+def daily_logins(before: datetime = None) -> int:
+    query = select(func.coalesce(func.sum(models.UserEventRollup.event_count), 0)).where(
+        models.UserEventRollup.granularity == "day", models.UserEventRollup.event_type == "user.logged_in"
+    )
+    if before is not None:
+        query = query.where(models.UserEventRollup.bucket_start < before)
+    with database.SessionLocal() as db:
+        return db.scalar(query)
+
+
+def raw_events() -> list:
+    with database.SessionLocal() as db:
+        return db.scalars(select(models.UserEvent.timestamp)).all()
+
+
+def total_logins() -> int:
+    with database.SessionLocal() as db:
+        return db.scalar(select(func.sum(models.UserStatistics.total_logins)))
+
+
+def test_retention_folds_then_deletes(analytics_db, monkeypatch):
+    monkeypatch.setattr(config, "EVENT_RETENTION_MONTHS", 3)
+    processor = EventProcessor()
+    # Twelve months back, one login per user a week apart
+    timestamps = [NOW - timedelta(weeks=week) for week in range(52)]
+    processor.process_user_events(logins(timestamps))
+    expired = sum(timestamp < CUTOFF for timestamp in timestamps) * USERS
+
+    # Rollups of the oldest month were never written (stored before rollups existed)
+    with database.SessionLocal() as db:
+        db.execute(delete(models.UserEventRollup).where(models.UserEventRollup.bucket_start < datetime(2025, 11, 1)))
+        db.commit()
+    assert daily_logins(before=CUTOFF) < expired
+
+    assert retention.apply_retention(database.engine, NOW) == expired
+    assert min(raw_events()) >= CUTOFF
+    assert daily_logins(before=CUTOFF) == expired
+    assert daily_logins() == len(timestamps) * USERS
+    # Nothing left to do
+    assert retention.apply_retention(database.engine, NOW) == 0
+
+
+def test_late_events_are_counted_and_expire(analytics_db, monkeypatch):
+    monkeypatch.setattr(config, "EVENT_RETENTION_MONTHS", 3)
+    processor = EventProcessor()
+    processor.process_user_events(logins([NOW - timedelta(days=1)]))
+    assert retention.apply_retention(database.engine, NOW) == 0
+
+    # Long after their month expired
+    processor.process_user_events(logins([CUTOFF - timedelta(days=40)]))
+    assert total_logins() == 2 * USERS
+    assert daily_logins(before=CUTOFF) == USERS
+
+    assert retention.apply_retention(database.engine, NOW) == USERS
+    assert min(raw_events()) >= CUTOFF
+    assert total_logins() == 2 * USERS
+    assert daily_logins(before=CUTOFF) == USERS
+    # No partitions outside PostgreSQL
+    retention.event_partitions.create_ahead(NOW)
@@ -0,0 +1,117 @@
+"""
+Failed events go through the retry tiers to the dead-letter queue, and back
+
+A failing event is moved to the next delayed retry queue, which returns
+it to the consumer queue after its TTL; once the tiers are exhausted, or
+straight away when retrying cannot help, it lands in the dead-letter
+queue. `dlq replay` moves dead-lettered events back, optionally only
+those of one event type, and leaves the rest in place.
+"""
+import argparse
+from collections import Counter
+from datetime import datetime
+import pika
+from app import dlq
+from app.shared import memory_broker
+from app.shared.codec import decode_body
+from app.shared.config import config
+from app.shared.event_schemas import UserLoggedInEvent, UserRegisteredEvent
+from app.shared.rabbitmq_client import (
+    ANALYTICS_USERS_QUEUE,
+    USERS_EXCHANGE,
+    RabbitMQClient,
+    dead_letter_queue_name,
+    failure_destination,
+    retry_queue_name,
+    setup_analytics_queues,
+)
+
+TIERS_MS = [20, 40]
+
+
+def test_failure_destination_walks_the_tiers(monkeypatch):
+    monkeypatch.setattr(config, "CONSUMER_RETRY_TIERS_MS", TIERS_MS)
+    error = RuntimeError("boom")
+    headers = None
+    targets = []
+    for _ in range(3):
+        target, headers = failure_destination("q", USERS_EXCHANGE, "user.logged_in", headers, error, retryable=True)
+        targets.append(target)
+    assert targets == [retry_queue_name("q", 20), retry_queue_name("q", 40), dead_letter_queue_name("q")]
+    assert headers["x-retry-count"] == 2
+    assert headers["x-original-routing-key"] == "user.logged_in"
+    assert headers["x-last-error"] == "RuntimeError: boom"
+
+    target, headers = failure_destination("q", USERS_EXCHANGE, "user.logged_in", None, error, retryable=False)
+    assert target == dead_letter_queue_name("q") and "x-retry-count" not in headers
+
+
+def test_failing_event_is_retried_then_dead_lettered(monkeypatch):
+    memory_broker.reset_brokers()
+    monkeypatch.setattr(config, "ANALYTICS_PARTITIONS", 1)
+    monkeypatch.setattr(config, "CONSUMER_RETRY_TIERS_MS", TIERS_MS)
+    setup_analytics_queues()
+
+    client = RabbitMQClient()
+    client.connect()
+    now = datetime.utcnow()
+    for user_id in (1, 2, 3):
+        client.publish(USERS_EXCHANGE, UserLoggedInEvent(user_id=user_id, username=f"user{user_id}", timestamp=now))
+
+    attempts = Counter()
+
+    def callback(event):
+        attempts[event["user_id"]] += 1
+        if event["user_id"] == 2:
+            if attempts[2] == len(TIERS_MS) + 1:
+                client.channel.stop_consuming()
+            raise RuntimeError("always fails")
+
+    client.consume(ANALYTICS_USERS_QUEUE, callback, ack_interval_ms=10, retry=True)
+    client.close()
+
+    assert attempts == {1: 1, 2: len(TIERS_MS) + 1, 3: 1}
+    broker = memory_broker.get_broker()
+    (dead,) = broker.queues[dead_letter_queue_name(ANALYTICS_USERS_QUEUE)].messages
+    assert dead.properties.headers["x-retry-count"] == len(TIERS_MS)
+    assert decode_body(dead.body, dead.properties.content_type, dead.properties.content_encoding)["user_id"] == 2
+    assert not broker.queues[ANALYTICS_USERS_QUEUE].messages
+    memory_broker.reset_brokers()
+
+
+def test_replay_selects_event_type(monkeypatch):
+    memory_broker.reset_brokers()
+    monkeypatch.setattr(config, "ANALYTICS_PARTITIONS", 1)
+    setup_analytics_queues()
+
+    client = RabbitMQClient()
+    client.connect()
+    now = datetime.utcnow()
+    dead_letters = dead_letter_queue_name(ANALYTICS_USERS_QUEUE)
+    events = [
+        UserLoggedInEvent(user_id=1, username="user1", timestamp=now),
+        UserRegisteredEvent(user_id=2, username="user2", email="user2@example.com", timestamp=now),
+        UserLoggedInEvent(user_id=3, username="user3", timestamp=now),
+    ]
+    for event in events:
+        client.channel.basic_publish(
+            exchange="",
+            routing_key=dead_letters,
+            body=event.model_dump_json().encode(),
+            properties=pika.BasicProperties(
+                content_type="application/json", headers={"x-retry-count": 3, "x-last-error": "RuntimeError: boom"}
+            )
+        )
+
+    dlq.replay(client, argparse.Namespace(queue="users", limit=None, event_type="user.registered"))
+    client.close()
+
+    broker = memory_broker.get_broker()
+    (replayed,) = broker.queues[ANALYTICS_USERS_QUEUE].messages
+    assert decode_body(replayed.body, replayed.properties.content_type, None)["user_id"] == 2
+    assert "x-retry-count" not in replayed.properties.headers and "x-replayed-at" in replayed.properties.headers
+    remaining = [
+        decode_body(message.body, "application/json", None)["user_id"] for message in broker.queues[dead_letters].messages
+    ]
+    assert sorted(remaining) == [1, 3]
+    memory_broker.reset_brokers()
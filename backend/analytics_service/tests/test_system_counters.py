@@ -0,0 +1,63 @@
+"""
+total_users means the same whichever way the system counters are computed
+
+Live ingestion, the backfill of an empty counters table and a rebuild
+from the event log must all count registered users: users seen only in
+other events do not count, and a user registered twice counts once.
+"""
+from datetime import datetime, timedelta
+from sqlalchemy import delete, func, select
+from app import database, models, rebuild
+from app.event_processor import EventProcessor, new_delta, upsert_statistics
+from app.shared.event_schemas import NoteCreatedEvent, UserLoggedInEvent, UserRegisteredEvent
+from app.system_stats import backfill_system_counters, upsert_system_counters
+
+REGISTERED_USERS = 3
+
+
+def total_users() -> int:
+    with database.SessionLocal() as db:
+        return db.scalar(select(func.coalesce(func.sum(models.SystemCounters.total_users), 0)))
+
+
+def test_total_users_has_one_definition(analytics_db):
+    start = datetime(2026, 3, 2, 9, 0)
+    processor = EventProcessor()
+    registrations = [
+        UserRegisteredEvent(user_id=user_id, username=f"user{user_id}", email=f"user{user_id}@example.com", timestamp=start)
+        for user_id in range(1, REGISTERED_USERS + 1)
+    ]
+    processor.process_user_events([event.model_dump(mode="json") for event in registrations])
+    processor.process_user_events([
+        # A second registration of user 1 (a new event ID), and a user whose registration was never seen
+        UserRegisteredEvent(
+            user_id=1, username="user1", email="user1@example.com", timestamp=start + timedelta(hours=1)
+        ).model_dump(mode="json"),
+        UserLoggedInEvent(user_id=9, username="user9", timestamp=start).model_dump(mode="json"),
+    ])
+    processor.process_note_events([
+        NoteCreatedEvent(note_id=1, user_id=8, title="note", timestamp=start).model_dump(mode="json")
+    ])
+    assert total_users() == REGISTERED_USERS
+
+    with database.SessionLocal() as db:
+        db.execute(delete(models.SystemCounters))
+        db.commit()
+    backfill_system_counters(database.engine)
+    assert total_users() == REGISTERED_USERS
+
+    rebuild.rebuild(workers=1, chunks=1)
+    assert total_users() == REGISTERED_USERS
+
+
+def test_registration_is_claimed_once(analytics_db):
+    # Two batches registering the same user, the second one before the first's
+    # statistics were applied: reading registered_at first counted the user twice
+    registered_at = datetime(2026, 3, 2, 9, 0)
+    deltas = {5: {**new_delta(), "registered_at": registered_at}}
+    with database.SessionLocal() as db:
+        upsert_system_counters(db, deltas)
+        upsert_system_counters(db, deltas)
+        upsert_statistics(db, deltas)
+        db.commit()
+    assert total_users() == 1
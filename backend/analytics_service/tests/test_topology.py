@@ -0,0 +1,54 @@
+"""
+Producers must not change how the analytics queues are bound
+
+The users and notes services declare their exchanges on every start,
+with their own (default, unpartitioned) settings. In partitioned mode the
+analytics base queues must still get no topic bindings afterwards, or
+every event would also reach the base queue, outside the partitions'
+single-active-consumer ordering, and be counted twice.
+"""
+from datetime import datetime
+from app.shared import memory_broker
+from app.shared.config import config
+from app.shared.event_schemas import NoteCreatedEvent, UserLoggedInEvent
+from app.shared.rabbitmq_client import (
+    ANALYTICS_NOTES_QUEUE,
+    ANALYTICS_USERS_QUEUE,
+    NOTES_EXCHANGE,
+    USERS_EXCHANGE,
+    RabbitMQClient,
+    partition_queue_name,
+    setup_analytics_queues,
+    setup_rabbitmq_infrastructure,
+)
+
+PARTITIONS = 4
+
+
+def test_producer_setup_keeps_base_queues_unbound_when_partitioned(monkeypatch):
+    memory_broker.reset_brokers()
+    monkeypatch.setattr(config, "ANALYTICS_PARTITIONS", PARTITIONS)
+    setup_analytics_queues()
+
+    monkeypatch.setattr(config, "ANALYTICS_PARTITIONS", 1)
+    setup_rabbitmq_infrastructure()
+
+    broker = memory_broker.get_broker()
+    for exchange in (USERS_EXCHANGE, NOTES_EXCHANGE):
+        assert broker.exchanges[exchange].bindings == []
+
+    now = datetime.utcnow()
+    client = RabbitMQClient()
+    client.connect()
+    try:
+        for user_id in range(1, 21):
+            client.publish(USERS_EXCHANGE, UserLoggedInEvent(user_id=user_id, username=f"user{user_id}", timestamp=now))
+            client.publish(NOTES_EXCHANGE, NoteCreatedEvent(note_id=user_id, user_id=user_id, title="note", timestamp=now))
+    finally:
+        client.close()
+
+    for queue in (ANALYTICS_USERS_QUEUE, ANALYTICS_NOTES_QUEUE):
+        assert len(broker.queues[queue].messages) == 0
+        partitioned = sum(len(broker.queues[partition_queue_name(queue, p)].messages) for p in range(PARTITIONS))
+        assert partitioned == 20
+    memory_broker.reset_brokers()
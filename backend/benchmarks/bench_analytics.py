@@ -0,0 +1,179 @@
+"""
+Benchmark the NumPy cohort/distribution queries against the equivalent ORM loops
+
+Seeds a SQLite database with user statistics, daily user rollups and hourly
+system rollups for many users, then answers the admin questions (weekly
+retention cohorts, notes-per-user histogram and percentiles, activity by
+hour of day) twice: by iterating over ORM objects in Python, and with
+analytics_queries over a columnar snapshot. Both must give the same
+answers; the snapshot load and the queries over it are timed separately,
+since the load is amortized over all requests until the next refresh.
+
+Usage (from the backend directory):
+    python benchmarks/bench_analytics.py [--users 20000] [--weeks 26] [--repeat 3]
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+WORKDIR = tempfile.mkdtemp(prefix="bench-analytics-")
+os.environ["RABBITMQ_URL"] = "memory://"
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(WORKDIR, 'analytics.db')}")
+os.environ["SPOOL_DIR"] = os.path.join(WORKDIR, "spool")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "analytics_service"))
+
+from app import database, models  # noqa: E402
+from app.analytics_queries import (  # noqa: E402
+    AnalyticsSnapshot,
+    activity_by_hour,
+    histogram,
+    percentiles,
+    retention_cohorts,
+)
+
+COHORTS = 12
+COHORT_WEEKS = 8
+BINS = 20
+EVENT_TYPES = ("note.created", "note.updated", "note.deleted", "user.logged_in")
+
+
+def seed(users: int, weeks: int, now: datetime):
+    rng = random.Random(42)
+    first_day = (now - timedelta(weeks=weeks)).replace(hour=0, minute=0, second=0, microsecond=0)
+    days = (now - first_day).days + 1
+    statistics, user_days, hourly = [], [], defaultdict(int)
+    for user_id in range(1, users + 1):
+        registered = first_day + timedelta(seconds=rng.randrange(days * 86400))
+        notes = int(rng.expovariate(1 / 15))
+        statistics.append({
+            "user_id": user_id, "total_notes": notes, "total_notes_created": notes + rng.randrange(5),
+            "total_notes_updated": rng.randrange(100), "total_notes_deleted": rng.randrange(5),
+            "total_logins": rng.randrange(50), "registered_at": registered, "last_activity": registered,
+        })
+        # Activity decays with time since registration
+        day = registered.replace(hour=0, minute=0, second=0)
+        while day <= now:
+            user_days.append({
+                "user_id": user_id, "granularity": "day", "bucket_start": day,
+                "event_type": rng.choice(EVENT_TYPES), "event_count": rng.randrange(1, 10),
+            })
+            day += timedelta(days=1 + int(rng.expovariate(1 / 4)))
+    for hour in range(days * 24):
+        for event_type in EVENT_TYPES:
+            hourly[(first_day + timedelta(hours=hour), event_type)] = rng.randrange(1000)
+
+    models.Base.metadata.create_all(bind=database.engine)
+    with database.engine.begin() as connection:
+        connection.execute(models.UserStatistics.__table__.insert(), statistics)
+        connection.execute(models.UserEventRollup.__table__.insert(), user_days)
+        connection.execute(models.SystemEventRollup.__table__.insert(), [
+            {"granularity": "hour", "bucket_start": start, "event_type": event_type, "event_count": count}
+            for (start, event_type), count in hourly.items()
+        ])
+    return len(user_days)
+
+
+def _week_start(day: datetime) -> datetime:
+    day = day.replace(hour=0, minute=0, second=0, microsecond=0)
+    return day - timedelta(days=day.weekday())
+
+
+def orm_queries(db, now: datetime):
+    """The same answers computed row by row over ORM objects"""
+    users = db.query(models.UserStatistics).all()
+    registered = {user.user_id: _week_start(user.registered_at) for user in users if user.registered_at}
+
+    current_week = _week_start(now)
+    first_week = current_week - timedelta(weeks=COHORTS - 1)
+    sizes, active = defaultdict(int), defaultdict(set)
+    for week in registered.values():
+        if first_week <= week <= current_week:
+            sizes[week] += 1
+    for rollup in db.query(models.UserEventRollup).filter(models.UserEventRollup.granularity == "day"):
+        week = registered.get(rollup.user_id)
+        if week is None or week < first_week:
+            continue
+        offset = (_week_start(rollup.bucket_start) - week).days // 7
+        if 0 <= offset < COHORT_WEEKS:
+            active[(week, offset)].add(rollup.user_id)
+    cohorts = []
+    for index in range(COHORTS):
+        week = first_week + timedelta(weeks=index)
+        observed = min(COHORT_WEEKS, COHORTS - index)
+        cohorts.append((week, sizes[week], [len(active[(week, offset)]) for offset in range(observed)]))
+
+    notes = sorted(user.total_notes for user in users)
+    low, high = notes[0], notes[-1]
+    width = max(1, -(-(high - low + 1) // BINS))
+    buckets = defaultdict(int)
+    for value in notes:
+        buckets[(value - low) // width] += 1
+    counts = [buckets[index] for index in range(-(-(high - low + 1) // width))]
+    median = notes[(len(notes) - 1) // 2] if len(notes) % 2 else (notes[len(notes) // 2 - 1] + notes[len(notes) // 2]) / 2
+
+    by_hour = [0] * 24
+    for rollup in db.query(models.SystemEventRollup).filter(models.SystemEventRollup.granularity == "hour"):
+        by_hour[rollup.bucket_start.hour] += rollup.event_count
+    return cohorts, counts, median, by_hour
+
+
+def numpy_queries(arrays, now: datetime):
+    statistics, active_days, hourly = arrays["statistics"], arrays["active_days"], arrays["hourly"]
+    cohorts = retention_cohorts(
+        statistics["user_id"], statistics["registered_at"], active_days["user_id"], active_days["day"],
+        COHORTS, COHORT_WEEKS, now=now
+    )
+    notes = statistics["total_notes"]
+    return (
+        [(cohort["week_start"], cohort["users"], cohort["active"]) for cohort in cohorts],
+        [bucket["count"] for bucket in histogram(notes, BINS)],
+        percentiles(notes)["p50"],
+        activity_by_hour(hourly["hour"], hourly["event_count"]),
+    )
+
+
+def best_of(repeat: int, function, *args):
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function(*args)
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--weeks", type=int, default=26)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    now = datetime.utcnow()
+    user_days = seed(args.users, args.weeks, now)
+    print(f"{args.users} users, {user_days} active user-days over {args.weeks} weeks")
+
+    db = database.SessionLocal()
+    snapshot = AnalyticsSnapshot()
+    orm_seconds, expected = best_of(args.repeat, orm_queries, db, now)
+    load_seconds, arrays = best_of(args.repeat, snapshot.load, db)
+    query_seconds, result = best_of(args.repeat, numpy_queries, arrays, now)
+    db.close()
+
+    print(f"ORM loop            {orm_seconds * 1000:10.1f} ms")
+    print(f"NumPy load          {load_seconds * 1000:10.1f} ms   (once per refresh)")
+    print(f"NumPy queries       {query_seconds * 1000:10.1f} ms   x{orm_seconds / query_seconds:.0f} faster than the ORM loop")
+    print(f"NumPy load+queries  {(load_seconds + query_seconds) * 1000:10.1f} ms   "
+          f"x{orm_seconds / (load_seconds + query_seconds):.1f}")
+    print("results match" if result == expected else "RESULTS DIFFER")
+
+
+if __name__ == "__main__":
+    main()
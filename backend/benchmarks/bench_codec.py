@@ -0,0 +1,95 @@
+"""
+Benchmark event encodings: encode/decode cost and bytes per event
+
+Usage (from the backend directory):
+    python benchmarks/bench_codec.py [--events 100000]
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "notes_service"))
+
+from app.shared.codec import (  # noqa: E402
+    CONTENT_TYPE_JSON,
+    CONTENT_TYPE_MSGPACK,
+    decode_body,
+    encode_event,
+    encode_payload,
+    msgpack,
+)
+from app.shared.event_schemas import NoteUpdatedEvent  # noqa: E402
+
+
+def make_events(count: int):
+    now = datetime.utcnow()
+    return [
+        NoteUpdatedEvent(note_id=i, user_id=i % 1000, title=f"Note title {i}", timestamp=now)
+        for i in range(count)
+    ]
+
+
+def bench_single(events, content_type: str):
+    started = time.perf_counter()
+    encoded = [encode_event(event, content_type) for event in events]
+    encode_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for message in encoded:
+        decode_body(message.body, message.content_type, message.content_encoding)
+    decode_seconds = time.perf_counter() - started
+
+    total_bytes = sum(len(message.body) for message in encoded)
+    return encode_seconds, decode_seconds, total_bytes
+
+
+def bench_batch(events, content_type: str, compression: str, batch_size: int):
+    payloads = [event.model_dump(mode="json") for event in events]
+    batches = [payloads[i:i + batch_size] for i in range(0, len(payloads), batch_size)]
+
+    started = time.perf_counter()
+    encoded = [encode_payload(batch, content_type, compression) for batch in batches]
+    encode_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for message in encoded:
+        decode_body(message.body, message.content_type, message.content_encoding)
+    decode_seconds = time.perf_counter() - started
+
+    total_bytes = sum(len(message.body) for message in encoded)
+    return encode_seconds, decode_seconds, total_bytes
+
+
+def report(label: str, count: int, result):
+    encode_seconds, decode_seconds, total_bytes = result
+    print(
+        f"{label:<36} encode {encode_seconds / count * 1e6:7.2f} us/event   "
+        f"decode {decode_seconds / count * 1e6:7.2f} us/event   "
+        f"{total_bytes / count:7.1f} bytes/event"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--events", type=int, default=100000)
+    parser.add_argument("--batch-size", type=int, default=100)
+    args = parser.parse_args()
+
+    events = make_events(args.events)
+    content_types = [CONTENT_TYPE_JSON] + ([CONTENT_TYPE_MSGPACK] if msgpack is not None else [])
+
+    for content_type in content_types:
+        report(f"single {content_type}", args.events, bench_single(events, content_type))
+    for content_type in content_types:
+        for compression in ("none", "zlib"):
+            report(
+                f"batch/{args.batch_size} {content_type} {compression}",
+                args.events,
+                bench_batch(events, content_type, compression, args.batch_size)
+            )
+
+
+if __name__ == "__main__":
+    main()
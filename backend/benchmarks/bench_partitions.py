@@ -0,0 +1,145 @@
+"""
+Benchmark ingestion throughput of partitioned consumers by worker count
+
+Each worker count runs in a fresh subprocess: events for many users are
+published to the notes exchange, spread over ANALYTICS_PARTITIONS partition
+queues and stored by a PartitionedConsumerPool. Per-user ordering is checked
+afterwards (note IDs of a user must be stored in publish order).
+
+By default everything runs in-process (RABBITMQ_URL=memory://, workers are
+threads, SQLite), which exercises routing and ordering but cannot scale:
+SQLite serializes writes and threads share the GIL. For scaling numbers set
+RABBITMQ_URL (with the rabbitmq_consistent_hash_exchange plugin) and
+DATABASE_URL (PostgreSQL); workers are then processes.
+
+Usage (from the backend directory):
+    python benchmarks/bench_partitions.py [--workers 1,2,4] [--partitions 8] [--events 20000]
+"""
+import argparse
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ANALYTICS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "analytics_service")
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix="bench-partitions-")
+    os.environ.setdefault("RABBITMQ_URL", "memory://")
+    os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(workdir, 'analytics.db')}")
+    os.environ["SPOOL_DIR"] = os.path.join(workdir, "spool")
+    os.environ["ANALYTICS_PARTITIONS"] = str(args.partitions)
+    os.environ["ANALYTICS_STANDBY_DELAY_SECONDS"] = str(args.standby_delay)
+    sys.path.insert(0, ANALYTICS_DIR)
+
+    from app import database, models
+    from app.partitions import PartitionedConsumerPool
+    from app.shared.event_schemas import NoteCreatedEvent
+    from app.shared.publisher import BackgroundPublisher
+    from app.shared.rabbitmq_client import (
+        ANALYTICS_NOTES_QUEUE,
+        ANALYTICS_USERS_QUEUE,
+        NOTES_EXCHANGE,
+        RabbitMQClient,
+        consumer_queue_names,
+        setup_analytics_queues,
+    )
+
+    logging.disable(logging.WARNING)
+    models.Base.metadata.create_all(bind=database.engine)
+    db = database.SessionLocal()
+    for model in (models.NoteEvent, models.UserEvent, models.UserStatistics):
+        db.query(model).delete()
+    db.commit()
+    db.close()
+
+    setup_analytics_queues()
+    client = RabbitMQClient()
+    client.connect()
+    for queue_name in consumer_queue_names(ANALYTICS_USERS_QUEUE) + consumer_queue_names(ANALYTICS_NOTES_QUEUE):
+        client.channel.queue_purge(queue=queue_name)
+    client.close()
+
+    pool = PartitionedConsumerPool(workers=args.run)
+    pool.start()
+    # Let home workers take their partitions before standbys subscribe
+    time.sleep(args.standby_delay + 1)
+
+    now = datetime.utcnow()
+    events = [
+        NoteCreatedEvent(note_id=i, user_id=i % args.users, title=f"Note {i}", timestamp=now)
+        for i in range(args.events)
+    ]
+    publisher = BackgroundPublisher(envelopes=True)
+    started = time.perf_counter()
+    for event in events:
+        publisher.publish(NOTES_EXCHANGE, event)
+
+    deadline = time.monotonic() + args.timeout
+    processed = 0
+    while processed < args.events and time.monotonic() < deadline:
+        time.sleep(0.05)
+        db = database.SessionLocal()
+        processed = db.query(models.NoteEvent).count()
+        db.close()
+    seconds = time.perf_counter() - started
+
+    db = database.SessionLocal()
+    last_note = {}
+    violations = 0
+    for user_id, note_id in db.query(models.NoteEvent.user_id, models.NoteEvent.note_id).order_by(models.NoteEvent.id):
+        if note_id < last_note.get(user_id, -1):
+            violations += 1
+        last_note[user_id] = note_id
+    db.close()
+
+    print(f"RESULT {processed} {seconds:.3f} {violations} {pool.state()['mode']}", flush=True)
+    publisher.close()
+    pool.stop()
+    os._exit(0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workers", default="1,2,4")
+    parser.add_argument("--partitions", type=int, default=8)
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--standby-delay", type=float, default=2.0)
+    parser.add_argument("--timeout", type=float, default=300.0)
+    parser.add_argument("--run", type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run is not None:
+        run(args)
+        return
+
+    baseline = None
+    print(f"{args.events} events, {args.users} users, {args.partitions} partitions")
+    for workers in [int(count) for count in args.workers.split(",")]:
+        command = [
+            sys.executable, os.path.abspath(__file__), "--run", str(workers),
+            "--partitions", str(args.partitions), "--events", str(args.events), "--users", str(args.users),
+            "--standby-delay", str(args.standby_delay), "--timeout", str(args.timeout),
+        ]
+        output = subprocess.run(command, capture_output=True, text=True).stdout
+        result = [line for line in output.splitlines() if line.startswith("RESULT")]
+        if not result:
+            print(f"workers={workers}: run failed")
+            continue
+
+        processed, seconds, violations, mode = result[0].split()[1:]
+        rate = int(processed) / float(seconds)
+        baseline = baseline or rate
+        print(
+            f"workers={workers:<3} ({mode:<9}) {rate:10.0f} events/s   x{rate / baseline:4.2f}   "
+            f"{processed}/{args.events} processed, {violations} ordering violations"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+Benchmark the notes -> analytics event pipeline in a single process
+
+Events are published with the shared publisher, routed by the in-memory
+broker (RABBITMQ_URL=memory://) and stored by the analytics EventProcessor
+in a SQLite database, so no services need to be running.
+
+Usage (from the backend directory):
+    python benchmarks/bench_pipeline.py [--events 20000] [--publisher background] [--envelopes] [--batch-size 1000]
+
+Envelopes only hold events of one user, and a user's events can only share
+an envelope when they fall into the same publisher batch, so envelopes need
+batches larger than the number of users whose events are interleaved: with
+the defaults (100 users, PUBLISHER_BATCH_SIZE=100) almost every envelope
+holds a single event and is published as a plain message.
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+WORKDIR = tempfile.mkdtemp(prefix="bench-pipeline-")
+os.environ["RABBITMQ_URL"] = "memory://"
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(WORKDIR, 'analytics.db')}")
+os.environ["SPOOL_DIR"] = os.path.join(WORKDIR, "spool")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "analytics_service"))
+
+from app import database, models  # noqa: E402
+from app.event_processor import EventProcessor  # noqa: E402
+from app.shared.event_schemas import NoteCreatedEvent, NoteUpdatedEvent  # noqa: E402
+from app.shared.publisher import BackgroundPublisher  # noqa: E402
+from app.shared.rabbitmq_client import NOTES_EXCHANGE, RabbitMQClient, setup_analytics_queues  # noqa: E402
+
+
+def make_events(count: int, users: int):
+    now = datetime.utcnow()
+    events = []
+    for i in range(count):
+        # Every note is created once and then updated, like an editing session
+        if i % 4 == 0:
+            events.append(NoteCreatedEvent(note_id=i, user_id=i % users, title=f"Note {i}", timestamp=now))
+        else:
+            events.append(NoteUpdatedEvent(note_id=i - i % 4, user_id=i % users, title=f"Note {i}", timestamp=now))
+    return events
+
+
+def seed_users(users: int):
+    # Benchmark the steady state: every user already has a statistics row
+    db = database.SessionLocal()
+    try:
+        db.add_all(
+            models.UserStatistics(
+                user_id=user_id,
+                total_notes=0,
+                total_notes_created=0,
+                total_notes_updated=0,
+                total_notes_deleted=0,
+                total_logins=0
+            )
+            for user_id in range(users)
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+def processed_events() -> int:
+    db = database.SessionLocal()
+    try:
+        return db.query(models.NoteEvent).count()
+    finally:
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--publisher", choices=["sync", "background"], default="background")
+    parser.add_argument("--envelopes", action="store_true")
+    parser.add_argument("--batch-size", type=int, default=None, help="publisher batch size (default PUBLISHER_BATCH_SIZE)")
+    parser.add_argument("--timeout", type=float, default=300.0)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    for name in list(logging.root.manager.loggerDict):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    models.Base.metadata.create_all(bind=database.engine)
+    seed_users(args.users)
+    setup_analytics_queues()
+    EventProcessor().start_all_consumers()
+
+    events = make_events(args.events, args.users)
+
+    if args.publisher == "background":
+        publisher = BackgroundPublisher(envelopes=args.envelopes, batch_size=args.batch_size)
+    else:
+        publisher = RabbitMQClient()
+        publisher.connect()
+
+    started = time.perf_counter()
+    for event in events:
+        publisher.publish(NOTES_EXCHANGE, event)
+    published_seconds = time.perf_counter() - started
+
+    deadline = time.monotonic() + args.timeout
+    processed = 0
+    while processed < args.events and time.monotonic() < deadline:
+        time.sleep(0.05)
+        processed = processed_events()
+    total_seconds = time.perf_counter() - started
+
+    print(f"database          {database.SQLALCHEMY_DATABASE_URL}")
+    print(f"publisher         {args.publisher}{' + envelopes' if args.envelopes else ''}")
+    print(f"publish           {args.events / published_seconds:10.0f} events/s")
+    print(f"end to end        {processed / total_seconds:10.0f} events/s ({processed}/{args.events} processed)")
+    if args.publisher == "background":
+        metrics = publisher.get_metrics()
+        print(f"publisher batches {metrics['batches']}, broker messages {metrics['messages']}, envelopes {metrics['envelopes']}")
+        if args.envelopes:
+            print(f"events / message  {processed / max(metrics['messages'], 1):10.1f}")
+            if publisher.batch_size <= args.users:
+                print(f"note              batch size {publisher.batch_size} <= {args.users} users: "
+                      "a user rarely has two events in a batch, so few envelopes form")
+
+    publisher.close()
+
+
+if __name__ == "__main__":
+    main()
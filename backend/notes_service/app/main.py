@@ -7,6 +7,8 @@ sys.path.append('/app')
 from . import models, database
 from .routers import notes
 from .shared.rabbitmq_client import setup_rabbitmq_infrastructure
+from .shared.publisher import get_publisher_metrics
+from .shared.revocation import start_revocation_listener
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -23,11 +25,17 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         print(f"Failed to setup RabbitMQ infrastructure: {e}")
 
+    # Keep the token revocation list in sync
+    start_revocation_listener()
+
     yield
 
     # Shutdown
     print("Shutting down Notes Service...")
 
+    # Flush events still waiting to be published
+    notes.rabbitmq_client.close()
+
 app = FastAPI(
     title="Notes Service",
     description="Microservice for managing notes",
@@ -53,5 +61,9 @@ async def root():
 async def health():
     return {"status": "healthy"}
 
+@app.get("/metrics/publisher")
+async def publisher_metrics():
+    return get_publisher_metrics(notes.rabbitmq_client)
+
 # Include routers
 app.include_router(notes.router, prefix="/notes", tags=["notes"])
\ No newline at end of file
@@ -7,12 +7,13 @@ import sys
 sys.path.append('/app')
 from ..shared.jwt_utils import get_current_user_id
 from ..shared.event_schemas import NoteCreatedEvent, NoteUpdatedEvent, NoteDeletedEvent
-from ..shared.rabbitmq_client import RabbitMQClient, NOTES_EXCHANGE
+from ..shared.publisher import create_publisher
+from ..shared.rabbitmq_client import NOTES_EXCHANGE
 
 router = APIRouter()
 
-# Initialize RabbitMQ client
-rabbitmq_client = RabbitMQClient()
+# Initialize event publisher (synchronous or background, see PUBLISHER_MODE)
+rabbitmq_client = create_publisher()
 
 # ============================================
 # NOTE CRUD ENDPOINTS
@@ -0,0 +1,407 @@
+import logging
+import queue
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional
+from pydantic import BaseModel
+from .config import config
+from .rabbitmq_client import RabbitMQClient, backoff_delay
+from .channel_pool import PooledRabbitMQClient
+from .spool import EventSpool, SpoolFull, make_record, publish_record, spool_path
+from .codec import encode_batch, encode_event, partition_key_of
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+OVERFLOW_POLICIES = ("block", "drop_newest", "drop_oldest")
+
+
+class OutgoingMessage(NamedTuple):
+    """Event waiting to be published (serialized on the publisher thread)"""
+    exchange_name: str
+    routing_key: str
+    message: BaseModel
+    enqueued_at: float
+
+
+class PublisherMetrics:
+    """Thread-safe counters describing the background publisher"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.enqueued = 0
+        self.published = 0
+        self.dropped = 0
+        self.failed = 0
+        self.spooled = 0
+        self.retries = 0
+        self.batches = 0
+        self.messages = 0  # Broker messages sent (an envelope is one message)
+        self.envelopes = 0
+        self.commit_latency_total_ms = 0.0
+        self.commit_latency_max_ms = 0.0
+        self.end_to_end_latency_max_ms = 0.0
+
+    def increment(self, name: str, amount: int = 1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def record_batch(self, size: int, commit_latency_ms: float, end_to_end_latency_ms: float):
+        with self._lock:
+            self.batches += 1
+            self.published += size
+            self.commit_latency_total_ms += commit_latency_ms
+            self.commit_latency_max_ms = max(self.commit_latency_max_ms, commit_latency_ms)
+            self.end_to_end_latency_max_ms = max(self.end_to_end_latency_max_ms, end_to_end_latency_ms)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "enqueued": self.enqueued,
+                "published": self.published,
+                "dropped": self.dropped,
+                "failed": self.failed,
+                "spooled": self.spooled,
+                "retries": self.retries,
+                "batches": self.batches,
+                "messages": self.messages,
+                "envelopes": self.envelopes,
+                # Time from the first publish of a batch to its commit
+                "commit_latency_avg_ms": (
+                    self.commit_latency_total_ms / self.batches if self.batches else 0.0
+                ),
+                "commit_latency_max_ms": self.commit_latency_max_ms,
+                "end_to_end_latency_max_ms": self.end_to_end_latency_max_ms,
+            }
+
+
+class BackgroundPublisher:
+    """
+    Publishes events from a dedicated thread
+
+    `publish` puts the event on a bounded in-memory queue and returns
+    immediately; serialization happens on the worker thread, which drains
+    the queue in batches over a transactional channel: a batch is written
+    without waiting for the broker and committed with one round trip, so an
+    event only counts as published once the broker has accepted its batch.
+    Events that cannot be published go to the disk spool and are replayed,
+    in order, before any newer event.
+
+    With envelopes enabled, events of a batch that share an exchange,
+    routing key and partition key (user) are sent as one batch envelope
+    message, as long as none of that user's other events falls between
+    them, so each user's events keep their order. Events of different users
+    never share an envelope, since partitioned consumers route an envelope
+    by its one partition key; envelopes therefore only pay off when a batch
+    holds several events per user, i.e. when batches are larger than the
+    number of users publishing at the same time.
+    """
+
+    def __init__(
+        self,
+        rabbitmq_url: Optional[str] = None,
+        max_queue_size: Optional[int] = None,
+        batch_size: Optional[int] = None,
+        flush_interval_ms: Optional[int] = None,
+        overflow_policy: Optional[str] = None,
+        max_retries: Optional[int] = None,
+        spool: Optional[EventSpool] = None,
+        envelopes: Optional[bool] = None
+    ):
+        """
+        Initialize background publisher
+
+        Args:
+            rabbitmq_url: RabbitMQ connection URL (defaults to config value)
+            max_queue_size: Maximum number of events waiting to be published
+            batch_size: Maximum number of events published per batch
+            flush_interval_ms: How long the worker waits to fill a batch
+            overflow_policy: What to do when the queue is full (block, drop_newest, drop_oldest)
+            max_retries: How many times a failed batch is retried before its events are spooled
+            spool: Spool for events published during a broker outage
+            envelopes: Whether batches are published as batch envelopes
+        """
+        self.rabbitmq_url = rabbitmq_url or config.RABBITMQ_URL
+        self.batch_size = batch_size or config.PUBLISHER_BATCH_SIZE
+        self.flush_interval = (flush_interval_ms or config.PUBLISHER_FLUSH_INTERVAL_MS) / 1000
+        self.overflow_policy = overflow_policy or config.PUBLISHER_OVERFLOW_POLICY
+        self.max_retries = config.PUBLISHER_MAX_RETRIES if max_retries is None else max_retries
+        self.block_timeout = config.PUBLISHER_BLOCK_TIMEOUT_MS / 1000
+        self.spool = spool or EventSpool(spool_path("events"))
+        self.envelopes = config.PUBLISHER_BATCH_ENVELOPES if envelopes is None else envelopes
+
+        if self.overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {self.overflow_policy}")
+
+        self.metrics = PublisherMetrics()
+        self._queue: "queue.Queue[OutgoingMessage]" = queue.Queue(
+            maxsize=max_queue_size or config.PUBLISHER_QUEUE_SIZE
+        )
+        self._client: Optional[RabbitMQClient] = None
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._reconnect_attempt = 0
+        self._next_replay_at = 0.0
+
+    def start(self):
+        """Start the worker thread (called lazily by the first publish)"""
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping.clear()
+                self._thread = threading.Thread(target=self._run, name="event-publisher", daemon=True)
+                self._thread.start()
+
+    def close(self, timeout: float = 5.0):
+        """
+        Flush queued events and stop the worker thread
+
+        Args:
+            timeout: Maximum number of seconds to wait for the flush
+        """
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+        self.spool.close()
+
+    def publish(self, exchange_name: str, message: BaseModel, routing_key: str = "") -> bool:
+        """
+        Queue a message for publishing
+
+        Args:
+            exchange_name: Name of the exchange
+            message: Pydantic model to publish
+            routing_key: Routing key for message (defaults to the event type)
+
+        Returns:
+            True if the message was queued, False if it was dropped
+        """
+        if self._thread is None:
+            self.start()
+
+        item = OutgoingMessage(
+            exchange_name=exchange_name,
+            routing_key=routing_key or message.event_type,
+            message=message,
+            enqueued_at=time.monotonic()
+        )
+
+        if self._offer(item):
+            self.metrics.increment("enqueued")
+            return True
+
+        self.metrics.increment("dropped")
+        logger.warning(f"Publisher queue full, dropped event: {message.event_type}")
+        return False
+
+    def _offer(self, item: OutgoingMessage) -> bool:
+        if self.overflow_policy == "block":
+            # Backpressure: the caller waits for room, but never indefinitely
+            try:
+                self._queue.put(item, timeout=self.block_timeout)
+                return True
+            except queue.Full:
+                return False
+
+        try:
+            self._queue.put_nowait(item)
+            return True
+        except queue.Full:
+            if self.overflow_policy == "drop_newest":
+                return False
+
+        # drop_oldest: make room by discarding the event that has waited longest
+        try:
+            self._queue.get_nowait()
+            self.metrics.increment("dropped")
+        except queue.Empty:
+            pass
+        try:
+            self._queue.put_nowait(item)
+            return True
+        except queue.Full:
+            return False
+
+    def queue_depth(self) -> int:
+        """Number of events waiting to be published"""
+        return self._queue.qsize()
+
+    def get_metrics(self) -> dict:
+        """Publisher metrics including the current queue depth"""
+        return {
+            "mode": "background",
+            "queue_depth": self.queue_depth(),
+            "queue_capacity": self._queue.maxsize,
+            "overflow_policy": self.overflow_policy,
+            "spool": self.spool.stats(),
+            **self.metrics.snapshot(),
+        }
+
+    def _next_batch(self) -> List[OutgoingMessage]:
+        try:
+            batch = [self._queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0 and not self._stopping.is_set():
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not (self._stopping.is_set() and self._queue.empty()):
+            batch = self._next_batch()
+            if self.spool.has_pending() and not self._drain_spool():
+                # Queue behind the spooled events so ordering is preserved
+                if batch:
+                    self._spool(batch)
+            elif batch:
+                self._publish_batch(batch)
+
+    def _drain_spool(self) -> bool:
+        if time.monotonic() < self._next_replay_at:
+            return False
+
+        try:
+            client = self._ensure_client()
+            replayed = self.spool.replay(lambda record: publish_record(client, record), commit=client.commit)
+            self.metrics.increment("published", replayed)
+            self.metrics.increment("messages", replayed)
+            logger.info(f"Replayed {replayed} spooled events")
+            self._reconnect_attempt = 0
+            return True
+        except Exception as e:
+            logger.warning(f"Spool replay failed: {e}")
+            self._reset_client()
+            self._schedule_reconnect()
+            return False
+
+    def _schedule_reconnect(self):
+        self._next_replay_at = time.monotonic() + backoff_delay(self._reconnect_attempt)
+        self._reconnect_attempt += 1
+
+    def _spool(self, items: List[OutgoingMessage]):
+        records = [
+            make_record(item.exchange_name, item.routing_key, item.message.event_type, encode_event(item.message))
+            for item in items
+        ]
+        try:
+            self.spool.append(records)
+            self.metrics.increment("spooled", len(records))
+        except SpoolFull as e:
+            self.metrics.increment("failed", len(records))
+            logger.error(f"Dropped {len(records)} events: {e}")
+
+    def _ensure_client(self) -> RabbitMQClient:
+        if self._client is None:
+            client = RabbitMQClient(self.rabbitmq_url)
+            client.connect(max_attempts=1)
+            client.begin_transactions()
+            self._client = client
+        return self._client
+
+    def _reset_client(self):
+        if self._client is not None:
+            try:
+                self._client.close()
+            except Exception:
+                pass
+            self._client = None
+
+    def _group(self, items: List[OutgoingMessage]) -> List[List[OutgoingMessage]]:
+        """Split items into units published as one message each"""
+        if not self.envelopes:
+            return [[item] for item in items]
+
+        # An event joins its user's latest group if that group has the same exchange and
+        # routing key, however many other users' events came in between. A user's events
+        # thus stay in order, while events of different users may overtake each other.
+        groups: List[List[OutgoingMessage]] = []
+        latest: Dict[Optional[str], List[OutgoingMessage]] = {}
+        for item in items:
+            partition_key = partition_key_of(item.message)
+            group = latest.get(partition_key)
+            if group is not None and (group[0].exchange_name, group[0].routing_key) == (
+                item.exchange_name, item.routing_key
+            ):
+                group.append(item)
+            else:
+                group = latest[partition_key] = [item]
+                groups.append(group)
+        return groups
+
+    def _publish_batch(self, batch: List[OutgoingMessage]):
+        pending = batch
+        attempt = 0
+        while pending:
+            started = time.monotonic()
+            published = 0
+            try:
+                client = self._ensure_client()
+                envelopes = 0
+                groups = self._group(pending)
+                for group in groups:
+                    first = group[0]
+                    if len(group) == 1:
+                        client.publish_encoded(first.exchange_name, encode_event(first.message), first.routing_key)
+                    else:
+                        envelope = encode_batch([item.message for item in group])
+                        client.publish_encoded(first.exchange_name, envelope, first.routing_key)
+                        envelopes += 1
+                # The only wait for the broker: all or none of the batch takes effect
+                client.commit()
+                published = len(pending)
+                self.metrics.increment("messages", len(groups))
+                self.metrics.increment("envelopes", envelopes)
+            except Exception as e:
+                logger.error(f"Failed to publish batch: {e}")
+                self._reset_client()
+            finally:
+                if published:
+                    now = time.monotonic()
+                    self.metrics.record_batch(
+                        published,
+                        (now - started) * 1000,
+                        (now - pending[0].enqueued_at) * 1000
+                    )
+
+            pending = pending[published:]
+            if not pending:
+                return
+
+            if attempt >= self.max_retries or self._stopping.is_set():
+                logger.error(f"Spooling {len(pending)} events after {attempt} retries")
+                self._spool(pending)
+                self._schedule_reconnect()
+                return
+
+            self.metrics.increment("retries")
+            time.sleep(backoff_delay(attempt))
+            attempt += 1
+
+
+def create_publisher():
+    """
+    Create the event publisher configured by PUBLISHER_MODE
+
+    Returns:
+        BackgroundPublisher in background mode, otherwise a pooled synchronous publisher
+    """
+    if config.PUBLISHER_MODE == "background":
+        return BackgroundPublisher()
+    return PooledRabbitMQClient()
+
+
+def get_publisher_metrics(publisher) -> dict:
+    """Metrics of a publisher created by create_publisher"""
+    return publisher.get_metrics()
@@ -0,0 +1,189 @@
+import hashlib
+import json
+import logging
+import math
+import socket
+import threading
+import time
+import urllib.request
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterable, Optional, Tuple
+from .config import config
+from .rabbitmq_client import RabbitMQClient, REVOCATIONS_EXCHANGE
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over string keys"""
+
+    def __init__(self, capacity: int, error_rate: float):
+        """
+        Initialize Bloom filter
+
+        Args:
+            capacity: Expected number of keys
+            error_rate: Target false positive rate at full capacity
+        """
+        capacity = max(capacity, 1)
+        self.capacity = capacity
+        self.num_bits = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self._bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, key: str):
+        # Double hashing (Kirsch-Mitzenmacher) from a single 128-bit digest
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, key: str):
+        for position in self._positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class RevocationList:
+    """
+    Set of revoked token ids (JWT `jti` claims)
+
+    Lookups go through a Bloom filter first, so the common not-revoked case is
+    answered in memory without touching the exact set. Entries are kept only
+    until the token would have expired anyway.
+    """
+
+    def __init__(self, capacity: Optional[int] = None, error_rate: Optional[float] = None):
+        self.capacity = capacity or config.REVOCATION_BLOOM_CAPACITY
+        self.error_rate = error_rate or config.REVOCATION_BLOOM_ERROR_RATE
+        self._revoked: Dict[str, float] = {}
+        self._bloom = BloomFilter(self.capacity, self.error_rate)
+        self._lock = threading.Lock()
+
+    def revoke(self, jti: str, expires_at: float):
+        """
+        Mark a token id as revoked
+
+        Args:
+            jti: Token id
+            expires_at: Token expiration as a UNIX timestamp
+        """
+        if expires_at <= time.time():
+            return
+
+        with self._lock:
+            self._revoked[jti] = expires_at
+            if len(self._revoked) > self.capacity:
+                self._rebuild()
+            else:
+                self._bloom.add(jti)
+
+    def is_revoked(self, jti: str) -> bool:
+        """Check whether a token id has been revoked"""
+        if jti not in self._bloom:
+            return False
+
+        expires_at = self._revoked.get(jti)
+        return expires_at is not None and expires_at > time.time()
+
+    def prune(self):
+        """Drop expired entries and rebuild the Bloom filter without them"""
+        with self._lock:
+            self._rebuild()
+
+    def _rebuild(self):
+        now = time.time()
+        self._revoked = {jti: exp for jti, exp in self._revoked.items() if exp > now}
+        while len(self._revoked) > self.capacity:
+            self.capacity *= 2
+
+        bloom = BloomFilter(self.capacity, self.error_rate)
+        for jti in self._revoked:
+            bloom.add(jti)
+        self._bloom = bloom
+
+    def __len__(self) -> int:
+        return len(self._revoked)
+
+
+# Process-wide revocation list consulted by jwt_utils.verify_token
+revocation_list = RevocationList()
+
+
+def to_timestamp(value) -> float:
+    """Convert an ISO string or naive UTC datetime to a UNIX timestamp"""
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+def fetch_revocations_from_users_service() -> Iterable[Tuple[str, float]]:
+    """Load currently active revocations from the users service"""
+    # Imported here: jwt_utils imports this module for revocation_list
+    from .jwt_utils import create_service_token
+
+    request = urllib.request.Request(
+        f"{config.USERS_SERVICE_URL}/users/revocations",
+        headers={"Authorization": f"Bearer {create_service_token(socket.gethostname())}"}
+    )
+    with urllib.request.urlopen(request, timeout=5) as response:
+        entries = json.loads(response.read())
+    return [(entry["jti"], to_timestamp(entry["expires_at"])) for entry in entries]
+
+
+def _handle_revocation_event(message: dict):
+    revocation_list.revoke(message["jti"], to_timestamp(message["expires_at"]))
+
+
+def _listen_for_revocations(bootstrap: Callable[[], Iterable[Tuple[str, float]]]):
+    while True:
+        client = RabbitMQClient()
+        try:
+            client.connect()
+            client.declare_exchange(REVOCATIONS_EXCHANGE, "fanout")
+            queue_name = client.declare_queue("", durable=False, exclusive=True)
+            client.bind_queue(queue_name, REVOCATIONS_EXCHANGE)
+
+            # Bootstrap after binding so no revocation published in between is missed
+            try:
+                for jti, expires_at in bootstrap():
+                    revocation_list.revoke(jti, expires_at)
+                revocation_list.prune()
+                logger.info(f"Loaded {len(revocation_list)} active token revocations")
+            except Exception as e:
+                logger.error(f"Failed to bootstrap token revocations: {e}")
+
+            client.consume(queue_name, _handle_revocation_event, auto_ack=True)
+        except Exception as e:
+            logger.error(f"Revocation listener error: {e}")
+        finally:
+            client.close()
+        time.sleep(config.REVOCATION_RECONNECT_SECONDS)
+
+
+def start_revocation_listener(
+    bootstrap: Callable[[], Iterable[Tuple[str, float]]] = fetch_revocations_from_users_service
+) -> threading.Thread:
+    """
+    Start a background thread that keeps `revocation_list` in sync
+
+    Each process binds its own exclusive queue to the revocations exchange,
+    so every replica of every service receives every revocation.
+
+    Args:
+        bootstrap: Callable returning (jti, expires_at) pairs revoked before startup
+
+    Returns:
+        The listener thread
+    """
+    thread = threading.Thread(target=_listen_for_revocations, args=(bootstrap,), daemon=True)
+    thread.start()
+    return thread
@@ -1,12 +1,26 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
+from datetime import datetime
 import sys
 sys.path.append('/app')
 
 from . import models, database
 from .routers import users
 from .shared.rabbitmq_client import setup_rabbitmq_infrastructure
+from .shared.publisher import get_publisher_metrics
+from .shared.revocation import start_revocation_listener, to_timestamp
+
+def load_active_revocations():
+    """Load revocations of not yet expired tokens from the users database"""
+    db = database.SessionLocal()
+    try:
+        revoked = db.query(models.RevokedToken).filter(
+            models.RevokedToken.expires_at > datetime.utcnow()
+        ).all()
+        return [(token.jti, to_timestamp(token.expires_at)) for token in revoked]
+    finally:
+        db.close()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -23,11 +37,17 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         print(f"Failed to setup RabbitMQ infrastructure: {e}")
 
+    # Keep the token revocation list in sync
+    start_revocation_listener(bootstrap=load_active_revocations)
+
     yield
 
     # Shutdown
     print("Shutting down Users Service...")
 
+    # Flush events still waiting to be published
+    users.rabbitmq_client.close()
+
 app = FastAPI(
     title="Users Service",
     description="Microservice for user management and authentication",
@@ -53,5 +73,9 @@ async def root():
 async def health():
     return {"status": "healthy"}
 
+@app.get("/metrics/publisher")
+async def publisher_metrics():
+    return get_publisher_metrics(users.rabbitmq_client)
+
 # Include routers
 app.include_router(users.router, prefix="/users", tags=["users"])
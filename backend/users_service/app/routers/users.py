@@ -5,14 +5,16 @@ from datetime import datetime
 from .. import models, schemas, database, auth
 import sys
 sys.path.append('/app')
-from ..shared.jwt_utils import create_access_token, get_current_user_id
-from ..shared.event_schemas import UserRegisteredEvent, UserLoggedInEvent
-from ..shared.rabbitmq_client import RabbitMQClient, USERS_EXCHANGE
+from ..shared.jwt_utils import create_access_token, get_current_user_id, get_current_token_payload, get_service_caller, SERVICE_TOKEN_SCOPE
+from ..shared.event_schemas import UserRegisteredEvent, UserLoggedInEvent, TokenRevokedEvent
+from ..shared.publisher import create_publisher
+from ..shared.rabbitmq_client import USERS_EXCHANGE, REVOCATIONS_EXCHANGE
+from ..shared.revocation import revocation_list, to_timestamp
 
 router = APIRouter()
 
-# Initialize RabbitMQ client
-rabbitmq_client = RabbitMQClient()
+# Initialize event publisher (synchronous or background, see PUBLISHER_MODE)
+rabbitmq_client = create_publisher()
 
 # ============================================
 # AUTHENTICATION ENDPOINTS
@@ -91,6 +93,58 @@ async def login(user_login: schemas.UserLogin, db: Session = Depends(database.ge
 
     return {"access_token": access_token, "token_type": "bearer"}
 
+@router.post("/logout", status_code=status.HTTP_204_NO_CONTENT)
+async def logout(
+    payload: dict = Depends(get_current_token_payload),
+    db: Session = Depends(database.get_db)
+):
+    """Revoke the current access token in all services"""
+    if payload.get("scope") == SERVICE_TOKEN_SCOPE:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Service tokens cannot be revoked"
+        )
+
+    jti = payload.get("jti")
+    if jti is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Token cannot be revoked"
+        )
+
+    user_id = int(payload["sub"])
+    expires_at = datetime.utcfromtimestamp(payload["exp"])
+
+    if db.query(models.RevokedToken).filter(models.RevokedToken.jti == jti).first() is None:
+        db.add(models.RevokedToken(jti=jti, user_id=user_id, expires_at=expires_at))
+        db.commit()
+
+    revocation_list.revoke(jti, to_timestamp(expires_at))
+
+    # Publish token revoked event
+    try:
+        event = TokenRevokedEvent(
+            jti=jti,
+            user_id=user_id,
+            expires_at=expires_at,
+            timestamp=datetime.utcnow()
+        )
+        rabbitmq_client.publish(REVOCATIONS_EXCHANGE, event)
+    except Exception as e:
+        print(f"Failed to publish token revoked event: {e}")
+
+    return None
+
+@router.get("/revocations", response_model=List[schemas.RevokedTokenResponse])
+async def get_active_revocations(
+    caller: str = Depends(get_service_caller),
+    db: Session = Depends(database.get_db)
+):
+    """Get revoked tokens that have not expired yet (services only, used to bootstrap)"""
+    return db.query(models.RevokedToken).filter(
+        models.RevokedToken.expires_at > datetime.utcnow()
+    ).all()
+
 # ============================================
 # USER MANAGEMENT ENDPOINTS
 # ============================================
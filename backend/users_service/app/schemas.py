@@ -40,3 +40,10 @@ class Token(BaseModel):
 
 class TokenData(BaseModel):
     user_id: Optional[int] = None
+
+class RevokedTokenResponse(BaseModel):
+    jti: str
+    expires_at: datetime
+
+    class Config:
+        from_attributes = True
@@ -1,11 +1,18 @@
+import uuid
 from datetime import datetime, timedelta
 from typing import Optional
 from jose import JWTError, jwt
 from fastapi import HTTPException, status, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from .config import config
+from .revocation import revocation_list
 
 security = HTTPBearer()
+optional_security = HTTPBearer(auto_error=False)
+
+# Scope claim of tokens services use to call each other's internal endpoints
+SERVICE_TOKEN_SCOPE = "service"
+SERVICE_TOKEN_EXPIRATION = timedelta(minutes=1)
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
     """
@@ -29,11 +36,29 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
     else:
         expire = datetime.utcnow() + timedelta(minutes=config.JWT_EXPIRATION_MINUTES)
 
-    to_encode.update({"exp": expire})
+    to_encode.update({"exp": expire, "jti": uuid.uuid4().hex})
     encoded_jwt = jwt.encode(to_encode, config.JWT_SECRET, algorithm=config.JWT_ALGORITHM)
 
     return encoded_jwt
 
+def create_service_token(service: str) -> str:
+    """
+    Create a short-lived token for calling another service's internal endpoints
+
+    Only holders of JWT_SECRET can sign one, and user tokens never carry the
+    service scope, so users cannot call these endpoints.
+
+    Args:
+        service: Name of the calling service (token subject)
+
+    Returns:
+        Encoded JWT token string
+    """
+    return create_access_token(
+        {"sub": f"service:{service}", "scope": SERVICE_TOKEN_SCOPE},
+        expires_delta=SERVICE_TOKEN_EXPIRATION
+    )
+
 def verify_token(token: str) -> dict:
     """
     Verify and decode a JWT token
@@ -45,7 +70,7 @@ def verify_token(token: str) -> dict:
         Decoded token payload
 
     Raises:
-        HTTPException: If token is invalid or expired
+        HTTPException: If token is invalid, expired or revoked
     """
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -55,10 +80,30 @@ def verify_token(token: str) -> dict:
 
     try:
         payload = jwt.decode(token, config.JWT_SECRET, algorithms=[config.JWT_ALGORITHM])
-        return payload
     except JWTError:
         raise credentials_exception
 
+    jti = payload.get("jti")
+    if jti is not None and revocation_list.is_revoked(jti):
+        raise credentials_exception
+
+    return payload
+
+def get_current_token_payload(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
+    """
+    Dependency to get the decoded payload of the current JWT token
+
+    Args:
+        credentials: HTTP Authorization credentials containing the bearer token
+
+    Returns:
+        Decoded token payload
+
+    Raises:
+        HTTPException: If token is invalid, expired or revoked
+    """
+    return verify_token(credentials.credentials)
+
 def get_current_user_id(credentials: HTTPAuthorizationCredentials = Depends(security)) -> int:
     """
     Dependency to get current user ID from JWT token
@@ -72,7 +117,9 @@ def get_current_user_id(credentials: HTTPAuthorizationCredentials = Depends(secu
     Raises:
         HTTPException: If token is invalid or user_id not found
     """
-    token = credentials.credentials
+    return _user_id_from_token(credentials.credentials)
+
+def _user_id_from_token(token: str) -> int:
     payload = verify_token(token)
 
     user_id_str = payload.get("sub")
@@ -93,6 +140,73 @@ def get_current_user_id(credentials: HTTPAuthorizationCredentials = Depends(secu
 
     return user_id
 
+def get_stream_user_id(
+    token: Optional[str] = None,
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)
+) -> int:
+    """
+    Dependency to get current user ID for streams opened by EventSource, which cannot set headers
+
+    Args:
+        token: JWT token from the `token` query parameter
+        credentials: HTTP Authorization credentials, used when present
+
+    Returns:
+        User ID from token
+
+    Raises:
+        HTTPException: If no token is given, or it is invalid
+    """
+    if credentials is not None:
+        token = credentials.credentials
+    if token is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Not authenticated",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return _user_id_from_token(token)
+
+def get_admin_user_id(user_id: int = Depends(get_current_user_id)) -> int:
+    """
+    Dependency to get the current user ID, allowing only users listed in ADMIN_USER_IDS
+
+    Args:
+        user_id: User ID from the JWT token
+
+    Returns:
+        User ID from token
+
+    Raises:
+        HTTPException: If token is invalid or the user is not an administrator
+    """
+    if user_id not in config.ADMIN_USER_IDS:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Administrator access required"
+        )
+    return user_id
+
+def get_service_caller(payload: dict = Depends(get_current_token_payload)) -> str:
+    """
+    Dependency allowing only other services (tokens from create_service_token)
+
+    Args:
+        payload: Decoded token payload
+
+    Returns:
+        Token subject naming the calling service
+
+    Raises:
+        HTTPException: If token is invalid or was not issued to a service
+    """
+    if payload.get("scope") != SERVICE_TOKEN_SCOPE:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Service access required"
+        )
+    return payload["sub"]
+
 def get_current_user_optional(credentials: Optional[HTTPAuthorizationCredentials] = Depends(security)) -> Optional[int]:
     """
     Optional dependency to get current user ID from JWT token (returns None if not authenticated)
@@ -0,0 +1,639 @@
+import bisect
+import hashlib
+import heapq
+import itertools
+import logging
+import threading
+import time
+import uuid
+from collections import deque
+from types import SimpleNamespace
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+import pika
+from pika.exceptions import ChannelClosedByBroker, ConnectionClosed
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MEMORY_URL_SCHEME = "memory://"
+
+# Ring points per unit of weight of an x-consistent-hash binding
+CONSISTENT_HASH_POINTS = 64
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+
+class _Message:
+    __slots__ = ("exchange", "routing_key", "body", "properties", "redelivered", "expires_at")
+
+    def __init__(self, exchange: str, routing_key: str, body: bytes, properties, expires_at: Optional[float]):
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.body = body
+        self.properties = properties
+        self.redelivered = False
+        self.expires_at = expires_at
+
+
+class _Queue:
+    def __init__(self, name: str, arguments: Optional[dict], exclusive_owner=None):
+        self.name = name
+        self.arguments = arguments or {}
+        self.exclusive_owner = exclusive_owner
+        self.messages: Deque[_Message] = deque()
+        self.consumers: List["_Consumer"] = []
+
+    @property
+    def ttl(self) -> Optional[float]:
+        ttl = self.arguments.get("x-message-ttl")
+        return None if ttl is None else ttl / 1000
+
+
+class _Exchange:
+    def __init__(self, name: str, exchange_type: str, arguments: Optional[dict] = None):
+        self.name = name
+        self.exchange_type = exchange_type
+        self.arguments = arguments or {}
+        self.bindings: List[Tuple[str, str]] = []  # (queue name, binding key)
+        self.exchange_bindings: List[Tuple[str, str]] = []  # (destination exchange, binding key)
+        self._ring: Optional[Tuple[List[int], List[str]]] = None
+
+    def hash_ring(self) -> Tuple[List[int], List[str]]:
+        """Points of the consistent-hash ring; a queue's binding key is its weight"""
+        if self._ring is None:
+            points = sorted(
+                (_hash(f"{queue_name}:{i}"), queue_name)
+                for queue_name, weight in self.bindings
+                for i in range(int(weight or 1) * CONSISTENT_HASH_POINTS)
+            )
+            self._ring = ([point for point, _ in points], [queue_name for _, queue_name in points])
+        return self._ring
+
+    def invalidate(self):
+        self._ring = None
+
+
+class _Consumer:
+    def __init__(self, tag: str, queue: _Queue, channel: "InMemoryChannel", callback: Callable, auto_ack: bool):
+        self.tag = tag
+        self.queue = queue
+        self.channel = channel
+        self.callback = callback
+        self.auto_ack = auto_ack
+
+
+def topic_matches(pattern: str, routing_key: str) -> bool:
+    """AMQP topic matching: `*` matches one word, `#` zero or more"""
+    def match(pattern_words, key_words):
+        if not pattern_words:
+            return not key_words
+        head, rest = pattern_words[0], pattern_words[1:]
+        if head == "#":
+            return any(match(rest, key_words[i:]) for i in range(len(key_words) + 1))
+        if not key_words:
+            return False
+        return (head == "*" or head == key_words[0]) and match(rest, key_words[1:])
+
+    return match(pattern.split(".") if pattern else [], routing_key.split(".") if routing_key else [])
+
+
+class InMemoryBroker:
+    """
+    Process-local AMQP 0-9-1 broker
+
+    Supports what this codebase uses: direct, fanout, topic and
+    x-consistent-hash exchanges, exchange-to-exchange bindings, durable,
+    exclusive and single-active-consumer queues, prefetch, (multiple) acks
+    and nacks, per-queue message TTL and dead-lettering, and basic_get.
+    Deliveries run on the thread that calls start_consuming or
+    process_data_events, like with pika's BlockingConnection.
+    """
+
+    def __init__(self):
+        self.exchanges: Dict[str, _Exchange] = {"": _Exchange("", "direct")}
+        self.queues: Dict[str, _Queue] = {}
+        self.condition = threading.Condition(threading.RLock())
+
+    # -- topology -----------------------------------------------------------
+
+    def declare_exchange(self, name: str, exchange_type: str, arguments: Optional[dict] = None):
+        with self.condition:
+            existing = self.exchanges.get(name)
+            if existing is not None and existing.exchange_type != exchange_type:
+                raise ChannelClosedByBroker(406, f"PRECONDITION_FAILED - inequivalent arg 'type' for exchange '{name}'")
+            if existing is None:
+                self.exchanges[name] = _Exchange(name, exchange_type, arguments)
+
+    def declare_queue(self, name: str, arguments: Optional[dict], exclusive_owner, passive: bool) -> _Queue:
+        with self.condition:
+            if not name:
+                name = f"amq.gen-{uuid.uuid4().hex}"
+            queue = self.queues.get(name)
+            if queue is None:
+                if passive:
+                    raise ChannelClosedByBroker(404, f"NOT_FOUND - no queue '{name}'")
+                queue = self.queues[name] = _Queue(name, arguments, exclusive_owner)
+            elif not passive and arguments is not None and queue.arguments != arguments:
+                raise ChannelClosedByBroker(406, f"PRECONDITION_FAILED - inequivalent args for queue '{name}'")
+            return queue
+
+    def bind(self, queue: str, exchange: str, routing_key: str):
+        with self.condition:
+            binding = (queue, routing_key)
+            target = self._exchange(exchange)
+            if queue not in self.queues:
+                raise ChannelClosedByBroker(404, f"NOT_FOUND - no queue '{queue}'")
+            if binding not in target.bindings:
+                target.bindings.append(binding)
+                target.invalidate()
+
+    def unbind(self, queue: str, exchange: str, routing_key: str):
+        with self.condition:
+            target = self.exchanges.get(exchange)
+            if target is not None and (queue, routing_key) in target.bindings:
+                target.bindings.remove((queue, routing_key))
+                target.invalidate()
+
+    def bind_exchange(self, destination: str, source: str, routing_key: str):
+        with self.condition:
+            self._exchange(destination)
+            target = self._exchange(source)
+            if (destination, routing_key) not in target.exchange_bindings:
+                target.exchange_bindings.append((destination, routing_key))
+
+    def unbind_exchange(self, destination: str, source: str, routing_key: str):
+        with self.condition:
+            target = self.exchanges.get(source)
+            if target is not None and (destination, routing_key) in target.exchange_bindings:
+                target.exchange_bindings.remove((destination, routing_key))
+
+    def delete_queue(self, name: str):
+        with self.condition:
+            self.queues.pop(name, None)
+            for exchange in self.exchanges.values():
+                exchange.bindings = [binding for binding in exchange.bindings if binding[0] != name]
+                exchange.invalidate()
+
+    def purge(self, name: str) -> int:
+        with self.condition:
+            queue = self._queue(name)
+            count = len(queue.messages)
+            queue.messages.clear()
+            return count
+
+    def _exchange(self, name: str) -> _Exchange:
+        exchange = self.exchanges.get(name)
+        if exchange is None:
+            raise ChannelClosedByBroker(404, f"NOT_FOUND - no exchange '{name}'")
+        return exchange
+
+    def _queue(self, name: str) -> _Queue:
+        queue = self.queues.get(name)
+        if queue is None:
+            raise ChannelClosedByBroker(404, f"NOT_FOUND - no queue '{name}'")
+        return queue
+
+    # -- routing ------------------------------------------------------------
+
+    def _matches(self, exchange: _Exchange, binding_key: str, routing_key: str) -> bool:
+        if exchange.exchange_type == "fanout":
+            return True
+        if exchange.exchange_type == "topic":
+            return topic_matches(binding_key, routing_key)
+        return binding_key == routing_key
+
+    def route(self, exchange_name: str, routing_key: str, properties=None, _visited=None) -> List[_Queue]:
+        exchange = self._exchange(exchange_name)
+        if exchange_name == "":
+            queue = self.queues.get(routing_key)
+            return [queue] if queue is not None else []
+
+        names = []
+        if exchange.exchange_type == "x-consistent-hash":
+            points, owners = exchange.hash_ring()
+            if points:
+                header = exchange.arguments.get("hash-header")
+                headers = (properties.headers if properties is not None else None) or {}
+                key = str(headers.get(header, "")) if header else routing_key
+                names.append(owners[bisect.bisect(points, _hash(key)) % len(points)])
+        else:
+            for queue_name, binding_key in exchange.bindings:
+                if self._matches(exchange, binding_key, routing_key) and queue_name not in names:
+                    names.append(queue_name)
+
+        queues = [self.queues[name] for name in names if name in self.queues]
+        visited = (_visited or set()) | {exchange_name}
+        for destination, binding_key in exchange.exchange_bindings:
+            if destination not in visited and self._matches(exchange, binding_key, routing_key):
+                for queue in self.route(destination, routing_key, properties, visited):
+                    if queue not in queues:
+                        queues.append(queue)
+        return queues
+
+    def publish(self, exchange_name: str, routing_key: str, body: bytes, properties) -> int:
+        with self.condition:
+            queues = self.route(exchange_name, routing_key, properties)
+            for queue in queues:
+                self._enqueue(queue, _Message(exchange_name, routing_key, body, properties, None))
+            self.condition.notify_all()
+            return len(queues)
+
+    def _enqueue(self, queue: _Queue, message: _Message, front: bool = False):
+        ttl = queue.ttl
+        message.expires_at = time.monotonic() + ttl if ttl is not None else None
+        if front:
+            queue.messages.appendleft(message)
+        else:
+            queue.messages.append(message)
+
+    def dead_letter(self, queue: _Queue, message: _Message, reason: str):
+        """Route a rejected or expired message to the queue's dead-letter exchange, if any"""
+        exchange = queue.arguments.get("x-dead-letter-exchange")
+        if exchange is None:
+            return
+
+        routing_key = queue.arguments.get("x-dead-letter-routing-key", message.routing_key)
+        properties = message.properties or pika.BasicProperties()
+        headers = dict(properties.headers or {})
+        headers.setdefault("x-first-death-queue", queue.name)
+        headers.setdefault("x-first-death-reason", reason)
+        properties = pika.BasicProperties(
+            delivery_mode=properties.delivery_mode,
+            content_type=properties.content_type,
+            content_encoding=properties.content_encoding,
+            type=properties.type,
+            headers=headers
+        )
+        for target in self.route(exchange, routing_key, properties):
+            self._enqueue(target, _Message(exchange, routing_key, message.body, properties, None))
+
+    def expire_messages(self):
+        """Dead-letter messages whose queue TTL has passed"""
+        now = time.monotonic()
+        with self.condition:
+            expired = False
+            for queue in list(self.queues.values()):
+                while queue.messages and queue.messages[0].expires_at is not None and queue.messages[0].expires_at <= now:
+                    self.dead_letter(queue, queue.messages.popleft(), "expired")
+                    expired = True
+            if expired:
+                self.condition.notify_all()
+
+    def next_expiry(self) -> Optional[float]:
+        with self.condition:
+            expiries = [
+                queue.messages[0].expires_at for queue in self.queues.values()
+                if queue.messages and queue.messages[0].expires_at is not None
+            ]
+            return min(expiries) if expiries else None
+
+
+_brokers: Dict[str, InMemoryBroker] = {}
+_brokers_lock = threading.Lock()
+
+
+def get_broker(url: str = MEMORY_URL_SCHEME) -> InMemoryBroker:
+    """Broker shared by every connection to the same memory:// URL in this process"""
+    with _brokers_lock:
+        broker = _brokers.get(url)
+        if broker is None:
+            broker = _brokers[url] = InMemoryBroker()
+        return broker
+
+
+def reset_brokers():
+    """Drop all in-memory brokers (between test runs)"""
+    with _brokers_lock:
+        _brokers.clear()
+
+
+class InMemoryConnection:
+    """Drop-in for pika.BlockingConnection backed by an InMemoryBroker"""
+
+    def __init__(self, broker: InMemoryBroker):
+        self.broker = broker
+        self.is_open = True
+        self._channels: List["InMemoryChannel"] = []
+        self._timers: List[Tuple[float, int, Callable]] = []
+        self._timer_ids = itertools.count()
+        self._threadsafe_callbacks: Deque[Callable] = deque()
+        self._exclusive_queues: List[str] = []
+
+    @property
+    def is_closed(self) -> bool:
+        return not self.is_open
+
+    def channel(self) -> "InMemoryChannel":
+        self._check_open()
+        channel = InMemoryChannel(self, len(self._channels) + 1)
+        self._channels.append(channel)
+        return channel
+
+    def call_later(self, delay: float, callback: Callable):
+        heapq.heappush(self._timers, (time.monotonic() + delay, next(self._timer_ids), callback))
+
+    def add_callback_threadsafe(self, callback: Callable):
+        """Run a callback on the thread processing this connection's events (callable from any thread)"""
+        self._check_open()
+        self._threadsafe_callbacks.append(callback)
+        with self.broker.condition:
+            self.broker.condition.notify_all()
+
+    def process_data_events(self, time_limit: Optional[float] = 0):
+        """Run due timers and deliver pending messages, waiting up to time_limit for work"""
+        self._check_open()
+        deadline = time.monotonic() + (time_limit or 0)
+        while True:
+            worked = self._run_timers()
+            self.broker.expire_messages()
+            for channel in self._channels:
+                worked |= channel._dispatch()
+            remaining = deadline - time.monotonic()
+            if worked or remaining <= 0:
+                return
+            self._wait(remaining)
+
+    def _run_timers(self) -> bool:
+        ran = False
+        while self._threadsafe_callbacks:
+            self._threadsafe_callbacks.popleft()()
+            ran = True
+        now = time.monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            _, _, callback = heapq.heappop(self._timers)
+            callback()
+            ran = True
+        return ran
+
+    def _wait(self, limit: float):
+        wakeups = [limit, 0.1]
+        if self._timers:
+            wakeups.append(self._timers[0][0] - time.monotonic())
+        next_expiry = self.broker.next_expiry()
+        if next_expiry is not None:
+            wakeups.append(next_expiry - time.monotonic())
+        with self.broker.condition:
+            self.broker.condition.wait(max(0.0, min(wakeups)))
+
+    def close(self):
+        if not self.is_open:
+            return
+        for channel in list(self._channels):
+            channel.close()
+        for queue_name in self._exclusive_queues:
+            self.broker.delete_queue(queue_name)
+        self.is_open = False
+
+    def _check_open(self):
+        if not self.is_open:
+            raise ConnectionClosed(320, "Connection closed")
+
+
+class InMemoryChannel:
+    """Drop-in for pika's BlockingChannel"""
+
+    def __init__(self, connection: InMemoryConnection, number: int):
+        self.connection = connection
+        self.broker = connection.broker
+        self.channel_number = number
+        self.is_open = True
+        self.prefetch_count = 0
+        self._confirms = False
+        self._transaction: Optional[List[tuple]] = None  # Publishes awaiting tx_commit
+        self._consuming = False
+        self._consumers: Dict[str, _Consumer] = {}
+        self._unacked: Dict[int, Tuple[_Queue, _Message]] = {}
+        self._delivery_tags = itertools.count(1)
+        self._ready: Deque[Tuple[_Consumer, int, _Message]] = deque()
+
+    @property
+    def is_closed(self) -> bool:
+        return not self.is_open
+
+    # -- topology -----------------------------------------------------------
+
+    def exchange_declare(
+        self,
+        exchange: str,
+        exchange_type: str = "direct",
+        durable: bool = False,
+        arguments: Optional[dict] = None,
+        **kwargs
+    ):
+        self._check_open()
+        self.broker.declare_exchange(exchange, exchange_type, arguments)
+
+    def exchange_bind(self, destination: str, source: str, routing_key: str = "", arguments=None):
+        self._check_open()
+        self.broker.bind_exchange(destination, source, routing_key)
+
+    def exchange_unbind(self, destination: str, source: str, routing_key: str = "", arguments=None):
+        self._check_open()
+        self.broker.unbind_exchange(destination, source, routing_key)
+
+    def queue_declare(
+        self,
+        queue: str = "",
+        passive: bool = False,
+        durable: bool = False,
+        exclusive: bool = False,
+        auto_delete: bool = False,
+        arguments: Optional[dict] = None
+    ):
+        self._check_open()
+        declared = self.broker.declare_queue(queue, arguments, self.connection if exclusive else None, passive)
+        if exclusive and declared.name not in self.connection._exclusive_queues:
+            self.connection._exclusive_queues.append(declared.name)
+        return SimpleNamespace(method=SimpleNamespace(
+            queue=declared.name,
+            message_count=len(declared.messages),
+            consumer_count=len(declared.consumers)
+        ))
+
+    def queue_bind(self, queue: str, exchange: str, routing_key: Optional[str] = None, arguments=None):
+        self._check_open()
+        self.broker.bind(queue, exchange, routing_key or "")
+
+    def queue_unbind(self, queue: str, exchange: str, routing_key: Optional[str] = None, arguments=None):
+        self._check_open()
+        self.broker.unbind(queue, exchange, routing_key or "")
+
+    def queue_purge(self, queue: str):
+        self._check_open()
+        return SimpleNamespace(method=SimpleNamespace(message_count=self.broker.purge(queue)))
+
+    # -- publishing ---------------------------------------------------------
+
+    def confirm_delivery(self):
+        # Publishes are applied synchronously, so they are confirmed as soon as basic_publish returns
+        self._confirms = True
+
+    def tx_select(self):
+        # Only publishes are transactional here; acks still take effect immediately
+        self._check_open()
+        if self._transaction is None:
+            self._transaction = []
+
+    def tx_commit(self):
+        self._check_open()
+        if self._transaction is None:
+            raise self._channel_error(406, "PRECONDITION_FAILED - channel is not transactional")
+        published, self._transaction = self._transaction, []
+        for message in published:
+            self.broker.publish(*message)
+
+    def tx_rollback(self):
+        self._check_open()
+        if self._transaction is None:
+            raise self._channel_error(406, "PRECONDITION_FAILED - channel is not transactional")
+        self._transaction = []
+
+    def basic_publish(self, exchange: str, routing_key: str, body, properties=None, mandatory: bool = False):
+        self._check_open()
+        if isinstance(body, str):
+            body = body.encode()
+        message = (exchange, routing_key, body, properties or pika.BasicProperties())
+        if self._transaction is not None:
+            self._transaction.append(message)
+            return
+        self.broker.publish(*message)
+
+    # -- consuming ----------------------------------------------------------
+
+    def basic_qos(self, prefetch_size: int = 0, prefetch_count: int = 0, global_qos: bool = False):
+        self.prefetch_count = prefetch_count
+
+    def has_capacity(self) -> bool:
+        return self.prefetch_count == 0 or len(self._unacked) + len(self._ready) < self.prefetch_count
+
+    def basic_consume(self, queue: str, on_message_callback: Callable, auto_ack: bool = False, **kwargs) -> str:
+        self._check_open()
+        with self.broker.condition:
+            target = self.broker._queue(queue)
+            consumer = _Consumer(f"ctag-{uuid.uuid4().hex}", target, self, on_message_callback, auto_ack)
+            target.consumers.append(consumer)
+            self._consumers[consumer.tag] = consumer
+        return consumer.tag
+
+    def basic_cancel(self, consumer_tag: str):
+        with self.broker.condition:
+            consumer = self._consumers.pop(consumer_tag, None)
+            if consumer is not None and consumer in consumer.queue.consumers:
+                consumer.queue.consumers.remove(consumer)
+
+    def basic_get(self, queue: str, auto_ack: bool = False):
+        self._check_open()
+        self.broker.expire_messages()
+        with self.broker.condition:
+            target = self.broker._queue(queue)
+            if not target.messages:
+                return None, None, None
+            message = target.messages.popleft()
+            delivery_tag = next(self._delivery_tags)
+            if not auto_ack:
+                self._unacked[delivery_tag] = (target, message)
+        return self._method(delivery_tag, message), message.properties, message.body
+
+    def _method(self, delivery_tag: int, message: _Message):
+        return SimpleNamespace(
+            delivery_tag=delivery_tag,
+            exchange=message.exchange,
+            routing_key=message.routing_key,
+            redelivered=message.redelivered
+        )
+
+    def _dispatch(self) -> bool:
+        """Take messages for this channel's consumers off their queues and run the callbacks"""
+        # Competing consumers take whatever is ready; prefetch keeps the split fair
+        with self.broker.condition:
+            for consumer in list(self._consumers.values()):
+                queue = consumer.queue
+                if queue.arguments.get("x-single-active-consumer") and queue.consumers[0] is not consumer:
+                    # Standby: the earliest registered consumer receives everything
+                    continue
+                while queue.messages and self.has_capacity():
+                    message = queue.messages.popleft()
+                    delivery_tag = next(self._delivery_tags)
+                    if not consumer.auto_ack:
+                        self._unacked[delivery_tag] = (queue, message)
+                    self._ready.append((consumer, delivery_tag, message))
+
+        delivered = bool(self._ready)
+        while self._ready and self.is_open:
+            consumer, delivery_tag, message = self._ready.popleft()
+            consumer.callback(self, self._method(delivery_tag, message), message.properties, message.body)
+        return delivered
+
+    def start_consuming(self):
+        self._consuming = True
+        while self._consuming and self.is_open and self.connection.is_open:
+            self.connection.process_data_events(time_limit=0.1)
+
+    def stop_consuming(self):
+        self._consuming = False
+
+    def _settled(self, delivery_tag: int, multiple: bool) -> List[Tuple[_Queue, _Message]]:
+        if multiple and delivery_tag == 0:
+            tags = sorted(self._unacked)  # Everything outstanding
+        elif delivery_tag not in self._unacked:
+            # Like RabbitMQ, also for multiple=True: the tag itself must still be outstanding
+            raise self._channel_error(406, f"PRECONDITION_FAILED - unknown delivery tag {delivery_tag}")
+        elif multiple:
+            tags = sorted(tag for tag in self._unacked if tag <= delivery_tag)
+        else:
+            tags = [delivery_tag]
+        return [self._unacked.pop(tag) for tag in tags]
+
+    def _channel_error(self, reply_code: int, reply_text: str) -> ChannelClosedByBroker:
+        """Close the channel, as the broker does on a channel error, and return the error to raise"""
+        self.close()
+        return ChannelClosedByBroker(reply_code, reply_text)
+
+    def basic_ack(self, delivery_tag: int = 0, multiple: bool = False):
+        self._check_open()
+        with self.broker.condition:
+            self._settled(delivery_tag, multiple)
+            self.broker.condition.notify_all()
+
+    def basic_nack(self, delivery_tag: int = 0, multiple: bool = False, requeue: bool = True):
+        self._check_open()
+        with self.broker.condition:
+            for queue, message in reversed(self._settled(delivery_tag, multiple)):
+                if requeue:
+                    message.redelivered = True
+                    self.broker._enqueue(queue, message, front=True)
+                else:
+                    self.broker.dead_letter(queue, message, "rejected")
+            self.broker.condition.notify_all()
+
+    def basic_reject(self, delivery_tag: int, requeue: bool = True):
+        self.basic_nack(delivery_tag, requeue=requeue)
+
+    def close(self):
+        if not self.is_open:
+            return
+        with self.broker.condition:
+            for tag in list(self._consumers):
+                self.basic_cancel(tag)
+            # Unacknowledged messages go back to their queues, as on a real broker
+            for queue, message in reversed([self._unacked[tag] for tag in sorted(self._unacked)]):
+                message.redelivered = True
+                self.broker._enqueue(queue, message, front=True)
+            self._unacked.clear()
+            self._ready.clear()
+            self.broker.condition.notify_all()
+        # Uncommitted publishes are discarded
+        if self._transaction is not None:
+            self._transaction = []
+        self.is_open = False
+
+    def _check_open(self):
+        if not self.is_open:
+            raise ChannelClosedByBroker(504, "Channel closed")
+
+
+def connect(url: str = MEMORY_URL_SCHEME) -> InMemoryConnection:
+    """Open a connection to the in-memory broker named by a memory:// URL"""
+    return InMemoryConnection(get_broker(url))
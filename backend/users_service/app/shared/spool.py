@@ -0,0 +1,290 @@
+import base64
+import json
+import logging
+import os
+import threading
+import time
+from typing import Callable, List, Optional
+from .config import config
+from .rabbitmq_client import backoff_delay
+from .codec import CONTENT_TYPE_JSON, EncodedMessage
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+FSYNC_POLICIES = ("always", "interval", "never")
+
+
+class SpoolFull(Exception):
+    """Raised when appending would grow the spool past its size limit"""
+
+
+def make_record(exchange_name: str, routing_key: str, event_type: str, encoded: EncodedMessage) -> dict:
+    """Build a spool record for an encoded message"""
+    return {
+        "exchange": exchange_name,
+        "routing_key": routing_key,
+        "event_type": event_type,
+        "body": base64.b64encode(encoded.body).decode(),
+        "content_type": encoded.content_type,
+        "content_encoding": encoded.content_encoding,
+        "message_type": encoded.message_type,
+        "partition_key": encoded.partition_key,
+    }
+
+
+def record_message(record: dict) -> EncodedMessage:
+    """Encoded message stored in a spool record"""
+    if "content_type" not in record:
+        # Records spooled before content types were negotiated hold the JSON text itself
+        return EncodedMessage(record["body"].encode(), CONTENT_TYPE_JSON)
+    return EncodedMessage(
+        base64.b64decode(record["body"]),
+        record["content_type"],
+        record.get("content_encoding"),
+        record.get("message_type"),
+        record.get("partition_key")
+    )
+
+
+def publish_record(client, record: dict):
+    """Publish a spool record with a connected RabbitMQClient"""
+    client.publish_encoded(record["exchange"], record_message(record), record["routing_key"])
+
+
+class EventSpool:
+    """
+    Append-only file of events that could not be published
+
+    Records are JSON lines. The replay position is kept in a separate offset
+    file, so a crash during replay resumes where it stopped; once everything
+    has been replayed both files are truncated.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_bytes: Optional[int] = None,
+        fsync_policy: Optional[str] = None,
+        fsync_interval_ms: Optional[int] = None
+    ):
+        """
+        Initialize event spool
+
+        Args:
+            path: Spool file path (the offset is stored next to it)
+            max_bytes: Maximum spool file size
+            fsync_policy: When appends are fsynced (always, interval, never)
+            fsync_interval_ms: Minimum time between fsyncs with the interval policy
+        """
+        self.path = path
+        self.offset_path = f"{path}.offset"
+        self.max_bytes = max_bytes or config.SPOOL_MAX_BYTES
+        self.fsync_policy = fsync_policy or config.SPOOL_FSYNC_POLICY
+        self.fsync_interval = (fsync_interval_ms or config.SPOOL_FSYNC_INTERVAL_MS) / 1000
+
+        if self.fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy: {self.fsync_policy}")
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._replay_lock = threading.Lock()
+        self._file = open(path, "ab")
+        self._size = self._file.tell()
+        self._offset = self._read_offset()
+        self._last_fsync = time.monotonic()
+        self.appended = 0
+        self.replayed = 0
+        self.rejected = 0
+
+    def _read_offset(self) -> int:
+        try:
+            with open(self.offset_path) as f:
+                return min(int(f.read().strip() or 0), self._size)
+        except FileNotFoundError:
+            return 0
+
+    def _write_offset(self, offset: int):
+        tmp_path = f"{self.offset_path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(str(offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.offset_path)
+        self._offset = offset
+
+    def has_pending(self) -> bool:
+        """Whether there are spooled events not yet replayed"""
+        return self._offset < self._size
+
+    def pending_bytes(self) -> int:
+        return self._size - self._offset
+
+    def append(self, records: List[dict]):
+        """
+        Append records to the spool
+
+        Args:
+            records: JSON-serializable records (exchange, routing key and body)
+
+        Raises:
+            SpoolFull: If the records do not fit within max_bytes
+        """
+        data = b"".join(json.dumps(record).encode() + b"\n" for record in records)
+        with self._lock:
+            if self._size + len(data) > self.max_bytes:
+                self.rejected += len(records)
+                raise SpoolFull(f"Spool {self.path} is full ({self._size} bytes)")
+
+            self._file.write(data)
+            self._file.flush()
+            self._size += len(data)
+            self.appended += len(records)
+
+            now = time.monotonic()
+            if self.fsync_policy == "always" or (
+                self.fsync_policy == "interval" and now - self._last_fsync >= self.fsync_interval
+            ):
+                os.fsync(self._file.fileno())
+                self._last_fsync = now
+
+    def replay(
+        self,
+        publish: Callable[[dict], None],
+        batch_size: Optional[int] = None,
+        commit: Optional[Callable[[], None]] = None
+    ) -> int:
+        """
+        Publish spooled records in order
+
+        The offset is committed after every batch, and after the last
+        successful record when publish raises. With `commit` (a
+        transactional channel) records only count once commit returns, so a
+        failed batch is replayed whole next time.
+
+        Args:
+            publish: Callable publishing a single record; raises on failure
+            batch_size: Number of records published between offset commits
+            commit: Callable committing the records published so far; raises on failure
+
+        Returns:
+            Number of records replayed
+        """
+        batch_size = batch_size or config.SPOOL_REPLAY_BATCH_SIZE
+        replayed = 0
+        # Appends only take the main lock briefly, so producers are not blocked for the whole replay
+        with self._replay_lock:
+            with open(self.path, "rb") as f:
+                f.seek(self._offset)
+                while True:
+                    position = self._offset
+                    lines = []
+                    for _ in range(batch_size):
+                        line = f.readline()
+                        if not line.endswith(b"\n"):
+                            break
+                        lines.append(line)
+                    if not lines:
+                        break
+
+                    published = 0
+                    try:
+                        for line in lines:
+                            publish(json.loads(line))
+                            position += len(line)
+                            published += 1
+                        if commit is not None:
+                            commit()
+                    except Exception:
+                        if commit is not None:
+                            published = 0  # Nothing of an uncommitted batch reached the broker
+                        raise
+                    finally:
+                        if published:
+                            with self._lock:
+                                self._write_offset(position)
+                                self.replayed += published
+                            replayed += published
+
+            with self._lock:
+                if not self.has_pending():
+                    self._truncate()
+        return replayed
+
+    def _truncate(self):
+        self._file.truncate(0)
+        self._file.seek(0)
+        self._size = 0
+        self._write_offset(0)
+
+    def stats(self) -> dict:
+        return {
+            "path": self.path,
+            "pending_bytes": self.pending_bytes(),
+            "max_bytes": self.max_bytes,
+            "fsync_policy": self.fsync_policy,
+            "appended": self.appended,
+            "replayed": self.replayed,
+            "rejected": self.rejected,
+        }
+
+    def close(self):
+        with self._lock:
+            self._file.flush()
+            if self.fsync_policy != "never":
+                os.fsync(self._file.fileno())
+            self._file.close()
+
+
+class SpoolReplayer:
+    """Background thread that replays a spool once the broker is reachable again"""
+
+    def __init__(self, spool: EventSpool, publish: Callable[[dict], None], poll_interval: float = 1.0):
+        """
+        Initialize spool replayer
+
+        Args:
+            spool: Spool to drain
+            publish: Callable publishing a single record; raises on failure
+            poll_interval: Seconds between checks while the spool is empty
+        """
+        self.spool = spool
+        self.publish = publish
+        self.poll_interval = poll_interval
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="spool-replayer", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def notify(self):
+        """Wake the replayer after something has been spooled"""
+        self._wakeup.set()
+
+    def stop(self):
+        self._stopping = True
+        self._wakeup.set()
+
+    def _run(self):
+        attempt = 0
+        while not self._stopping:
+            if not self.spool.has_pending():
+                attempt = 0
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+
+            try:
+                replayed = self.spool.replay(self.publish)
+                logger.info(f"Replayed {replayed} spooled events")
+                attempt = 0
+            except Exception as e:
+                logger.warning(f"Spool replay failed, retrying: {e}")
+                time.sleep(backoff_delay(attempt))
+                attempt += 1
+
+
+def spool_path(name: str) -> str:
+    """Path of a named spool file inside SPOOL_DIR"""
+    return os.path.join(config.SPOOL_DIR, f"{name}.spool")
@@ -0,0 +1,38 @@
+"""
+Run the users service against a throwaway database and the in-memory broker
+
+The database is a fresh SQLite file unless TEST_DATABASE_URL points at
+another database. Its tables are dropped and recreated for every test.
+
+Usage (from the users_service directory):
+    python -m pytest -q tests
+"""
+import os
+import sys
+import tempfile
+
+WORKDIR = tempfile.mkdtemp(prefix="users-tests-")
+os.environ["DATABASE_URL"] = os.getenv("TEST_DATABASE_URL", f"sqlite:///{os.path.join(WORKDIR, 'users.db')}")
+os.environ["RABBITMQ_URL"] = "memory://"
+os.environ["SPOOL_DIR"] = os.path.join(WORKDIR, "spool")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import pytest  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+from app import database, models  # noqa: E402
+from app.main import app  # noqa: E402
+
+
+@pytest.fixture
+def users_db():
+    models.Base.metadata.drop_all(bind=database.engine)
+    models.Base.metadata.create_all(bind=database.engine)
+    yield database.engine
+    database.engine.dispose()
+
+
+@pytest.fixture
+def client(users_db):
+    # Not entered as a context manager: the lifespan would start the revocation listener
+    return TestClient(app)
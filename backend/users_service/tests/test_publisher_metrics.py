@@ -0,0 +1,31 @@
+"""
+The background publisher reports what its batches cost
+
+Batches are written in an AMQP transaction, so the latency reported per
+batch is the time until tx_commit returned (there are no publisher
+confirms).
+"""
+from datetime import datetime
+from app.routers import users
+from app.shared.event_schemas import UserLoggedInEvent
+from app.shared.publisher import BackgroundPublisher
+from app.shared.rabbitmq_client import USERS_EXCHANGE, setup_rabbitmq_infrastructure
+
+EVENTS = 120
+
+
+def test_metrics_report_commit_latency(client, monkeypatch):
+    setup_rabbitmq_infrastructure()
+    publisher = BackgroundPublisher(batch_size=50, flush_interval_ms=20)
+    monkeypatch.setattr(users, "rabbitmq_client", publisher)
+    for user_id in range(EVENTS):
+        publisher.publish(
+            USERS_EXCHANGE, UserLoggedInEvent(user_id=user_id, username=f"user{user_id}", timestamp=datetime.utcnow())
+        )
+    publisher.close()
+
+    metrics = client.get("/metrics/publisher").json()
+    assert metrics["published"] == EVENTS
+    assert metrics["batches"] >= EVENTS // 50
+    assert 0 < metrics["commit_latency_avg_ms"] <= metrics["commit_latency_max_ms"]
+    assert not any(name.startswith("confirm_") for name in metrics)
@@ -0,0 +1,82 @@
+"""
+Logging out revokes the token in every service
+
+Logout stores the token id, adds it to this process's revocation list and
+publishes it for the other services; afterwards the token is refused.
+Service tokens belong to no user and cannot be logged out.
+"""
+import time
+from app.shared import memory_broker
+from app.shared.codec import decode_body
+from app.shared.jwt_utils import create_service_token
+from app.shared.rabbitmq_client import REVOCATIONS_EXCHANGE, setup_rabbitmq_infrastructure
+from app.shared.revocation import BloomFilter, RevocationList
+from app import database, models
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = BloomFilter(1000, 0.01)
+    for i in range(1000):
+        bloom.add(f"token-{i}")
+    assert all(f"token-{i}" in bloom for i in range(1000))
+    false_positives = sum(f"other-{i}" in bloom for i in range(10000))
+    assert false_positives < 300
+
+
+def test_revocation_list_expires_and_grows():
+    revocations = RevocationList(capacity=4, error_rate=0.01)
+    now = time.time()
+    revocations.revoke("expired", now - 1)
+    assert not revocations.is_revoked("expired")
+    assert len(revocations) == 0
+
+    for i in range(10):
+        revocations.revoke(f"jti-{i}", now + 60)
+    assert revocations.capacity >= 10
+    assert all(revocations.is_revoked(f"jti-{i}") for i in range(10))
+    assert not revocations.is_revoked("jti-10")
+
+    revocations.revoke("short", now + 0.05)
+    time.sleep(0.1)
+    assert not revocations.is_revoked("short")
+    revocations.prune()
+    assert len(revocations) == 10
+
+
+def register_and_login(client) -> str:
+    user = {"username": "alice", "email": "alice@example.com", "password": "secret123"}
+    assert client.post("/users/register", json=user).status_code == 201
+    response = client.post("/users/login", json={"username": "alice", "password": "secret123"})
+    assert response.status_code == 200
+    return response.json()["access_token"]
+
+
+def test_logout_revokes_token(client):
+    setup_rabbitmq_infrastructure()
+    # What the revocation listener of another service binds
+    broker = memory_broker.get_broker()
+    broker.declare_exchange(REVOCATIONS_EXCHANGE, "fanout")
+    listener = broker.declare_queue("revocations-listener", None, None, False)
+    broker.bind("revocations-listener", REVOCATIONS_EXCHANGE, "")
+    broker.purge("revocations-listener")
+
+    token = register_and_login(client)
+    headers = {"Authorization": f"Bearer {token}"}
+    assert client.get("/users/me", headers=headers).status_code == 200
+
+    assert client.post("/users/logout", headers=headers).status_code == 204
+    assert client.get("/users/me", headers=headers).status_code == 401
+
+    with database.SessionLocal() as db:
+        (revoked,) = db.query(models.RevokedToken).all()
+    (message,) = listener.messages
+    event = decode_body(message.body, message.properties.content_type, message.properties.content_encoding)
+    assert event["jti"] == revoked.jti
+    assert event["user_id"] == revoked.user_id
+
+
+def test_service_token_cannot_log_out(client):
+    headers = {"Authorization": f"Bearer {create_service_token('notes-service')}"}
+    assert client.post("/users/logout", headers=headers).status_code == 403
+    with database.SessionLocal() as db:
+        assert db.query(models.RevokedToken).count() == 0
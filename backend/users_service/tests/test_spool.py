@@ -0,0 +1,133 @@
+"""
+The spool replays every event once, in order, across failures and restarts
+
+Replay commits its offset after each batch (or after the last record
+published when publish fails), so a reopened spool resumes where the
+previous one stopped. On a transactional channel a batch only counts
+once its commit returns.
+"""
+import os
+import time
+from datetime import datetime
+import pytest
+from app.shared import memory_broker
+from app.shared.codec import decode_body
+from app.shared.config import config
+from app.shared.event_schemas import UserLoggedInEvent
+from app.shared.publisher import BackgroundPublisher
+from app.shared.rabbitmq_client import USERS_EXCHANGE, RabbitMQClient, setup_rabbitmq_infrastructure
+from app.shared.spool import EventSpool, SpoolFull
+
+
+def records(start: int, count: int):
+    return [
+        {"exchange": "users.topic", "routing_key": "user.logged_in", "seq": seq}
+        for seq in range(start, start + count)
+    ]
+
+
+def open_spool(tmp_path, **kwargs) -> EventSpool:
+    return EventSpool(str(tmp_path / "events.spool"), fsync_policy="never", **kwargs)
+
+
+def test_replay_resumes_from_committed_offset(tmp_path):
+    spool = open_spool(tmp_path)
+    spool.append(records(0, 5))
+    spool.append(records(5, 5))
+    assert spool.has_pending()
+
+    published = []
+
+    def fail_at_seven(record):
+        if record["seq"] == 7:
+            raise ConnectionError("broker gone")
+        published.append(record["seq"])
+
+    with pytest.raises(ConnectionError):
+        spool.replay(fail_at_seven, batch_size=3)
+    assert published == list(range(7))
+    spool.close()
+
+    # A restarted process continues after the last published record
+    spool = open_spool(tmp_path)
+    assert spool.replay(lambda record: published.append(record["seq"]), batch_size=3) == 3
+    assert published == list(range(10))
+    assert not spool.has_pending()
+    assert os.path.getsize(spool.path) == 0
+    spool.close()
+
+
+def test_failed_commit_replays_whole_batch(tmp_path):
+    spool = open_spool(tmp_path)
+    spool.append(records(0, 4))
+    published, committed = [], []
+
+    def commit():
+        if len(published) > 2:
+            raise ConnectionError("commit failed")
+        committed.extend(published)
+
+    with pytest.raises(ConnectionError):
+        spool.replay(lambda record: published.append(record["seq"]), batch_size=2, commit=commit)
+    assert committed == [0, 1]
+    assert spool.replayed == 2
+
+    published.clear()
+    committed.clear()
+    assert spool.replay(lambda record: published.append(record["seq"]), batch_size=2, commit=lambda: None) == 2
+    assert published == [2, 3]
+    spool.close()
+
+
+def test_full_spool_rejects_appends(tmp_path):
+    spool = open_spool(tmp_path, max_bytes=200)
+    spool.append(records(0, 1))
+    with pytest.raises(SpoolFull):
+        spool.append(records(1, 10))
+    assert (spool.appended, spool.rejected) == (1, 10)
+
+    # A torn last line (crash mid-append) is not replayed
+    with open(spool.path, "ab") as f:
+        f.write(b'{"seq": 99')
+    published = []
+    spool.replay(lambda record: published.append(record["seq"]))
+    assert published == [0]
+    spool.close()
+
+
+def test_publisher_spools_during_outage_and_replays_in_order(tmp_path, monkeypatch):
+    memory_broker.reset_brokers()
+    monkeypatch.setattr(config, "RABBITMQ_RECONNECT_BASE_MS", 10)
+    monkeypatch.setattr(config, "RABBITMQ_RECONNECT_MAX_MS", 50)
+    spool = open_spool(tmp_path)
+    publisher = BackgroundPublisher(batch_size=10, flush_interval_ms=10, max_retries=0, spool=spool)
+    now = datetime.utcnow()
+    # No exchange yet: every publish fails, like with the broker down
+    for user_id in range(1, 26):
+        publisher.publish(USERS_EXCHANGE, UserLoggedInEvent(user_id=user_id, username=f"user{user_id}", timestamp=now))
+    deadline = time.monotonic() + 5
+    while publisher.get_metrics()["spooled"] < 25 and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert publisher.get_metrics()["spooled"] == 25
+
+    setup_rabbitmq_infrastructure()
+    client = RabbitMQClient()
+    client.connect()
+    client.declare_queue("audit")
+    client.bind_queue("audit", USERS_EXCHANGE, "#")
+    client.close()
+
+    # Queued behind the spooled events until the replay succeeds
+    publisher.publish(USERS_EXCHANGE, UserLoggedInEvent(user_id=26, username="user26", timestamp=now))
+    messages = memory_broker.get_broker().queues["audit"].messages
+    deadline = time.monotonic() + 5
+    while len(messages) < 26 and time.monotonic() < deadline:
+        time.sleep(0.02)
+    publisher.close()
+    user_ids = [
+        decode_body(message.body, message.properties.content_type, message.properties.content_encoding)["user_id"]
+        for message in messages
+    ]
+    assert user_ids == list(range(1, 27))
+    assert not spool.has_pending()
+    memory_broker.reset_brokers()
@@ -76,25 +76,6 @@ function App() {
     }
   };
 
-  // Fetch user statistics
-  const fetchStatistics = async () => {
-    if (!token) return;
-
-    try {
-      const response = await fetch(`${ANALYTICS_API_URL}/analytics/users/me/statistics`, {
-        headers: {
-          'Authorization': `Bearer ${token}`,
-        },
-      });
-      if (response.ok) {
-        const data = await response.json();
-        setStatistics(data);
-      }
-    } catch (err) {
-      console.error('Error fetching statistics:', err);
-    }
-  };
-
   // Fetch system-wide statistics
   const fetchSystemStats = async () => {
     try {
@@ -131,7 +112,6 @@ function App() {
     if (token) {
       fetchUser(token);
       fetchNotes();
-      fetchStatistics();
       fetchSystemStats();
     }
   }, [token]);
@@ -142,6 +122,20 @@ function App() {
     }
   }, [user, token]);
 
+  // Live user statistics: the first event carries all fields, later ones only those that changed
+  useEffect(() => {
+    if (!token) return;
+
+    const source = new EventSource(
+      `${ANALYTICS_API_URL}/analytics/users/me/stream?token=${encodeURIComponent(token)}`
+    );
+    source.addEventListener('statistics', (event) => {
+      const changes = JSON.parse((event as MessageEvent).data);
+      setStatistics((current: any) => ({ ...current, ...changes }));
+    });
+    return () => source.close();
+  }, [token]);
+
   const handleLogin = async (username: string, password: string) => {
     try {
       setError(null);
@@ -183,6 +177,15 @@ function App() {
   };
 
   const handleLogout = () => {
+    if (token) {
+      // Revoke the token server-side; the local session is cleared regardless
+      fetch(`${USERS_API_URL}/users/logout`, {
+        method: 'POST',
+        headers: {
+          'Authorization': `Bearer ${token}`,
+        },
+      }).catch((err) => console.error('Error revoking token:', err));
+    }
     localStorage.removeItem('token');
     setToken(null);
     setUser(null);
@@ -205,7 +208,6 @@ function App() {
       });
       if (!response.ok) throw new Error('Failed to create note');
       await fetchNotes();
-      await fetchStatistics();
       await fetchNoteEvents();
       await fetchSystemStats();
     } catch (err) {
@@ -229,7 +231,6 @@ function App() {
       if (!response.ok) throw new Error('Failed to update note');
       setEditingNote(null);
       await fetchNotes();
-      await fetchStatistics();
       await fetchNoteEvents();
       await fetchSystemStats();
     } catch (err) {
@@ -251,7 +252,6 @@ function App() {
       });
       if (!response.ok) throw new Error('Failed to delete note');
       await fetchNotes();
-      await fetchStatistics();
       await fetchNoteEvents();
       await fetchSystemStats();
     } catch (err) {
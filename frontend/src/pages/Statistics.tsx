@@ -77,6 +77,14 @@ const Statistics: React.FC<StatisticsProps> = ({
               <span className="stat-label">Active Today</span>
               <span className="stat-value system-value">{systemStats.active_users_today}</span>
             </div>
+            <div className="stat-item">
+              <span className="stat-label">Active This Week</span>
+              <span className="stat-value system-value">{systemStats.active_users_week}</span>
+            </div>
+            <div className="stat-item">
+              <span className="stat-label">Active This Month</span>
+              <span className="stat-value system-value">{systemStats.active_users_month}</span>
+            </div>
           </div>
         </div>
       )}